@@ -2,6 +2,7 @@
 """
 合法爬取Pexels CC0图片（非商用）
 用途：仅用于以图搜图演示，遵守Pexels API条款
+并发下载、限速、断点续传且边下载边提取特征的版本见 src/ingest.py
 """
 import os
 import requests
@@ -6,6 +6,6 @@ if [ -z "$QUERY" ]; then
   exit 1
 fi
 source venv/Scripts/activate
-python src/preprocess.py
-python src/extract_features.py
+# 提取直接读取 dataset/images 并在内存中缩放，无需先运行 preprocess.py
+python src/extra_features.py
 python src/search_two_stage.py --query_path "$QUERY" --topk 5 --nprobe 30
\ No newline at end of file
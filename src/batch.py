@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+批量查询：图库只加载一次，一批查询一起做快速阶段（每块图库描述子每批只参与一次矩阵乘），
+再逐个查询精排，每完成一个查询就输出一行 JSONL。search_two_stage.py / search_bruteforce.py
+的 --queries 参数都走这里。
+查询列表 spec 可以是：
+  - 目录：其中的图片（.jpg/.png）与特征文件（.npz）
+  - glob：如 "dataset/queries/*.jpg"
+  - 列表文件（.txt/.lst）：每行一个路径，# 开头为注释
+图片查询现场解码 + ORB（与建库相同参数），.npz 直接读取（features/ 下的图库特征会排除自身）。
+输出每行：{"query": 路径, "results": [{"name": ..., "score": ...}], "elapsed_ms": ...}
+（elapsed_ms 为上一条记录输出到该查询完成的时间；批次的快速阶段算在批次第一个查询上）
+读取失败、索引现场重建等提示都写到标准错误，标准输出只有 JSONL。
+"""
+import glob as globlib
+import json
+import sys
+import time
+from pathlib import Path
+
+from src.extra_features import ORB_PARAMS
+from src.feature_store import FEAT_DIR
+from src.pipeline import IMAGE_SUFFIXES, MAX_SIDE, stream_features
+from src.ransac_validate import load_kps_des
+from src import tracing
+
+BATCH_SIZE = 32
+LIST_SUFFIXES = (".txt", ".lst")
+
+
+def resolve_queries(spec: str):
+    """把目录 / glob / 列表文件展开成有序的查询路径列表"""
+    p = Path(spec)
+    if p.is_dir():
+        paths = sorted(x for x in p.iterdir() if x.suffix.lower() in IMAGE_SUFFIXES + (".npz",))
+    elif p.is_file() and p.suffix.lower() in LIST_SUFFIXES:
+        with open(p, encoding="utf-8") as f:
+            lines = [ln.strip() for ln in f]
+        paths = [Path(ln) for ln in lines if ln and not ln.startswith("#")]
+    elif p.is_file():
+        paths = [p]
+    else:
+        paths = sorted(Path(x) for x in globlib.glob(spec))
+    return paths
+
+
+def load_queries(paths, max_side: int = MAX_SIDE, workers: int = 2):
+    """
+    生成器：按输入顺序产出 (path, pts, des, exclude)；读不到的查询 des 为 None
+    图片查询通过 pipeline.stream_features 并行解码 + 提取
+    """
+    images = [p for p in paths if p.suffix.lower() != ".npz"]
+    extracted = stream_features(images, ORB_PARAMS, max_side, workers=workers)
+    for p in paths:
+        if p.suffix.lower() == ".npz":
+            pts, des = load_kps_des(p)
+            yield p, pts, des, (p.stem if p.parent == FEAT_DIR else None)
+        else:
+            _, _, pts, des = next(extracted)
+            yield p, pts, des, None
+
+
+def chunks(items, size: int):
+    buf = []
+    for x in items:
+        buf.append(x)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+def run(spec: str, search_batch, out=None, batch_size: int = BATCH_SIZE, max_side: int = MAX_SIDE,
+        workers: int = 2) -> int:
+    """
+    search_batch(queries) 接收 [(pts, des, exclude)]，按顺序产出每个查询的 [(图片id, 分数)]。
+    结果逐行写入 out（默认标准输出）并立即 flush，返回处理的查询数
+    """
+    out = out or sys.stdout
+    paths = resolve_queries(spec)
+    n = 0
+    for chunk in chunks(load_queries(paths, max_side, workers), batch_size):
+        ok = [q for q in chunk if q[2] is not None]
+        results = search_batch([(pts, des, ex) for _, pts, des, ex in ok])
+        t0 = time.perf_counter()
+        for path, _, des, _ in chunk:
+            if des is None:
+                rec = {"query": str(path), "error": "cannot load query"}
+            else:
+                # 批量的快速阶段在第一个查询取结果时执行，记在该查询名下
+                with tracing.query(path):
+                    res = next(results)
+                t1 = time.perf_counter()
+                rec = {"query": str(path), "results": [{"name": name, "score": int(s)} for name, s in res],
+                       "elapsed_ms": (t1 - t0) * 1000}
+                t0 = t1
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()
+            n += 1
+    return n
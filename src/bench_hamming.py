@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+hamming.py 的正确性对拍与微基准：
+  - 与 OpenCV BFMatcher(NORM_HAMMING) 在 uint8 描述子上的 knnMatch(k=2) + 比值测试逐项比较
+  - 比较单对匹配（OpenCV / XOR+popcount / 矩阵乘）与一对多 match_many 的耗时
+用法：
+  python src/bench_hamming.py                 # 随机描述子 + features/ 中的真实描述子
+  python src/bench_hamming.py --repeat 20
+"""
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from src import hamming
+from src.feature_store import FEAT_DIR, open_gallery
+
+
+def cv2_ratio_match(des1, des2, ratio):
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+    out = []
+    for m in bf.knnMatch(des1, des2, k=2):
+        if len(m) == 2 and m[0].distance < ratio * m[1].distance:
+            out.append((m[0].queryIdx, m[0].trainIdx, m[0].distance))
+    return out
+
+
+def check_pair(des1, des2, ratio=hamming.RATIO_TEST_THRESHOLD):
+    """返回不一致项数；最近邻并列时只比较距离"""
+    ref = cv2_ratio_match(des1, des2, ratio)
+    qi, ti, d = hamming.ratio_match(des1, des2, ratio)
+    ours = {int(a): (int(b), float(c)) for a, b, c in zip(qi, ti, d)}
+    dist = hamming.hamming_matrix(des1, des2)
+    bad = abs(len(ref) - len(ours))
+    for q, t, dd in ref:
+        if q not in ours or ours[q][1] != dd:
+            bad += 1
+        elif ours[q][0] != t and dist[q, ours[q][0]] != dist[q, t]:
+            bad += 1
+    return bad
+
+
+def timeit(fn, repeat):
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--n", type=int, default=800, help="descriptors per image")
+    parser.add_argument("--images", type=int, default=100, help="gallery images for match_many")
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    # ---- 正确性 ----
+    pairs = [(rng.integers(0, 256, (n1, 32), dtype=np.uint8), rng.integers(0, 256, (n2, 32), dtype=np.uint8))
+             for n1, n2 in [(1, 2), (5, 1), (50, 60), (300, 700), (800, 800)]]
+    gallery = open_gallery(FEAT_DIR)
+    for i in range(0, min(len(gallery), 20), 2):
+        pairs.append((np.asarray(gallery.get(i)[1]), np.asarray(gallery.get(i + 1)[1])))
+    bad = sum(check_pair(a, b) for a, b in pairs)
+    # 距离矩阵两条计算路径逐元素一致
+    a, b = pairs[3]
+    ref = np.unpackbits(a[:, None, :] ^ b[None, :, :], axis=2).sum(axis=2)
+    same = (np.array_equal(hamming._hamming_xor(a, b), ref)
+            and np.array_equal(hamming._hamming_gemm(a, b), ref))
+    print(f"correctness: {len(pairs)} pairs, mismatches={bad}, distance paths equal={same}")
+
+    # ---- 计时 ----
+    q = rng.integers(0, 256, (args.n, 32), dtype=np.uint8)
+    t = rng.integers(0, 256, (args.n, 32), dtype=np.uint8)
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+    print(f"one pair {args.n}x{args.n} (ms):")
+    print(f"  cv2 knnMatch uint8   {timeit(lambda: bf.knnMatch(q, t, k=2), args.repeat):8.2f}")
+    print(f"  xor+popcount         {timeit(lambda: hamming._ratio_from_dist(hamming._hamming_xor(q, t), 0.75), args.repeat):8.2f}")
+    print(f"  gemm                 {timeit(lambda: hamming._ratio_from_dist(hamming._signed_dot(q, t), 0.75, nbits=256), args.repeat):8.2f}")
+    gal = [rng.integers(0, 256, (args.n, 32), dtype=np.uint8) for _ in range(args.images)]
+    loop_ms = timeit(lambda: [bf.knnMatch(q, g, k=2) for g in gal], 1)
+    many_ms = timeit(lambda: hamming.match_many(q, gal), 1)
+    print(f"one query vs {args.images} images (ms):")
+    print(f"  cv2 knnMatch loop    {loop_ms:8.2f}")
+    print(f"  match_many           {many_ms:8.2f}")
+    return 1 if bad or not same else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+基准测试：从 dataset/images 合成指定规模的图库（裁剪、旋转、缩放、JPEG 重编码、亮度/对比度抖动），
+查询图由某张图库图片再做一次轻度变换得到，因此每个查询的正确答案已知：
+图库按源图循环生成，同一源图的所有变换（<源图>__<序号>.jpg）都算正确答案，全部写进 groundtruth.csv。
+对每个规模测量：
+  - 预处理吞吐（解码 + 缩放，pipeline.load_gray）、特征提取吞吐（extract_to_store）
+  - 各索引的建库时间（BoW / VLAD / MIH）、查询特征提取耗时
+  - 每个检索引擎（brute / two_stage / cascade / bow / vlad / mih）的查询延迟 p50/p95/p99、recall@K、mAP、MRR
+  - 各阶段结束时的峰值 RSS
+结果写成 JSON（默认 bench/results/），可以用 compare 子命令对比两次运行、发现性能或召回回退。
+合成图库缓存在 bench/data/<规模>/，同样参数再次运行不会重新生成。
+用法：
+  python src/benchmark.py run --scales 1000 10000 --queries 50
+  python src/benchmark.py run --scales 100000 --engines bow vlad mih     # 大规模时跳过逐图匹配
+  python src/benchmark.py compare bench/results/a.json bench/results/b.json --tolerance 0.1
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.evaluate import KS, latency_stats, load_gt, rank_metrics
+from src.extra_features import ORB_PARAMS, extract_to_store
+from src.feature_store import STORE_DIRNAME, open_gallery, release_store
+from src.pipeline import MAX_SIDE, bounded_map, list_images, load_gray, stream_features
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource，峰值 RSS 记为 None
+    resource = None
+
+BENCH_DIR = Path("bench")
+DATA_DIR = BENCH_DIR / "data"
+RESULTS_DIR = BENCH_DIR / "results"
+SRC_DIR = Path("dataset/images")
+SCALES = (1000, 10000, 100000)
+ENGINES = ("brute", "two_stage", "cascade", "bow", "vlad", "mih")
+GT_FILE = "groundtruth.csv"
+META_FILE = "meta.json"
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KiB，macOS 是字节
+    return round(rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def percentiles(xs):
+    return latency_stats(xs) if xs else {}
+
+
+# ---------------- 合成图库 ----------------
+
+def augment(img, rng, strong: bool = True):
+    """随机裁剪 + 旋转/缩放 + 亮度/对比度/gamma 抖动；strong=False 为查询用的轻度变换"""
+    h, w = img.shape[:2]
+    keep = rng.uniform(0.7, 1.0) if strong else rng.uniform(0.85, 1.0)
+    ch, cw = int(h * keep), int(w * keep)
+    y, x = rng.integers(0, h - ch + 1), rng.integers(0, w - cw + 1)
+    img = img[y:y + ch, x:x + cw]
+    angle = rng.uniform(-30, 30) if strong else rng.uniform(-10, 10)
+    scale = rng.uniform(0.6, 1.2) if strong else rng.uniform(0.8, 1.1)
+    M = cv2.getRotationMatrix2D((cw / 2, ch / 2), angle, scale)
+    img = cv2.warpAffine(img, M, (cw, ch), borderMode=cv2.BORDER_REFLECT)
+    alpha = rng.uniform(0.7, 1.3) if strong else rng.uniform(0.85, 1.15)
+    beta = rng.uniform(-30, 30) if strong else rng.uniform(-15, 15)
+    img = cv2.convertScaleAbs(img, alpha=alpha, beta=beta)
+    gamma = rng.uniform(0.7, 1.4) if strong else 1.0
+    if gamma != 1.0:
+        lut = (np.linspace(0, 1, 256) ** gamma * 255).astype(np.uint8)
+        img = cv2.LUT(img, lut)
+    return img
+
+
+def _jpeg(img, rng, lo=50, hi=95) -> bytes:
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(lo, hi + 1))])
+    return buf.tobytes()
+
+
+def make_gallery(out_dir: Path, n_images: int, n_queries: int, src_dir: Path = SRC_DIR,
+                 max_side: int = MAX_SIDE, seed: int = 0, workers: int = 4):
+    """
+    生成 out_dir/images（n_images 张变换图）、out_dir/queries 与 groundtruth.csv（query,gt，每个正确答案一行）
+    已有相同参数的数据时直接复用
+    """
+    meta = {"n_images": n_images, "n_queries": n_queries, "src": str(src_dir), "max_side": max_side, "seed": seed,
+            "gt": "source"}
+    meta_path = out_dir / META_FILE
+    if meta_path.exists() and json.loads(meta_path.read_text(encoding="utf-8")) == meta:
+        return
+    sources = []
+    for p in list_images(src_dir):
+        _, gray = load_gray(p, max_side)
+        if gray is not None:
+            sources.append((p.stem, gray))
+    if not sources:
+        raise FileNotFoundError(f"no readable images in {src_dir}")
+    img_dir, q_dir = out_dir / "images", out_dir / "queries"
+    img_dir.mkdir(parents=True, exist_ok=True)
+    q_dir.mkdir(parents=True, exist_ok=True)
+
+    def gen_gallery(i):
+        rng = np.random.default_rng([seed, i])
+        stem, src = sources[i % len(sources)]
+        name = f"{stem}__{i:06d}.jpg"
+        (img_dir / name).write_bytes(_jpeg(augment(src, rng), rng))
+        return name
+
+    names = list(bounded_map(gen_gallery, range(n_images), workers, 4 * workers))
+    rng = np.random.default_rng([seed, n_images])
+    picks = rng.choice(n_images, size=min(n_queries, n_images), replace=False)
+
+    def gen_query(j):
+        qrng = np.random.default_rng([seed, n_images, j])
+        g = cv2.imread(str(img_dir / names[picks[j]]), cv2.IMREAD_GRAYSCALE)
+        qname = f"q_{j:05d}.jpg"
+        (q_dir / qname).write_bytes(_jpeg(augment(g, qrng, strong=False), qrng, 70, 95))
+        return qname
+
+    qnames = list(bounded_map(gen_query, range(len(picks)), workers, 4 * workers))
+    # 与查询同源的图库图片都是正确答案
+    by_source = {}
+    for name in names:
+        by_source.setdefault(name.split("__")[0], []).append(name)
+    with open(out_dir / GT_FILE, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        for qname, gi in zip(qnames, picks):
+            for name in by_source[names[gi].split("__")[0]]:
+                w.writerow([str(q_dir / qname), str(img_dir / name)])
+    meta_path.write_text(json.dumps(meta), encoding="utf-8")
+
+
+def load_pairs(out_dir: Path):
+    """[(查询路径, 正确答案 stem 的集合)]，按查询首次出现的顺序"""
+    return [(Path(q), gt) for q, gt in load_gt(out_dir / GT_FILE).items()]
+
+
+# ---------------- 测量 ----------------
+
+def _engines(gallery, indexes, topk, nprobe):
+    from src import search_bruteforce, search_two_stage
+    return {
+        "brute": lambda p, d: search_bruteforce.search(gallery, p, d, topk),
+        "two_stage": lambda p, d: search_two_stage.search(gallery, p, d, topk, nprobe),
+        "cascade": lambda p, d: search_two_stage.search(gallery, p, d, topk, nprobe, coarse="cascade"),
+        "bow": lambda p, d: search_two_stage.search(gallery, p, d, topk, nprobe, coarse="bow", bow=indexes["bow"]),
+        "vlad": lambda p, d: search_two_stage.search(gallery, p, d, topk, nprobe, coarse="vlad",
+                                                     glob=indexes["vlad"]),
+        "mih": lambda p, d: search_bruteforce.search_mih(gallery, indexes["mih"], p, d, topk, nprobe),
+    }
+
+
+def bench_scale(n_images: int, args) -> dict:
+    from src.global_desc import train_global
+    from src.mih import MIHIndex
+    from src.vocab import train_bow
+    out_dir = Path(args.data) / str(n_images)
+    res = {"images": n_images}
+    t0 = time.time()
+    make_gallery(out_dir, n_images, args.queries, Path(args.src), workers=args.workers)
+    res["generate_s"] = time.time() - t0
+    files = list_images(out_dir / "images")
+
+    sample = files[:min(len(files), args.pre_sample)]
+    t0 = time.time()
+    for p in sample:
+        load_gray(p)
+    res["preprocess_img_per_s"] = len(sample) / max(time.time() - t0, 1e-9)
+
+    feat_dir = out_dir / "features"
+    release_store(feat_dir)
+    t0 = time.time()
+    counts, _, _, _ = extract_to_store(files, feat_dir / STORE_DIRNAME, workers=args.workers, full=True)
+    dt = time.time() - t0
+    res["extract_img_per_s"] = len(files) / max(dt, 1e-9)
+    res["extract_s"] = dt
+    res["descriptors"] = int(sum(counts))
+    res["peak_rss_mb_after_extract"] = peak_rss_mb()
+
+    gallery = open_gallery(feat_dir)
+    indexes, res["build_s"] = {}, {}
+    builders = {"bow": lambda: train_bow(gallery, k=args.bow_k, depth=args.bow_depth),
+                "vlad": lambda: train_global(gallery),
+                "mih": lambda: MIHIndex.build(gallery)}
+    for name, fn in builders.items():
+        if name in args.engines:
+            t0 = time.time()
+            indexes[name] = fn()
+            res["build_s"][name] = time.time() - t0
+    res["peak_rss_mb_after_build"] = peak_rss_mb()
+
+    pairs = load_pairs(out_dir)
+    queries, t_extract = [], []
+    t0 = time.time()
+    for (path, _, pts, des), (_, gt) in zip(stream_features([q for q, _ in pairs], ORB_PARAMS, workers=1), pairs):
+        t_extract.append(time.time() - t0)
+        if des is not None:
+            queries.append((pts, des, gt))
+        t0 = time.time()
+    res["query_extract"] = percentiles(t_extract)
+
+    engines = _engines(gallery, indexes, max(KS), args.nprobe)
+    res["engines"] = {}
+    for name in args.engines:
+        fn = engines[name]
+        lat, ranked = [], []
+        for pts, des, _ in queries:
+            t0 = time.time()
+            top = fn(pts, des)
+            lat.append(time.time() - t0)
+            ranked.append([n for n, _ in top])
+        r = dict(percentiles(lat), **rank_metrics(ranked, [gt for _, _, gt in queries]))
+        r["peak_rss_mb"] = peak_rss_mb()
+        res["engines"][name] = r
+        print(f"  {name:9s} p50 {r['p50_ms']:8.1f} ms  p95 {r['p95_ms']:8.1f} ms  "
+              f"R@1 {r['recall@1']:.3f}  R@10 {r['recall@10']:.3f}  MRR {r['mrr']:.3f}")
+    release_store(feat_dir)
+    return res
+
+
+def run(args):
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "env": {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+                "cpus": os.cpu_count(), "machine": platform.machine()},
+        "config": {"queries": args.queries, "nprobe": args.nprobe, "engines": args.engines,
+                   "orb": ORB_PARAMS, "max_side": MAX_SIDE, "bow_k": args.bow_k, "bow_depth": args.bow_depth},
+        "scales": {},
+    }
+    for n in args.scales:
+        print(f"scale {n}:")
+        report["scales"][str(n)] = bench_scale(n, args)
+        s = report["scales"][str(n)]
+        print(f"  preprocess {s['preprocess_img_per_s']:.1f} img/s, extract {s['extract_img_per_s']:.1f} img/s, "
+              f"build {', '.join(f'{k} {v:.2f}s' for k, v in s['build_s'].items())}")
+    out = Path(args.out) if args.out else RESULTS_DIR / f"bench-{datetime.now():%Y%m%d-%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print("Wrote", out)
+
+
+def compare(args) -> int:
+    """对比两份结果：延迟变慢超过 tolerance 或召回下降超过 recall_drop 记为回退，返回回退数"""
+    old = json.loads(Path(args.old).read_text(encoding="utf-8"))
+    new = json.loads(Path(args.new).read_text(encoding="utf-8"))
+    regressions = 0
+    for scale, s_new in new["scales"].items():
+        s_old = old["scales"].get(scale)
+        if s_old is None:
+            continue
+        for name, e_new in s_new["engines"].items():
+            e_old = s_old["engines"].get(name)
+            if e_old is None:
+                continue
+            notes = []
+            for key in ("p50_ms", "p95_ms"):
+                if e_new[key] > e_old[key] * (1 + args.tolerance):
+                    notes.append(f"{key} {e_old[key]:.1f} -> {e_new[key]:.1f}")
+            for key in e_new:
+                if key.startswith("recall@") or key == "mrr":
+                    if e_new[key] < e_old.get(key, 0) - args.recall_drop:
+                        notes.append(f"{key} {e_old[key]:.3f} -> {e_new[key]:.3f}")
+            status = "REGRESSION" if notes else "ok"
+            regressions += bool(notes)
+            print(f"{scale:>7s} {name:9s} {status}  " + "; ".join(notes))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("run", help="generate galleries and measure every stage")
+    r.add_argument("--scales", type=int, nargs="+", default=list(SCALES))
+    r.add_argument("--queries", type=int, default=50, help="queries per scale")
+    r.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    r.add_argument("--nprobe", type=int, default=30)
+    r.add_argument("--bow_k", type=int, default=10)
+    r.add_argument("--bow_depth", type=int, default=4)
+    r.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    r.add_argument("--pre_sample", type=int, default=500, help="images timed for preprocess throughput")
+    r.add_argument("--src", type=str, default=str(SRC_DIR))
+    r.add_argument("--data", type=str, default=str(DATA_DIR))
+    r.add_argument("--out", type=str, help="result JSON (default bench/results/bench-<time>.json)")
+    c = sub.add_parser("compare", help="compare two result files")
+    c.add_argument("old")
+    c.add_argument("new")
+    c.add_argument("--tolerance", type=float, default=0.1, help="allowed relative latency increase")
+    c.add_argument("--recall_drop", type=float, default=0.01, help="allowed absolute recall/MRR drop")
+    args = parser.parse_args()
+    if args.cmd == "run":
+        run(args)
+    else:
+        sys.exit(1 if compare(args) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,89 @@
 #!/usr/bin/env python3
 """
-简易命令行入口：按顺序运行预处理->提取->检索（两阶段）
+简易命令行入口：
+  - run_all：预处理 -> 提取 -> 建索引 -> 检索（两阶段），全部在本进程内按阶段依赖图执行（见 orchestrate.py）：
+    输入与参数都没变的阶段直接跳过，互不依赖的阶段并行，最后打印每个阶段的耗时
+  - query：查询常驻检索服务
 用法示例：
-  python src/cli.py preprocess extract extract_feats brute --query dataset/queries/q1.jpg
+  python src/cli.py run_all dataset/queries/q1.jpg
+  python src/cli.py run_all dataset/queries/q1.jpg --coarse bow --indexes vlad   # 另外顺带建 VLAD 索引
+  python src/cli.py run_all dataset/queries/q1.jpg --dry_run                     # 只列出会执行的阶段
+  python src/cli.py run_all --force extract                                      # 不检索，只重跑提取
+  python src/cli.py query dataset/queries/q1.jpg [http://127.0.0.1:8765]   # 查询常驻检索服务
 本文件是教学示例，按需调整。
 """
+import argparse
 import sys
-import subprocess
+import time
+from pathlib import Path
+from src.feature_store import FEAT_DIR
+from src.orchestrate import IMG_DIR, INDEXES, Pipeline, default_graph, print_report
+from src.pipeline import MAX_SIDE
+from src.ransac_validate import VERIFY_MODES
+from src.search_client import DEFAULT_SERVER, SearchClient
 
-def run(cmd):
-    print("RUN:", cmd)
-    r = subprocess.run(cmd, shell=True)
-    if r.returncode != 0:
-        print("Command failed:", cmd)
-        sys.exit(1)
+def run_all(args):
+    query = Path(args.query) if args.query else None
+    stages = default_graph(query, src=Path(args.src), feat_dir=Path(args.features), max_side=args.max_side,
+                           coarse=args.coarse, indexes=args.indexes, topk=args.topk, nprobe=args.nprobe,
+                           verify=args.verify, workers=args.workers, dedup=args.dedup)
+    pipe = Pipeline(stages, Path(args.features), workers=args.parallel)
+    force = set(args.force) if args.force else (set(pipe.stages) if args.force is not None else set())
+    unknown = force - set(pipe.stages)
+    if unknown:
+        print("Unknown stage(s):", ", ".join(sorted(unknown)), "- available:", ", ".join(pipe.stages))
+        return 2
+    if args.dry_run:
+        for r in pipe.plan(force=force):
+            print(f"  {r['name']:10s} {r['status']}")
+        return 0
+    t0 = time.perf_counter()
+    report = pipe.run(force=force)
+    wall = time.perf_counter() - t0
+    search = next((r for r in report if r["name"] == "search"), None)
+    if search is not None and search["status"] == "ran":
+        print("Refined Top-K:")
+        for name, inl in search["result"]:
+            print(name, inl)
+    print("Stages:")
+    print_report(report, wall)
+    return 1 if any(r["status"] in ("failed", "blocked") for r in report) else 0
+
+def query(args):
+    # 常驻服务（python src/search_server.py）已加载图库，只需上传查询图片
+    client = SearchClient(args.server)
+    res = client.search_image(args.query, topk=args.topk, nprobe=args.nprobe)
+    for r in res["results"]:
+        print(r["name"], r["score"])
+    print(f"elapsed {res['elapsed_ms']:.1f} ms")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="mode", required=True)
+    p = sub.add_parser("run_all", help="preprocess, extract, build indexes and search in one process")
+    p.add_argument("query", nargs="?", help="query image; omit to only bring the gallery up to date")
+    p.add_argument("--src", type=str, default=str(IMG_DIR), help="gallery images")
+    p.add_argument("--features", type=str, default=str(FEAT_DIR))
+    p.add_argument("--max_side", type=int, default=MAX_SIDE)
+    p.add_argument("--coarse", choices=["match", "bow", "vlad", "cascade", "flann"], default="match",
+                   help="two-stage quick stage; bow/vlad/flann add their index build stage")
+    p.add_argument("--indexes", nargs="*", choices=INDEXES, default=[], help="extra indexes to keep up to date")
+    p.add_argument("--topk", type=int, default=5)
+    p.add_argument("--nprobe", type=int, default=30)
+    p.add_argument("--verify", choices=VERIFY_MODES, default="homography")
+    p.add_argument("--dedup", action="store_true", help="extract only near-duplicate representatives")
+    p.add_argument("--workers", type=int, default=1, help="extraction processes")
+    p.add_argument("--parallel", type=int, default=2, help="stages run concurrently")
+    p.add_argument("--force", nargs="*", help="rerun these stages regardless of fingerprints (no names = all)")
+    p.add_argument("--dry_run", action="store_true", help="only show which stages would run")
+    p = sub.add_parser("query", help="query a running search_server")
+    p.add_argument("query")
+    p.add_argument("server", nargs="?", default=DEFAULT_SERVER)
+    p.add_argument("--topk", type=int, default=5)
+    p.add_argument("--nprobe", type=int, default=30)
+    args = parser.parse_args()
+    sys.exit(run_all(args) if args.mode == "run_all" else query(args))
 
 if __name__ == "__main__":
-    # 示例：  python src/cli.py run_all dataset/queries/q1.jpg
-    if len(sys.argv) < 2:
-        print("Usage: python src/cli.py run_all <query_path>")
-        sys.exit(1)
-    mode = sys.argv[1]
-    if mode == "run_all":
-        query = sys.argv[2]
-        run("python src/preprocess.py")
-        run("python src/extract_features.py")
-        run(f"python src/search_two_stage.py --query_path {query} --topk 5 --nprobe 30")
-    else:
-        print("Unknown mode")
\ No newline at end of file
+    main()
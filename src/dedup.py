@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+近重复图片去重：同一张图的重新编码、缩放版本，或同一张图库图在多个关键词下被重复抓取，
+每一张都要提取、存储，检索时还要各自匹配 + RANSAC。这里用感知哈希把它们聚成簇：
+  - 每张图在预处理时（preprocess.py，与提取同一条解码+缩放路径）计算 64 位 dHash 与 pHash，存到 features/phash.npz
+  - pHash 建 BK 树（汉明距离满足三角不等式），半径 PHASH_RADIUS 内且 dHash 距离 <= DHASH_RADIUS 的图视为近重复
+  - 贪心取代表：按名字顺序，第一张未归簇的图成为代表，把它半径内尚未归簇的图收为成员（不做传递，簇不会串成长链）
+  - 簇写到 features/dedup.json；检索时只匹配代表，结果再展开成簇内所有图片（成员沿用代表的分数）
+  - extra_features.py --dedup 只为代表提取特征，非代表图片不进入特征库
+用法：
+  python src/dedup.py build                     # 计算哈希（没有 phash.npz 时）并聚类
+  python src/dedup.py info                      # 簇的统计与最大的几个簇
+  python src/dedup.py hash a.jpg b.jpg          # 两张图的 dHash / pHash 距离
+  python src/search_bruteforce.py --query_path dataset/queries/q1.jpg --dedup
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from src.feature_store import FEAT_DIR
+from src.pipeline import MAX_SIDE, bounded_map, list_images, load_gray
+
+HASH_FILE = "phash.npz"
+CLUSTERS_FILE = "dedup.json"
+IMG_DIR = Path("dataset/images")
+PHASH_RADIUS = 10   # 64 位 pHash 的近重复半径
+DHASH_RADIUS = 12   # 再用 dHash 复核，两种哈希都接近才算重复（减少纯色/纹理图的误并）
+
+
+def dhash(gray) -> int:
+    """差值哈希：缩到 9x8，比较水平相邻像素"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _pack(small[:, 1:] > small[:, :-1])
+
+
+def phash(gray) -> int:
+    """感知哈希：缩到 32x32 做 DCT，取左上 8x8 低频系数与其中位数比较（不含直流分量）"""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return _pack(low > np.median(low.flatten()[1:]))
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """BK 树：每个节点的子节点按与该节点的汉明距离分桶，查询时用三角不等式剪枝"""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, h: int, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (h, [item], {})
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (h, [item], {})
+                return
+            node = child
+
+    def search(self, h: int, radius: int) -> List[tuple]:
+        """返回 [(距离, item)]，距离 <= radius"""
+        out, stack = [], [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                out.extend((d, it) for it in node[1])
+            for cd, child in node[2].items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+        return out
+
+
+# ---------------- 哈希文件 ----------------
+
+def image_hashes(gray):
+    return dhash(gray), phash(gray)
+
+
+def save_hashes(hashes: Dict[str, tuple], feat_dir: Path = FEAT_DIR):
+    """hashes 为 {图片id: (dhash, phash)}"""
+    np.savez(Path(feat_dir) / HASH_FILE, ids=np.array(list(hashes), dtype=str),
+             dhash=np.array([h[0] for h in hashes.values()], dtype=np.uint64),
+             phash=np.array([h[1] for h in hashes.values()], dtype=np.uint64))
+
+
+def load_hashes(feat_dir: Path = FEAT_DIR):
+    """返回 {图片id: (dhash, phash)}；没有哈希文件时返回 None"""
+    path = Path(feat_dir) / HASH_FILE
+    if not path.exists():
+        return None
+    a = np.load(path)
+    return {str(n): (int(d), int(p)) for n, d, p in zip(a["ids"], a["dhash"], a["phash"])}
+
+
+def compute_hashes(files, max_side: int = MAX_SIDE, workers: int = 2) -> Dict[str, tuple]:
+    """没有运行 preprocess.py 时直接从源图计算（同样的解码+缩放路径）"""
+    def one(p):
+        _, gray = load_gray(p, max_side)
+        return p.stem, (image_hashes(gray) if gray is not None else None)
+    return {name: h for name, h in bounded_map(one, files, workers, 4 * workers) if h is not None}
+
+
+# ---------------- 聚类 ----------------
+
+def cluster(hashes: Dict[str, tuple], phash_radius: int = PHASH_RADIUS,
+            dhash_radius: int = DHASH_RADIUS) -> Dict[str, List[str]]:
+    """贪心代表聚类，返回 {代表: [代表, 成员...]}（单张图自成一簇）"""
+    tree = BKTree()
+    for name, (_, ph) in hashes.items():
+        tree.add(ph, name)
+    clusters, assigned = {}, set()
+    for name in sorted(hashes):
+        if name in assigned:
+            continue
+        dh = hashes[name][0]
+        near = sorted(n for _, n in tree.search(hashes[name][1], phash_radius)
+                      if n not in assigned and n != name and hamming(dh, hashes[n][0]) <= dhash_radius)
+        clusters[name] = [name] + near
+        assigned.update(clusters[name])
+    return clusters
+
+
+def save_clusters(clusters: Dict[str, List[str]], feat_dir: Path = FEAT_DIR,
+                  phash_radius: int = PHASH_RADIUS, dhash_radius: int = DHASH_RADIUS):
+    data = {"params": {"phash_radius": phash_radius, "dhash_radius": dhash_radius},
+            "clusters": {rep: members for rep, members in clusters.items() if len(members) > 1}}
+    path = Path(feat_dir) / CLUSTERS_FILE
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+    return path
+
+
+class Clusters:
+    """检索时使用：决定哪些图参与匹配，并把代表的结果展开成整个簇"""
+
+    def __init__(self, clusters: Dict[str, List[str]]):
+        self.members = {rep: list(m) for rep, m in clusters.items()}
+        self.rep_of = {n: rep for rep, m in self.members.items() for n in m}
+        self.hidden = frozenset(n for n, rep in self.rep_of.items() if n != rep)
+
+    def __len__(self):
+        return len(self.members)
+
+    def skip(self, exclude=None) -> set:
+        """
+        不参与匹配的图片：所有非代表成员，加上 exclude。
+        exclude 本身是代表时（用图库图查询），由簇里的下一张图顶替它参与匹配
+        """
+        skip = set(self.hidden)
+        if exclude is not None:
+            skip.add(exclude)
+            members = self.members.get(exclude)
+            if members and len(members) > 1:
+                skip.discard(members[1])
+        return skip
+
+    def expand(self, results, topk: int, exclude=None):
+        """[(代表, 分数)] -> [(图片id, 分数)]，成员紧跟在代表之后，截断到 topk"""
+        out = []
+        for name, score in results:
+            rep = self.rep_of.get(name, name)
+            for n in self.members.get(rep, [name]):
+                if n != exclude and all(n != o for o, _ in out):
+                    out.append((n, score))
+            if len(out) >= topk:
+                break
+        return out[:topk]
+
+
+def load_clusters(feat_dir: Path = FEAT_DIR) -> Optional[Clusters]:
+    path = Path(feat_dir) / CLUSTERS_FILE
+    if not path.exists():
+        return None
+    return Clusters(json.loads(path.read_text(encoding="utf-8"))["clusters"])
+
+
+def build(src: Path = IMG_DIR, feat_dir: Path = FEAT_DIR, phash_radius: int = PHASH_RADIUS,
+          dhash_radius: int = DHASH_RADIUS, rehash: bool = False) -> Dict[str, List[str]]:
+    hashes = None if rehash else load_hashes(feat_dir)
+    files = list_images(src)
+    if hashes is None or any(p.stem not in hashes for p in files):
+        hashes = compute_hashes(files)
+        save_hashes(hashes, feat_dir)
+    names = {p.stem for p in files}
+    clusters = cluster({n: h for n, h in hashes.items() if n in names}, phash_radius, dhash_radius)
+    save_clusters(clusters, feat_dir, phash_radius, dhash_radius)
+    return clusters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=str, default=str(FEAT_DIR))
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("build", help="hash (if needed) and cluster the gallery")
+    p.add_argument("--src", type=str, default=str(IMG_DIR))
+    p.add_argument("--phash_radius", type=int, default=PHASH_RADIUS)
+    p.add_argument("--dhash_radius", type=int, default=DHASH_RADIUS)
+    p.add_argument("--rehash", action="store_true", help="recompute hashes even if phash.npz exists")
+    p = sub.add_parser("info", help="cluster statistics")
+    p.add_argument("--top", type=int, default=10)
+    p = sub.add_parser("hash", help="hash distances between two images")
+    p.add_argument("images", nargs=2)
+    args = parser.parse_args()
+    feat_dir = Path(args.features)
+
+    if args.cmd == "hash":
+        (d1, p1), (d2, p2) = [image_hashes(load_gray(Path(x))[1]) for x in args.images]
+        print(f"dhash {d1:016x} {d2:016x} distance {hamming(d1, d2)}")
+        print(f"phash {p1:016x} {p2:016x} distance {hamming(p1, p2)}")
+        return
+    if args.cmd == "build":
+        t0 = time.time()
+        clusters = build(Path(args.src), feat_dir, args.phash_radius, args.dhash_radius, args.rehash)
+        n = sum(len(m) for m in clusters.values())
+        print(f"{n} images -> {len(clusters)} representatives ({n - len(clusters)} near-duplicates, "
+              f"{sum(len(m) > 1 for m in clusters.values())} clusters) in {time.time() - t0:.2f}s")
+        return
+    dups = load_clusters(feat_dir)
+    if dups is None:
+        print(f"{feat_dir / CLUSTERS_FILE} not found; run python src/dedup.py build")
+        sys.exit(1)
+    print(f"{len(dups)} clusters with duplicates, {len(dups.hidden)} hidden images")
+    for rep, members in sorted(dups.members.items(), key=lambda x: -len(x[1]))[:args.top]:
+        print(f"{rep}: {' '.join(members[1:])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,313 @@
 #!/usr/bin/env python3
 """
-基于提供的 ground-truth CSV 评估 Precision@K。
-CSV 格式（header）：query_filename,gt_filename
+基于 ground-truth CSV 的进程内评估：图库只加载一次（进程池每个 worker 各打开一次 memmap 特征库），
+查询在进程池中并行执行，可以评估任意检索引擎与参数组合（如 nprobe、比值测试阈值的网格扫描），
+同时报告 recall@K、mAP、MRR 与 p50/p95/p99 延迟。
+CSV 格式（header 可有可无）：query_filename,gt_filename，同一查询可以有多行（多个正确答案）
 示例： dataset/queries/q1.jpg,images/0001.jpg
+查询为图片时现场解码 + 提取 ORB；为 .npz 时直接读取（features/ 下的图库特征会排除自身）。
+引擎：brute / two_stage / cascade / bow / vlad / mih / flann（bow、vlad 需先分别运行 vocab.py / global_desc.py build，
+索引从 <features>/bow、<features>/global、<features>/mih、<features>/flann 读取；mih 没有索引文件时在每个 worker
+内存中现建，flann 没有时建一次并保存，见 matchers.py）
 用法：
-  python src/evaluate.py --gt groundtruth.csv --method brute --topk 5
-注意：本脚本假设已经有 search_bruteforce.py 的输出接口，可按需修改对接。
+  python src/evaluate.py --gt groundtruth.csv --engine brute --topk 5
+  python src/evaluate.py --gt groundtruth.csv --engine two_stage bow --nprobe 10 30 50 --ratio 0.7 0.75 0.8
+  python src/evaluate.py --gt groundtruth.csv --engine two_stage --json sweep.json
+  python src/evaluate.py --gt groundtruth.csv --engine mih --nprobe 30 300 --verify homography similarity
+  python src/evaluate.py --gt groundtruth.csv --engine cascade --cascade_n 50 100 --cascade_keep 100 200
+  python src/evaluate.py --gt groundtruth.csv --engine brute flann --nprobe 30 100   # FLANN LSH 与暴力检索对比
+  python src/evaluate.py --gt groundtruth.csv --engine brute mih --dedup     # 只匹配近重复簇的代表（dedup.py）
+  python src/evaluate.py --gt groundtruth.csv --server http://127.0.0.1:8765   # 查询常驻服务
 """
 import argparse
 import csv
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-import subprocess
+
+import numpy as np
+
+from src.hamming import RATIO_TEST_THRESHOLD
+from src.ransac_validate import VERIFY_MODES
+from src.search_two_stage import CASCADE_KEEP, CASCADE_N
+from src.search_client import SearchClient
+
+FEAT_DIR = Path("features")
+ENGINES = ("brute", "two_stage", "cascade", "bow", "vlad", "mih", "flann")
+KS = (1, 5, 10)
+
 
 def load_gt(path):
-    gt = {}
+    """返回 OrderedDict: 查询路径 -> 正确答案 stem 的集合"""
+    gt = OrderedDict()
     with open(path, newline='') as f:
         r = csv.reader(f)
         for row in r:
-            if not row: continue
+            if not row or len(row) < 2:
+                continue
             q, g = row[0].strip(), row[1].strip()
-            gt[q] = g
+            if q == "query_filename":
+                continue
+            gt.setdefault(q, set()).add(Path(g).stem)
     return gt
 
-def run_search_and_get_topk(query, topk):
-    # 调用 search_bruteforce.py 并解析输出（简单方式）
-    cmd = ["python", "src/search_bruteforce.py", "--query_path", query, "--topk", str(topk)]
-    res = subprocess.run(cmd, capture_output=True, text=True)
-    out = res.stdout.splitlines()
-    top = []
-    for line in out:
-        if '\t' in line:
-            name = line.split('\t')[0].strip()
-            top.append(name)
-    return top
+
+def average_precision(ranked, relevant) -> float:
+    """AP@len(ranked)：分母取 min(相关数, 结果数)，结果列表只有 Top-K 时不惩罚 K 之外的相关项"""
+    hits, total = 0, 0.0
+    for i, name in enumerate(ranked, 1):
+        if name in relevant:
+            hits += 1
+            total += hits / i
+    denom = min(len(relevant), len(ranked))
+    return total / denom if denom else 0.0
+
+
+def rank_metrics(ranked, relevant, ks=KS) -> dict:
+    """ranked: 每个查询的结果名列表；relevant: 每个查询的正确答案集合。返回 recall@K、mAP、MRR"""
+    out = {}
+    for k in ks:
+        out[f"recall@{k}"] = float(np.mean([bool(set(r[:k]) & rel) for r, rel in zip(ranked, relevant)]))
+    out["map"] = float(np.mean([average_precision(r, rel) for r, rel in zip(ranked, relevant)]))
+    rr = []
+    for r, rel in zip(ranked, relevant):
+        first = next((i for i, name in enumerate(r, 1) if name in rel), None)
+        rr.append(1.0 / first if first else 0.0)
+    out["mrr"] = float(np.mean(rr))
+    return out
+
+
+def latency_stats(seconds) -> dict:
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    if ms.size == 0:
+        return {"p50_ms": float("nan"), "p95_ms": float("nan"), "p99_ms": float("nan"), "mean_ms": float("nan")}
+    return {"p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)), "mean_ms": float(ms.mean())}
+
+
+# ---------------- 进程池 worker ----------------
+
+_W = {}
+
+
+def _init_worker(feat_dir: str, rerank_workers: int):
+    import cv2
+    from src.feature_store import open_gallery
+    cv2.setNumThreads(1)
+    _W.clear()
+    _W["feat_dir"] = Path(feat_dir)
+    _W["gallery"] = open_gallery(Path(feat_dir))
+    _W["rerank_workers"] = rerank_workers
+
+
+def _index(name: str):
+    # bow / vlad / mih / flann 索引在第一次用到时加载，之后在该 worker 内复用
+    if name not in _W:
+        if name == "bow":
+            from src.vocab import load_bow
+            _W[name] = load_bow(_W["feat_dir"] / "bow")
+        elif name == "vlad":
+            from src.global_desc import load_global
+            _W[name] = load_global(_W["feat_dir"] / "global")
+        elif name == "mih":
+            from src.mih import load_or_build
+            _W[name] = load_or_build(_W["gallery"], _W["feat_dir"] / "mih")
+        elif name == "flann":
+            from src.matchers import load_backend
+            _W[name] = load_backend("flann", _W["gallery"], _W["feat_dir"])
+        elif name == "dedup":
+            from src.dedup import load_clusters
+            _W[name] = load_clusters(_W["feat_dir"])
+    return _W[name]
+
+
+def load_query(q: str, feat_dir=FEAT_DIR):
+    """返回 (pts, des, exclude)；图片现场提取，.npz 从文件或特征库读取（feat_dir 下的图库特征排除自身）"""
+    from src.ransac_validate import load_kps_des
+    p = Path(q)
+    if p.suffix.lower() == ".npz":
+        pts, des = load_kps_des(p)
+        return pts, des, (p.stem if p.parent.resolve() == Path(feat_dir).resolve() else None)
+    import cv2
+    from src.extra_features import ORB_PARAMS
+    from src.pipeline import load_gray, detect
+    _, gray = load_gray(p)
+    if gray is None:
+        return None, None, None
+    if "orb" not in _W:
+        _W["orb"] = cv2.ORB_create(**ORB_PARAMS)
+    pts, des = detect(gray, _W["orb"])
+    return pts, des, None
+
+
+def run_query(pts, des, exclude, cfg: dict):
+    from src import search_bruteforce, search_two_stage
+    g, w = _W["gallery"], _W["rerank_workers"]
+    engine, topk, ratio, verify = cfg["engine"], cfg["topk"], cfg["ratio"], cfg["verify"]
+    dups = _index("dedup") if cfg.get("dedup") else None
+    if engine == "brute":
+        return search_bruteforce.search(g, pts, des, topk, exclude=exclude, workers=w, ratio=ratio, verify=verify,
+                                        dups=dups)
+    if engine in ("mih", "flann"):
+        return search_bruteforce.search_mih(g, _index(engine), pts, des, topk, cfg["nprobe"], exclude=exclude,
+                                            workers=w, ratio=ratio, verify=verify, dups=dups)
+    coarse = {"two_stage": "match", "cascade": "cascade", "bow": "bow", "vlad": "vlad"}[engine]
+    budgets = {k: cfg[k] for k in ("cascade_n", "cascade_keep") if k in cfg}
+    return search_two_stage.search(g, pts, des, topk, cfg["nprobe"], coarse=coarse,
+                                   bow=_index("bow") if coarse == "bow" else None,
+                                   glob=_index("vlad") if coarse == "vlad" else None,
+                                   exclude=exclude, workers=w, ratio=ratio, verify=verify, **budgets)
+
+
+def _task(args):
+    q, configs = args
+    pts, des, exclude = load_query(q, _W["feat_dir"])
+    out = []
+    for cfg in configs:
+        if des is None:
+            # 读不到的查询算作未命中，但不计入延迟统计
+            out.append(([], None))
+            continue
+        if cfg["engine"] in ("bow", "vlad", "mih", "flann"):
+            _index(cfg["engine"])  # 首次加载/建索引不计入查询延迟
+        if cfg.get("dedup"):
+            _index("dedup")
+        t0 = time.perf_counter()
+        res = run_query(pts, des, exclude, cfg)
+        out.append(([name for name, _ in res], time.perf_counter() - t0))
+    return out
+
+
+# ---------------- 驱动 ----------------
+
+def make_configs(args):
+    configs = []
+    for engine, nprobe, ratio, verify in itertools.product(args.engine, args.nprobe, args.ratio, args.verify):
+        if engine == "brute" and nprobe != args.nprobe[0]:
+            continue  # 暴力检索不使用 nprobe
+        cfg = {"engine": engine, "nprobe": nprobe, "ratio": ratio, "verify": verify, "topk": args.topk}
+        if args.dedup and engine in ("brute", "mih", "flann"):
+            cfg["dedup"] = True
+        if engine != "cascade":
+            configs.append(cfg)
+            continue
+        for n, keep in itertools.product(args.cascade_n, args.cascade_keep):
+            configs.append(dict(cfg, cascade_n=n, cascade_keep=keep))
+    return configs
+
+
+def evaluate(gt, configs, workers: int, feat_dir=FEAT_DIR, rerank_workers: int = 1):
+    """
+    每个查询只加载/提取一次特征，在同一个 worker 里依次跑所有配置；
+    返回与 configs 对应的 [{配置 + 指标}]
+    """
+    queries = list(gt)
+    t0 = time.time()
+    tasks = [(q, configs) for q in queries]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(str(feat_dir), rerank_workers)) as ex:
+            per_query = list(ex.map(_task, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        _init_worker(str(feat_dir), rerank_workers)
+        per_query = [_task(t) for t in tasks]
+    wall = time.time() - t0
+    relevant = [gt[q] for q in queries]
+    report = []
+    for c, cfg in enumerate(configs):
+        ranked = [per_query[i][c][0] for i in range(len(queries))]
+        lat = [per_query[i][c][1] for i in range(len(queries)) if per_query[i][c][1] is not None]
+        ks = tuple(k for k in KS if k <= cfg["topk"]) or (cfg["topk"],)
+        report.append(dict(cfg, queries=len(queries), failed=len(queries) - len(lat),
+                           **rank_metrics(ranked, relevant, ks), **latency_stats(lat)))
+    return report, wall
+
+
+def server_search_topk(client: SearchClient, query, topk, mode):
+    # .npz 交给服务端按路径读取，图片则直接上传字节
+    if Path(query).suffix == ".npz":
+        res = client.search_feat(query, topk=topk, mode=mode)
+    else:
+        res = client.search_image(query, topk=topk, mode=mode)
+    return [r["name"] for r in res["results"]]
+
+
+def evaluate_server(gt, server: str, topk: int, mode: str, workers: int):
+    client = SearchClient(server)
+
+    def one(q):
+        t0 = time.perf_counter()
+        names = server_search_topk(client, q, topk, mode)
+        return [Path(n).stem for n in names], time.perf_counter() - t0
+
+    queries = list(gt)
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(one, queries))
+    wall = time.time() - t0
+    ks = tuple(k for k in KS if k <= topk) or (topk,)
+    cfg = {"engine": f"server:{mode}", "topk": topk, "queries": len(queries)}
+    return [dict(cfg, **rank_metrics([r for r, _ in results], [gt[q] for q in queries], ks),
+                 **latency_stats([t for _, t in results]))], wall
+
+
+def print_report(report, wall):
+    keys = [k for k in report[0] if k.startswith("recall@")]
+    head = f"{'engine':16s} {'nprobe':>6s} {'ratio':>5s} {'verify':>10s} " + " ".join(f"{k:>9s}" for k in keys)
+    print(head + f" {'mAP':>6s} {'MRR':>6s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}")
+    for r in report:
+        label = r["engine"] + (f":{r['cascade_n']}/{r['cascade_keep']}" if "cascade_n" in r else "")
+        label += "+dedup" if r.get("dedup") else ""
+        print(f"{label:16s} {r.get('nprobe', '-')!s:>6s} {r.get('ratio', '-')!s:>5s} {r.get('verify', '-'):>10s} "
+              + " ".join(f"{r[k]:9.3f}" for k in keys)
+              + f" {r['map']:6.3f} {r['mrr']:6.3f} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} {r['p99_ms']:8.1f}")
+    failed = report[0].get("failed", 0)
+    print(f"{report[0]['queries']} queries x {len(report)} configs in {wall:.1f}s"
+          + (f"; {failed} queries could not be loaded (counted as misses, excluded from latency)" if failed else ""))
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--gt", required=True, help="ground truth csv")
     parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--engine", nargs="+", choices=ENGINES, default=["brute"])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[30], help="coarse shortlist sizes to sweep")
+    parser.add_argument("--ratio", type=float, nargs="+", default=[RATIO_TEST_THRESHOLD],
+                        help="ratio-test thresholds to sweep")
+    parser.add_argument("--verify", nargs="+", choices=VERIFY_MODES, default=["homography"],
+                        help="geometric verification modes to sweep")
+    parser.add_argument("--cascade_n", type=int, nargs="+", default=[CASCADE_N],
+                        help="cascade tier-1 feature budgets to sweep")
+    parser.add_argument("--cascade_keep", type=int, nargs="+", default=[CASCADE_KEEP],
+                        help="cascade tier-2 image budgets to sweep")
+    parser.add_argument("--dedup", action="store_true",
+                        help="brute/mih/flann match only near-duplicate representatives (features/dedup.json)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="query processes")
+    parser.add_argument("--rerank_workers", type=int, default=1, help="RANSAC threads inside each process")
+    parser.add_argument("--features", type=str, default=str(FEAT_DIR), help="gallery feature directory")
+    parser.add_argument("--json", type=str, help="also write the report as JSON")
+    parser.add_argument("--server", type=str, help="search_server.py address, e.g. http://127.0.0.1:8765")
+    parser.add_argument("--method", choices=["brute", "two_stage"], default="brute",
+                        help="search mode when using --server")
     args = parser.parse_args()
     gt = load_gt(args.gt)
-    total = 0
-    correct_at_k = 0
-    for q, g in gt.items():
-        total += 1
-        topk = run_search_and_get_topk(q, args.topk)
-        # ground truth filename is assumed relative to dataset/images or features; compare stems
-        gt_stem = Path(g).stem
-        found = any(Path(name).stem == gt_stem for name in topk)
-        if found:
-            correct_at_k += 1
-    print(f"Precision@{args.topk}: {correct_at_k}/{total} = {correct_at_k/total:.3f}")
+    if not gt:
+        print("No queries in", args.gt)
+        return
+    if args.server:
+        report, wall = evaluate_server(gt, args.server, args.topk, args.method, args.workers)
+    else:
+        report, wall = evaluate(gt, make_configs(args), args.workers, feat_dir=Path(args.features),
+                                rerank_workers=args.rerank_workers)
+    print_report(report, wall)
+    if args.json:
+        Path(args.json).write_text(json.dumps({"gt": args.gt, "wall_s": wall, "results": report}, indent=2),
+                                   encoding="utf-8")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
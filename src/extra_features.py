@@ -1,70 +1,263 @@
 #!/usr/bin/env python3
 """
-遍历 dataset/images_pre，使用 ORB 提取 keypoints 与 descriptors，
-并把结果保存到 features/<imagename>.npz（包含 keypoints pts 列表 与 descriptors numpy 数组）
-用法：python src/extract_features.py
+遍历 dataset/images，在内存中完成 解码 -> 缩放到 MAX_SIDE -> 灰度 -> ORB（见 pipeline.py），
+不再读取 preprocess.py 写出的 dataset/images_pre（那份预处理图只用于可视化，需要时加 --save-pre），
+默认把整个图库写入合并式特征库 features/store/（见 feature_store.py），
+加 --npz 时按旧格式保存到 features/<imagename>.npz（包含 keypoints pts 列表 与 descriptors numpy 数组）
+增量提取：features/manifest.json 记录每张源图的路径、大小、mtime、内容哈希以及提取参数，
+重复运行时只处理新增/修改的图片，并删除已移除图片的特征；提取参数变化时全部重提。
+用法：
+  python src/extra_features.py                 # 增量更新 features/store/
+  python src/extra_features.py --workers 8     # 8 个进程并行提取（每个进程一个 ORB）
+  python src/extra_features.py --full          # 忽略 manifest，全部重提
+  python src/extra_features.py --save-pre      # 同时写出 dataset/images_pre 供可视化
+  python src/extra_features.py --npz           # 整个图库 -> features/*.npz
+  python src/extra_features.py --dedup         # 只提取近重复簇的代表（先运行 preprocess.py 或 dedup.py build）
+  python src/extra_features.py 图片路径 输出特征路径
 """
+import argparse
+import hashlib
+import json
+import os
+import time
 import cv2
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import sys
+from src.feature_store import KP_DIM, FeatureStoreWriter, find_store, release_store, store_dir
+from src.pipeline import MAX_SIDE, decode_gray, detect, list_images, load_gray, stream_features
 
-IMG_DIR = Path("dataset/images_pre")
+IMG_DIR = Path("dataset/images")
+PRE_DIR = Path("dataset/images_pre")
 FEAT_DIR = Path("features")
 FEAT_DIR.mkdir(parents=True, exist_ok=True)
+MANIFEST_FILE = "manifest.json"
 
-orb = cv2.ORB_create(nfeatures=800)
+# 提取参数：写入 manifest，变化后旧特征全部作废
+ORB_PARAMS = {"nfeatures": 800}
 #特征点数量
+orb = cv2.ORB_create(**ORB_PARAMS)
 
-def extract_and_save(p: Path, out_dir: Path):
-    img = cv2.imread(str(p), cv2.IMREAD_GRAYSCALE)
+def extract_gray(img, detector=None):
+    """对灰度图提取 ORB，返回 pts (N,2) float32 与 des (N,32) uint8"""
+    return detect(img, detector or orb)
+
+def extract_image(p: Path, max_side: int = MAX_SIDE):
+    """读图、缩放、灰度化并提取 ORB，返回 pts (N,2) float32 与 des (N,32) uint8；读图失败返回 None"""
+    _, img = load_gray(p, max_side)
     if img is None:
         print("WARN: cannot read", p)
+        return None
+    return extract_gray(img)
+
+def extract_and_save(p: Path, out_dir: Path, max_side: int = MAX_SIDE):
+    feats = extract_image(p, max_side)
+    if feats is None:
         return
-    kp, des = orb.detectAndCompute(img, None)
-    if des is None:
-        des = np.empty((0, 32), dtype=np.uint8)
-    des = des.astype(np.uint8)
-    pts = np.array([kp_i.pt for kp_i in kp], dtype=np.float32) if kp else np.empty((0,2), dtype=np.float32)
+    pts, des = feats
     # 保存 pts (N,2) 和 des (N, descriptor_size)
     out_path = out_dir / (p.stem + ".npz")
     np.savez_compressed(str(out_path), pts=pts, des=des)
-    return len(kp) if kp else 0
+    return len(des)
+
+# ---------- 并行提取：每个工作进程一个 ORB ----------
+_worker_orb = None
+_worker_max_side = MAX_SIDE
+_worker_save_dir = None
+
+def _init_worker(params, max_side=MAX_SIDE, save_dir=None):
+    global _worker_orb, _worker_max_side, _worker_save_dir
+    cv2.setNumThreads(1)  # 进程级并行，避免 OpenCV 内部线程再抢核
+    _worker_orb = cv2.ORB_create(**params)
+    _worker_max_side = max_side
+    _worker_save_dir = save_dir
+
+def _extract_worker(p: Path):
+    """工作进程：读一次文件，既算内容哈希又在内存中解码缩放提取，返回 (sha1, pts, des)"""
+    data = p.read_bytes()
+    sha1 = hashlib.sha1(data).hexdigest()
+    img = decode_gray(data, _worker_max_side)
+    if img is None:
+        return sha1, None, None
+    if _worker_save_dir is not None:
+        cv2.imwrite(str(Path(_worker_save_dir) / p.name), img)
+    pts, des = extract_gray(img, _worker_orb)
+    return sha1, pts, des
+
+def _extract_stream(paths, max_side, prefetch, save_dir):
+    # 主进程内：读文件与解码+ORB 在两级有界队列中流水
+    for _, sha1, pts, des in stream_features(paths, ORB_PARAMS, max_side=max_side,
+                                             prefetch=prefetch, save_dir=save_dir):
+        yield sha1, pts, des
+
+def file_sha1(p: Path) -> str:
+    return hashlib.sha1(p.read_bytes()).hexdigest()
+
+def load_manifest(feat_dir: Path = FEAT_DIR) -> dict:
+    path = Path(feat_dir) / MANIFEST_FILE
+    if not path.exists():
+        return {"params": None, "images": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest: dict, feat_dir: Path = FEAT_DIR):
+    path = Path(feat_dir) / MANIFEST_FILE
+    tmp = path.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+def plan_incremental(files, manifest: dict, store, params: dict, full: bool = False):
+    """
+    对比 manifest 与当前文件，返回 (dirty, records)：
+      dirty   需要重新提取的图片集合
+      records 未变化图片的 manifest 记录（mtime 变化但内容哈希相同的会刷新 mtime）；
+              上次读不出的图片（failed）文件没变就留在 records 里，不再重试
+    """
+    same_params = manifest.get("params") == params and not full
+    old = manifest.get("images", {}) if same_params else {}
+    dirty, records = set(), {}
+    for p in files:
+        st = p.stat()
+        rec = old.get(p.stem)
+        if (rec is None or store is None or not (rec.get("failed") or p.stem in store) or rec["path"] != str(p)
+                or rec["size"] != st.st_size):
+            dirty.add(p)
+        elif rec["mtime"] == st.st_mtime:
+            records[p.stem] = rec
+        elif rec["sha1"] == file_sha1(p):
+            records[p.stem] = dict(rec, mtime=st.st_mtime)
+        else:
+            dirty.add(p)
+    return dirty, records
+
+def extract_params(max_side: int = MAX_SIDE) -> dict:
+    # kp_dim 或特征顺序变化（如补存尺度/方向、按 response 排序）同样需要全部重提
+    return dict(ORB_PARAMS, max_side=max_side, kp_dim=KP_DIM, kp_order="response")
+
+def extract_to_store(files, root: Path, workers: int = 1, chunksize: int = 16, full: bool = False,
+                     max_side: int = MAX_SIDE, prefetch: int = 8, save_dir: Path = None):
+    """
+    增量更新合并式特征库，返回 (每张图的关键点数, 新提取数, 删除数, 读取失败数)
+    未变化的图片直接从旧库拷贝描述子，只有 dirty 图片进入进程池提取；
+    读不出的图片记入 manifest（failed），文件变化前不再重试
+    """
+    feat_dir = root.parent
+    manifest = load_manifest(feat_dir)
+    store = find_store(feat_dir)
+    params = extract_params(max_side)
+    dirty, records = plan_incremental(files, manifest, store, params, full=full)
+    names = {p.stem for p in files}
+    removed = [n for n in (store.ids if store is not None else []) if n not in names]
+    if not dirty and not removed and store is not None and len(records) == len(files):
+        return [int(c) for c in store.counts], 0, 0, 0
+
+    todo = [p for p in files if p in dirty]
+    if workers > 1 and len(todo) > 1:
+        ex = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(ORB_PARAMS, max_side, save_dir))
+        results = ex.map(_extract_worker, todo, chunksize=chunksize)
+    else:
+        ex = None
+        results = _extract_stream(todo, max_side, prefetch, save_dir)
+
+    stats = []
+    images = {}
+    n_failed = 0
+    try:
+        with FeatureStoreWriter(root) as w:
+            # 按文件顺序归并：未变化的从旧库拷贝，变化的按序取提取结果（map 保序）
+            for p in files:
+                if p in dirty:
+                    sha1, pts, des = next(results)
+                    st = p.stat()
+                    images[p.stem] = {"path": str(p), "size": st.st_size, "mtime": st.st_mtime, "sha1": sha1}
+                    if des is None:
+                        print("WARN: cannot read", p)
+                        images[p.stem]["failed"] = True
+                        n_failed += 1
+                        continue
+                elif records[p.stem].get("failed"):
+                    images[p.stem] = records[p.stem]
+                    continue
+                else:
+                    pts, des = store.get_by_name(p.stem)
+                    images[p.stem] = records[p.stem]
+                w.add(p.stem, pts, des)
+                stats.append(len(des))
+            # 释放旧库的 memmap 再替换目录（Windows 下映射中的文件无法删除）
+            release_store(feat_dir)
+            store = None
+    finally:
+        if ex is not None:
+            ex.shutdown()
+    save_manifest({"params": params, "images": images}, feat_dir)
+    return stats, len(todo) - n_failed, len(removed), n_failed
 
 # 新增：单张图片提取函数
 def extract_single_image(img_path: str, out_feat_path: str):
     img_p = Path(img_path)
     out_p = Path(out_feat_path)
     # 调用原有提取逻辑，输出到指定路径（而非固定FEAT_DIR）
-    img = cv2.imread(str(img_p), cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        print("WARN: cannot read", img_p)
+    feats = extract_image(img_p)
+    if feats is None:
         return
-    kp, des = orb.detectAndCompute(img, None)
-    if des is None:
-        des = np.empty((0, 32), dtype=np.uint8)
-    des = des.astype(np.uint8)
-    pts = np.array([kp_i.pt for kp_i in kp], dtype=np.float32) if kp else np.empty((0,2), dtype=np.float32)
+    pts, des = feats
     np.savez_compressed(str(out_p), pts=pts, des=des)
-    print(f"Extracted features for {img_p} → {out_p} (keypoints: {len(kp) if kp else 0})")
+    print(f"Extracted features for {img_p} → {out_p} (keypoints: {len(des)})")
 
 
 def main():
-    if len(sys.argv) == 3:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("img_path", nargs="?", help="单张图片路径（与 out_feat_path 一起使用）")
+    parser.add_argument("out_feat_path", nargs="?", help="单张图片的输出 .npz 路径")
+    parser.add_argument("--npz", action="store_true", help="按旧格式每张图保存一个 features/<stem>.npz")
+    parser.add_argument("--workers", type=int, default=1, help="提取进程数（0 = CPU 核数）")
+    parser.add_argument("--chunksize", type=int, default=16, help="每次分发给工作进程的图片数")
+    parser.add_argument("--full", action="store_true", help="忽略 manifest，全部重新提取")
+    parser.add_argument("--src", type=str, default=str(IMG_DIR), help="源图目录")
+    parser.add_argument("--max_side", type=int, default=MAX_SIDE, help="缩放后的最长边（0 = 不缩放）")
+    parser.add_argument("--prefetch", type=int, default=8, help="流式提取时每级队列的在途图片数")
+    parser.add_argument("--dedup", action="store_true",
+                        help="skip near-duplicates listed in features/dedup.json (only representatives are stored)")
+    parser.add_argument("--save-pre", dest="save_pre", action="store_true",
+                        help=f"同时把缩放后的灰度图写到 {PRE_DIR}（仅用于可视化）")
+    args = parser.parse_args()
+
+    if args.img_path and args.out_feat_path:
         # 命令行格式：python extra_features.py 图片路径 输出特征路径
-        img_path = sys.argv[1]
-        out_feat_path = sys.argv[2]
-        extract_single_image(img_path, out_feat_path)
+        extract_single_image(args.img_path, args.out_feat_path)
     else:
-        files = sorted([p for p in IMG_DIR.iterdir() if p.suffix.lower() in (".jpg",".png",".jpeg")])
+        files = list_images(args.src)
         if not files:
-            print("No preprocessed images found in", IMG_DIR)
+            print("No images found in", args.src)
             return
-        stats = []
-        for p in files:
-            n = extract_and_save(p, FEAT_DIR)
-            stats.append(n)
-        print(f"Extracted features for {len(files)} images. avg keypoints:", (sum(stats)/len(stats)) if stats else 0)
+        if args.dedup:
+            from src.dedup import CLUSTERS_FILE, load_clusters
+            dups = load_clusters(FEAT_DIR)
+            if dups is None:
+                print(f"{FEAT_DIR / CLUSTERS_FILE} not found; run src/preprocess.py or src/dedup.py build")
+                return
+            n = len(files)
+            files = [p for p in files if p.stem not in dups.hidden]
+            print(f"dedup: {n - len(files)} near-duplicates skipped")
+        save_dir = None
+        if args.save_pre:
+            save_dir = PRE_DIR
+            save_dir.mkdir(parents=True, exist_ok=True)
+        t0 = time.time()
+        if args.npz:
+            stats = [n for n in (extract_and_save(p, FEAT_DIR, args.max_side) for p in files) if n is not None]
+        else:
+            workers = args.workers or os.cpu_count() or 1
+            stats, n_new, n_removed, n_failed = extract_to_store(files, store_dir(FEAT_DIR), workers=workers,
+                                                                 chunksize=args.chunksize, full=args.full,
+                                                                 max_side=args.max_side, prefetch=args.prefetch,
+                                                                 save_dir=save_dir)
+            print(f"Feature store -> {store_dir(FEAT_DIR)}: extracted {n_new}, removed {n_removed}, "
+                  f"unchanged {len(stats) - n_new}, unreadable {n_failed}")
+        print(f"Extracted features for {len(files)} images in {time.time() - t0:.2f}s. avg keypoints:",
+              (sum(stats)/len(stats)) if stats else 0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
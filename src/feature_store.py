@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+合并式特征库：把整个图库的特征存成少量连续文件，用 np.memmap 打开，
+替代 features/ 下“每张图一个 .npz”的存储方式。
+目录结构（默认 features/store/）：
+  descriptors.u8   # 所有图片描述子首尾相接，uint8，形状 (总特征数, 32)
+  keypoints.f32    # 对应的关键点，float32，形状 (总特征数, kp_dim)，列为 KP_FIELDS（旧库只有 x, y）
+  index.npz        # 每张图的 ids / offsets / counts 以及维度信息（不压缩）
+打开时只读取 index.npz，描述子与关键点按页懒加载，多个进程共享同一份页缓存。
+用法：
+  python src/feature_store.py features/store            # 查看特征库概况
+"""
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+FEAT_DIR = Path("features")
+STORE_DIRNAME = "store"
+DES_FILE = "descriptors.u8"
+KPS_FILE = "keypoints.f32"
+INDEX_FILE = "index.npz"
+DES_DIM = 32  # ORB 描述子 32 字节
+KP_FIELDS = ("x", "y", "size", "angle", "octave", "response")  # 与 cv2.KeyPoint 的属性对应
+KP_DIM = len(KP_FIELDS)
+
+
+class Features:
+    """
+    一张图的特征：pts (N, kp_dim) float32 与 des (N, 32) uint8 两个数组，不为每个点建 Python 对象。
+    关键点属性按列取视图（旧格式没有的列为 None）；cv2.KeyPoint 只在 keypoints() 被调用时生成（可视化用）。
+    可以直接解包：pts, des = feats
+    """
+
+    __slots__ = ("pts", "des")
+
+    def __init__(self, pts: np.ndarray, des: np.ndarray):
+        self.pts = pts
+        self.des = des
+
+    def __len__(self):
+        return len(self.des)
+
+    def __iter__(self):
+        return iter((self.pts, self.des))
+
+    def _column(self, i: int) -> Optional[np.ndarray]:
+        return self.pts[:, i] if self.pts.ndim == 2 and self.pts.shape[1] > i else None
+
+    @property
+    def xy(self) -> np.ndarray:
+        return self.pts[:, :2]
+
+    @property
+    def size(self) -> Optional[np.ndarray]:
+        return self._column(2)
+
+    @property
+    def angle(self) -> Optional[np.ndarray]:
+        return self._column(3)
+
+    @property
+    def octave(self) -> Optional[np.ndarray]:
+        return self._column(4)
+
+    @property
+    def response(self) -> Optional[np.ndarray]:
+        return self._column(5)
+
+    def keypoints(self, idx=None) -> list:
+        """生成 cv2.KeyPoint 列表；idx 只取其中一部分（如匹配上的点）"""
+        from src.match import to_keypoints
+        return to_keypoints(self.pts if idx is None else self.pts[np.asarray(idx, dtype=np.int64)])
+
+
+class FeatureStore:
+    """
+    只读特征库：第 i 张图的特征为 des[offsets[i]:offsets[i]+counts[i]]
+    get() 返回的是 memmap 上的切片视图，不发生拷贝
+    """
+
+    def __init__(self, ids, offsets, counts, pts, des, root=None):
+        self.ids = [str(x) for x in ids]
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.pts = pts
+        self.des = des
+        self.root = Path(root) if root is not None else None
+        self._pos = {name: i for i, name in enumerate(self.ids)}
+
+    @classmethod
+    def open(cls, root: Union[str, Path]) -> "FeatureStore":
+        root = Path(root)
+        idx = np.load(root / INDEX_FILE)
+        ids = idx["ids"]
+        offsets = idx["offsets"]
+        counts = idx["counts"]
+        des_dim = int(idx["des_dim"])
+        kp_dim = int(idx["kp_dim"])
+        total = int(counts.sum()) if len(counts) else 0
+        if total == 0:
+            # 空文件无法 mmap，直接给空数组
+            pts = np.empty((0, kp_dim), dtype=np.float32)
+            des = np.empty((0, des_dim), dtype=np.uint8)
+        else:
+            pts = np.memmap(root / KPS_FILE, dtype=np.float32, mode="r", shape=(total, kp_dim))
+            des = np.memmap(root / DES_FILE, dtype=np.uint8, mode="r", shape=(total, des_dim))
+        return cls(ids, offsets, counts, pts, des, root=root)
+
+    @classmethod
+    def from_npz_dir(cls, feat_dir: Union[str, Path]) -> "FeatureStore":
+        """兼容旧格式：把 features/*.npz 读进内存，组装成同样接口的特征库"""
+        ids, all_pts, all_des, counts = [], [], [], []
+        for f in sorted(Path(feat_dir).glob("*.npz")):
+            a = np.load(f, allow_pickle=True)
+            pts = a.get("pts")
+            des = a.get("des")
+            if pts is None:
+                pts = np.empty((0, KP_DIM), dtype=np.float32)
+            if des is None:
+                des = np.empty((0, DES_DIM), dtype=np.uint8)
+            pts = np.asarray(pts, dtype=np.float32)
+            ids.append(f.stem)
+            all_pts.append(pts.reshape(-1, pts.shape[1] if pts.ndim == 2 else KP_DIM))
+            all_des.append(np.asarray(des, dtype=np.uint8).reshape(len(des), DES_DIM))
+            counts.append(len(des))
+        counts = np.asarray(counts, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64) if len(counts) else counts
+        pts = np.concatenate(all_pts) if all_pts else np.empty((0, KP_DIM), dtype=np.float32)
+        des = np.concatenate(all_des) if all_des else np.empty((0, DES_DIM), dtype=np.uint8)
+        return cls(ids, offsets, counts, pts, des)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, name):
+        return name in self._pos
+
+    def index_of(self, name: str) -> int:
+        return self._pos[name]
+
+    def get(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        a = int(self.offsets[i])
+        b = a + int(self.counts[i])
+        return self.pts[a:b], self.des[a:b]
+
+    def get_by_name(self, name: str) -> Tuple[np.ndarray, np.ndarray]:
+        return self.get(self._pos[name])
+
+    def features(self, i: int) -> Features:
+        return Features(*self.get(i))
+
+
+class FeatureStoreWriter:
+    """
+    顺序写入特征库：先写到 <root>.tmp，close() 时写 index 并整体替换旧库，
+    写入过程中读者看到的始终是完整的旧库
+    """
+
+    def __init__(self, root: Union[str, Path], des_dim: int = DES_DIM, kp_dim: int = KP_DIM):
+        self.root = Path(root)
+        self.tmp = self.root.with_name(self.root.name + ".tmp")
+        if self.tmp.exists():
+            shutil.rmtree(self.tmp)
+        self.tmp.mkdir(parents=True)
+        self.des_dim = des_dim
+        self.kp_dim = kp_dim
+        self.ids: List[str] = []
+        self.counts: List[int] = []
+        self._des_f = open(self.tmp / DES_FILE, "wb")
+        self._kps_f = open(self.tmp / KPS_FILE, "wb")
+
+    def add(self, name: str, pts: np.ndarray, des: np.ndarray):
+        des = np.ascontiguousarray(des, dtype=np.uint8).reshape(-1, self.des_dim)
+        pts = np.asarray(pts, dtype=np.float32)
+        if pts.ndim == 2 and pts.shape[1] < self.kp_dim:
+            # 旧格式只有 (x, y)：缺少的尺度/方向等列补 NaN，相似变换验证会跳过这些点
+            pts = np.hstack([pts, np.full((len(pts), self.kp_dim - pts.shape[1]), np.nan, dtype=np.float32)])
+        pts = np.ascontiguousarray(pts).reshape(-1, self.kp_dim)
+        if len(pts) != len(des):
+            raise ValueError(f"{name}: pts/des 数量不一致 ({len(pts)} vs {len(des)})")
+        self._des_f.write(des.tobytes())
+        self._kps_f.write(pts.tobytes())
+        self.ids.append(name)
+        self.counts.append(len(des))
+
+    def close(self) -> Path:
+        self._des_f.close()
+        self._kps_f.close()
+        counts = np.asarray(self.counts, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64) if len(counts) else counts
+        np.savez(self.tmp / INDEX_FILE, ids=np.array(self.ids, dtype=str), offsets=offsets,
+                 counts=counts, des_dim=self.des_dim, kp_dim=self.kp_dim)
+        if self.root.exists():
+            shutil.rmtree(self.root)
+        os.replace(self.tmp, self.root)
+        _OPENED.pop(str(self.root.resolve()), None)
+        return self.root
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # 出错时丢弃半成品，保留旧库
+            self._des_f.close()
+            self._kps_f.close()
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+# 进程内缓存：同一个特征库只打开一次（按 index 文件修改时间失效）
+_OPENED: Dict[str, Tuple[float, FeatureStore]] = {}
+
+
+def store_dir(feat_dir: Union[str, Path] = FEAT_DIR) -> Path:
+    return Path(feat_dir) / STORE_DIRNAME
+
+
+def find_store(feat_dir: Union[str, Path] = FEAT_DIR) -> Optional[FeatureStore]:
+    """返回 feat_dir 下的特征库（不存在则 None）"""
+    root = store_dir(feat_dir)
+    index = root / INDEX_FILE
+    if not index.exists():
+        return None
+    key = str(root.resolve())
+    mtime = index.stat().st_mtime
+    hit = _OPENED.get(key)
+    if hit is not None and hit[0] == mtime:
+        return hit[1]
+    store = FeatureStore.open(root)
+    _OPENED[key] = (mtime, store)
+    return store
+
+
+def release_store(feat_dir: Union[str, Path] = FEAT_DIR):
+    """丢弃进程内缓存的特征库（释放 memmap），重写特征库前调用"""
+    _OPENED.pop(str(store_dir(feat_dir).resolve()), None)
+
+
+def open_gallery(feat_dir: Union[str, Path] = FEAT_DIR) -> FeatureStore:
+    """优先使用合并式特征库，没有时回退到逐个读取 *.npz"""
+    store = find_store(feat_dir)
+    if store is not None:
+        return store
+    return FeatureStore.from_npz_dir(feat_dir)
+
+
+def load_from_store(npz_path: Union[str, Path]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    把 features/<stem>.npz 形式的路径解析到同目录特征库中的条目，
+    找不到时返回 None，由调用方回退到读 npz 文件
+    """
+    p = Path(npz_path)
+    store = find_store(p.parent)
+    if store is None or p.stem not in store:
+        return None
+    return store.get_by_name(p.stem)
+
+
+def list_features(feat_dir: Union[str, Path] = FEAT_DIR) -> List[Path]:
+    """列出图库中所有特征的（逻辑）路径 features/<id>.npz，供检索脚本遍历"""
+    feat_dir = Path(feat_dir)
+    store = find_store(feat_dir)
+    if store is None:
+        return sorted(feat_dir.glob("*.npz"))
+    return sorted(feat_dir / (name + ".npz") for name in store.ids)
+
+
+if __name__ == "__main__":
+    root = Path(sys.argv[1]) if len(sys.argv) > 1 else store_dir()
+    s = FeatureStore.open(root)
+    print(f"{root}: {len(s)} images, {len(s.des)} descriptors, "
+          f"des {s.des.shape[1]}B, kp_dim {s.pts.shape[1]}")
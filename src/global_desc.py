@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+全局描述子：每张图片聚合成一个定长向量，快速阶段变成一次矩阵-向量乘（批量查询为一次 GEMM）。
+  - 码本：在 ORB 描述子上做 k-majority 聚类（vocab.k_majority），描述子按汉明距离分配到最近中心
+  - 二值 VLAD：把描述子展开成 256 维 0/1 向量，累加与所属簇均值的残差 -> k*256 维
+    （signed sqrt + 簇内 L2 归一化 + 整体 L2 归一化）
+  - PCA 白化降到 dim 维（默认 256）后再 L2 归一化，图库存成一个连续的 float32 矩阵
+输出（默认 features/global/）：
+  model.npz     # 码本（二值中心 + 浮点均值）与 PCA（均值、投影矩阵）
+  vectors.npy   # (N, dim) float32，行顺序与 ids 对应
+  ids.npy
+用法：
+  python src/global_desc.py build --k 64 --dim 256     # 训练码本与 PCA，编码整个图库
+  python src/global_desc.py eval --nprobe 30           # 与 BoW 快速阶段对比召回与耗时
+  python src/search_two_stage.py --query_path dataset/queries/q1.jpg --coarse vlad
+"""
+import argparse
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from src.feature_store import FEAT_DIR, open_gallery
+from src.hamming import hamming_matrix
+from src import tracing
+from src.vocab import k_majority
+
+GLOBAL_DIR = FEAT_DIR / "global"
+MODEL_FILE = "model.npz"
+VECTORS_FILE = "vectors.npy"
+IDS_FILE = "ids.npy"
+
+
+def _l2(x: np.ndarray, axis=-1) -> np.ndarray:
+    return x / np.maximum(np.linalg.norm(x, axis=axis, keepdims=True), 1e-12)
+
+
+class VLADModel:
+    """二值 VLAD 码本 + PCA 白化"""
+
+    def __init__(self, centers, means, pca_mean, pca_proj):
+        self.centers = np.asarray(centers, dtype=np.uint8)     # (k,32) 用于分配
+        self.means = np.asarray(means, dtype=np.float32)       # (k,256) 每簇每一位的均值
+        self.pca_mean = np.asarray(pca_mean, dtype=np.float32)  # (k*256,)
+        self.pca_proj = np.asarray(pca_proj, dtype=np.float32)  # (k*256, dim)，已包含白化
+
+    @property
+    def dim(self) -> int:
+        return self.pca_proj.shape[1]
+
+    @staticmethod
+    def train_codebook(des: np.ndarray, k: int = 64, iters: int = 10, seed: int = 0):
+        centers, labels = k_majority(des, k, iters=iters, seed=seed)
+        bits = np.unpackbits(des, axis=1).astype(np.float32)
+        counts = np.bincount(labels, minlength=k).astype(np.float32)
+        sums = np.zeros((k, bits.shape[1]), dtype=np.float32)
+        np.add.at(sums, labels, bits)
+        means = sums / np.maximum(counts, 1)[:, None]
+        return centers, means
+
+    def vlad(self, des: np.ndarray) -> np.ndarray:
+        """单张图片的原始 VLAD（k*256 维，已归一化，未降维）"""
+        k, nb = self.means.shape
+        v = np.zeros((k, nb), dtype=np.float32)
+        if des is not None and len(des):
+            labels = hamming_matrix(des, self.centers).argmin(axis=1)
+            bits = np.unpackbits(np.ascontiguousarray(des, dtype=np.uint8), axis=1).astype(np.float32)
+            np.add.at(v, labels, bits)
+            v -= np.bincount(labels, minlength=k).astype(np.float32)[:, None] * self.means
+            v = np.sign(v) * np.sqrt(np.abs(v))
+            v = _l2(v, axis=1)
+        return _l2(v.ravel())
+
+    def project(self, vlads: np.ndarray) -> np.ndarray:
+        """(n, k*256) -> (n, dim) float32，PCA 白化后 L2 归一化"""
+        return _l2((np.atleast_2d(vlads) - self.pca_mean) @ self.pca_proj).astype(np.float32)
+
+    def encode(self, des: np.ndarray) -> np.ndarray:
+        with tracing.span("vlad_encode"):
+            return self.project(self.vlad(des))[0]
+
+    @staticmethod
+    def fit_pca(vlads: np.ndarray, dim: int):
+        """
+        在 (n, D) 样本上求 PCA 白化投影；dim 不超过样本数的一半
+        n < D（k*256 维，通常如此）时对 n×n 的 Gram 矩阵做特征分解，不展开 D×D 协方差或完整 SVD
+        """
+        mean = vlads.mean(axis=0)
+        x = vlads - mean
+        w, u = np.linalg.eigh(x @ x.T)
+        order = np.argsort(w)[::-1]
+        w, u = np.maximum(w[order], 0), u[:, order]
+        # 维数接近样本数时白化会把训练图片两两压成近似正交（相似度全部约为 -1/(n-1)），排序失去意义
+        dim = min(dim, int((w > 1e-9).sum()), max(1, len(vlads) // 2))
+        s = np.sqrt(w[:dim])
+        vt = (u[:, :dim].T @ x) / s[:, None]          # 主成分方向 (dim, D)
+        eig = w[:dim] / max(len(vlads) - 1, 1)
+        proj = vt.T / np.sqrt(eig + 1e-9)
+        return mean, proj
+
+    def save(self, path: Path):
+        np.savez(path, centers=self.centers, means=self.means, pca_mean=self.pca_mean, pca_proj=self.pca_proj)
+
+    @classmethod
+    def load(cls, path: Path) -> "VLADModel":
+        a = np.load(path)
+        return cls(a["centers"], a["means"], a["pca_mean"], a["pca_proj"])
+
+
+class GlobalIndex:
+    """图库全局向量：一个连续的 (N, dim) float32 矩阵，余弦相似度即内积"""
+
+    def __init__(self, ids, vectors):
+        self.ids = [str(x) for x in ids]
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self._pos = {name: i for i, name in enumerate(self.ids)}
+
+    def scores(self, q: np.ndarray) -> np.ndarray:
+        """q 为 (dim,) 时返回 (N,)；q 为 (m, dim) 时一次 GEMM 返回 (m, N)"""
+        return q @ self.vectors.T
+
+    def _top(self, s: np.ndarray, nprobe: int, exclude: str = None) -> List[Tuple[str, float]]:
+        if exclude in self._pos:
+            s = s.copy()
+            s[self._pos[exclude]] = -np.inf
+        n = min(nprobe, len(s))
+        if n <= 0:
+            return []
+        top = np.argpartition(-s, n - 1)[:n]
+        top = top[np.argsort(-s[top], kind="stable")]
+        return [(self.ids[i], float(s[i])) for i in top if np.isfinite(s[i])]
+
+    def query(self, q: np.ndarray, nprobe: int, exclude: str = None) -> List[Tuple[str, float]]:
+        with tracing.span("vlad_rank"):
+            return self._top(self.scores(q), nprobe, exclude)
+
+    def query_batch(self, qs: np.ndarray, nprobe: int, excludes=None) -> List[List[Tuple[str, float]]]:
+        with tracing.span("vlad_rank"):
+            s = self.scores(np.atleast_2d(qs))
+            excludes = excludes or [None] * len(s)
+            return [self._top(row, nprobe, ex) for row, ex in zip(s, excludes)]
+
+    def save(self, out: Path):
+        np.save(out / VECTORS_FILE, self.vectors)
+        np.save(out / IDS_FILE, np.array(self.ids, dtype=str))
+
+    @classmethod
+    def load(cls, out: Path, mmap: bool = False) -> "GlobalIndex":
+        return cls(np.load(out / IDS_FILE), np.load(out / VECTORS_FILE, mmap_mode="r" if mmap else None))
+
+
+def load_global(global_dir: Path = GLOBAL_DIR) -> Tuple[VLADModel, GlobalIndex]:
+    global_dir = Path(global_dir)
+    return VLADModel.load(global_dir / MODEL_FILE), GlobalIndex.load(global_dir)
+
+
+def train_global(gallery, k: int = 64, dim: int = 256, iters: int = 10, sample: int = 200000,
+                 train_images: int = 4096, batch: int = 1024, seed: int = 0) -> Tuple[VLADModel, GlobalIndex]:
+    """训练码本与 PCA（PCA 只在至多 train_images 张图片的 VLAD 上训练），再分批编码整个图库"""
+    rng = np.random.default_rng(seed)
+    des = np.asarray(gallery.des)
+    sample = des[rng.choice(len(des), size=min(sample, len(des)), replace=False)]
+    centers, means = VLADModel.train_codebook(sample, k=k, iters=iters)
+    model = VLADModel(centers, means, np.zeros(centers.shape[0] * 256, np.float32), np.zeros((0, 0), np.float32))
+    train_idx = rng.choice(len(gallery), size=min(train_images, len(gallery)), replace=False)
+    model.pca_mean, model.pca_proj = VLADModel.fit_pca(
+        np.stack([model.vlad(gallery.get(i)[1]) for i in train_idx]), dim)
+    vectors = np.empty((len(gallery), model.dim), dtype=np.float32)
+    for a in range(0, len(gallery), batch):
+        b = min(a + batch, len(gallery))
+        vectors[a:b] = model.project(np.stack([model.vlad(gallery.get(i)[1]) for i in range(a, b)]))
+    return model, GlobalIndex(gallery.ids, vectors)
+
+
+def build(args):
+    gallery = open_gallery(FEAT_DIR)
+    if len(gallery) == 0:
+        print("No features found in", FEAT_DIR)
+        return
+    t0 = time.time()
+    model, index = train_global(gallery, k=args.k, dim=args.dim, iters=args.iters, sample=args.sample,
+                                train_images=args.train_images, batch=args.batch)
+    dt = time.time() - t0
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    model.save(out / MODEL_FILE)
+    index.save(out)
+    print(f"Codebook k={args.k}, PCA {model.pca_proj.shape[0]} -> {model.dim} dims; "
+          f"encoded {len(gallery)} images ({index.vectors.nbytes / 2**20:.2f} MiB) in {dt:.2f}s -> {out}")
+
+
+def evaluate(args):
+    # 与 vocab.py eval 相同的合成查询（图库图片随机旋转/缩放），对比 VLAD 与 BoW 的召回和耗时
+    from src.vocab import BOW_DIR, INDEX_FILE, load_bow, warped_query
+    gallery = open_gallery(FEAT_DIR)
+    model, index = load_global(Path(args.out))
+    bow = load_bow(BOW_DIR) if (BOW_DIR / INDEX_FILE).exists() else None
+    rng = np.random.default_rng(0)
+    queries = rng.choice(len(gallery), size=min(args.queries, len(gallery)), replace=False)
+    names, descs = [], []
+    for qi in queries:
+        des_q = warped_query(Path(args.images) / (gallery.ids[qi] + ".jpg"), rng)
+        if des_q is not None and len(des_q):
+            names.append(gallery.ids[qi])
+            descs.append(des_q)
+    if not names:
+        print("No readable query images in", args.images)
+        return
+    t_enc, t_rank, hit, t_bow, hit_bow = [], [], [], [], []
+    for name, des_q in zip(names, descs):
+        t0 = time.time()
+        q = model.encode(des_q)
+        t1 = time.time()
+        top = [n for n, _ in index.query(q, args.nprobe)]
+        t_rank.append(time.time() - t1)
+        t_enc.append(t1 - t0)
+        hit.append(name in top)
+        if bow is not None:
+            t0 = time.time()
+            bow_top = [n for n, _ in bow[1].query(bow[0], des_q, args.nprobe)]
+            t_bow.append(time.time() - t0)
+            hit_bow.append(name in bow_top)
+    qs = np.stack([model.encode(d) for d in descs])
+    t0 = time.time()
+    index.query_batch(qs, args.nprobe)
+    t_batch = time.time() - t0
+    print(f"queries={len(names)} nprobe={args.nprobe} dim={model.dim} gallery={len(index.ids)}")
+    print(f"VLAD coarse : encode {np.mean(t_enc) * 1000:.2f} ms, rank {np.mean(t_rank) * 1000:.3f} ms/query, "
+          f"batch rank {t_batch * 1000 / len(names):.3f} ms/query, recall@{args.nprobe} {np.mean(hit):.3f}")
+    if t_bow:
+        print(f"BoW coarse  : mean {np.mean(t_bow) * 1000:.2f} ms/query, recall@{args.nprobe} {np.mean(hit_bow):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="train codebook + PCA and encode the gallery")
+    b.add_argument("--k", type=int, default=64, help="codebook size")
+    b.add_argument("--dim", type=int, default=256, help="dimensions after PCA whitening")
+    b.add_argument("--iters", type=int, default=10)
+    b.add_argument("--sample", type=int, default=200000, help="descriptors sampled for the codebook")
+    b.add_argument("--train_images", type=int, default=4096, help="images used to fit PCA")
+    b.add_argument("--batch", type=int, default=1024, help="images projected per batch")
+    b.add_argument("--out", type=str, default=str(GLOBAL_DIR))
+    e = sub.add_parser("eval", help="recall and latency of the VLAD coarse stage")
+    e.add_argument("--nprobe", type=int, default=30)
+    e.add_argument("--queries", type=int, default=30)
+    e.add_argument("--images", type=str, default="dataset/images", help="images used to synthesize queries")
+    e.add_argument("--out", type=str, default=str(GLOBAL_DIR))
+    args = parser.parse_args()
+    if args.cmd == "build":
+        build(args)
+    else:
+        evaluate(args)
+
+
+if __name__ == "__main__":
+    main()
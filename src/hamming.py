@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+二值描述子（ORB 32 字节）的汉明距离匹配，直接在 uint8 原始描述子上计算，
+不再转成 float32 交给 BFMatcher（那样内存翻 4 倍，且部分 OpenCV 版本直接报错）。
+  - hamming_matrix：距离矩阵。小规模用 uint64 视图上的 XOR + popcount，
+    大规模改用 0/±1 位平面矩阵乘（d = (256 - A·B) / 2，结果同样是精确整数）
+  - ratio_match：一次求出每个查询描述子的最近、次近邻并做比值测试，返回下标数组
+  - match_many：一个查询与多张图库图片一次调用完成匹配
+  - match_batch：一批查询与多张图库图片，每块图库描述子每批只参与一次矩阵乘
+与 OpenCV 的对拍与计时见 python src/bench_hamming.py
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from src import tracing
+
+RATIO_TEST_THRESHOLD = 0.75
+# 候选对数超过该值时改用矩阵乘（BLAS）计算距离
+GEMM_MIN_PAIRS = 1 << 14
+# match_many 每次拼接的图库描述子行数上限（控制距离矩阵内存）
+MANY_MAX_COLS = 1 << 16
+# match_batch 点积矩阵的元素数上限（float32，约 256 MiB）
+BATCH_MAX_CELLS = 1 << 26
+# XOR 路径每块的查询行数
+_XOR_CHUNK = 256
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+if hasattr(np, "bitwise_count"):
+    _popcount64 = np.bitwise_count
+else:
+    _M1 = np.uint64(0x5555555555555555)
+    _M2 = np.uint64(0x3333333333333333)
+    _M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+    _H01 = np.uint64(0x0101010101010101)
+
+    def _popcount64(x):
+        # SWAR popcount：逐步把相邻位段的计数相加，最后用乘法把 8 个字节的计数汇总到最高字节
+        x = x - ((x >> np.uint64(1)) & _M1)
+        x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+        x = (x + (x >> np.uint64(4))) & _M4
+        return (x * _H01) >> np.uint64(56)
+
+
+def _as_bytes(des) -> np.ndarray:
+    des = np.ascontiguousarray(des, dtype=np.uint8)
+    return des.reshape(len(des), -1)
+
+
+def _hamming_xor(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    out = np.empty((len(a), len(b)), dtype=np.int32)
+    if a.shape[1] % 8 == 0:
+        a64, b64 = a.view(np.uint64), b.view(np.uint64)
+        for i in range(0, len(a), _XOR_CHUNK):
+            x = a64[i:i + _XOR_CHUNK, None, :] ^ b64[None, :, :]
+            out[i:i + _XOR_CHUNK] = _popcount64(x).sum(axis=2, dtype=np.int32)
+    else:
+        for i in range(0, len(a), _XOR_CHUNK):
+            x = a[i:i + _XOR_CHUNK, None, :] ^ b[None, :, :]
+            out[i:i + _XOR_CHUNK] = _POPCOUNT8[x].sum(axis=2, dtype=np.int32)
+    return out
+
+
+def _signed_bits(des: np.ndarray) -> np.ndarray:
+    # 每一位映射为 ±1，两行的点积 = 位数 - 2 * 汉明距离
+    return np.unpackbits(des, axis=1).astype(np.float32) * 2.0 - 1.0
+
+
+def _signed_dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # ±1 位平面的点积矩阵，汉明距离 = (位数 - 点积) / 2，点积越大越近
+    return _signed_bits(a) @ _signed_bits(b).T
+
+
+def _hamming_gemm(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    nbits = a.shape[1] * 8
+    return np.rint((nbits - _signed_dot(a, b)) * 0.5).astype(np.int32)
+
+
+def hamming_matrix(a, b) -> np.ndarray:
+    """a (Na,32) 与 b (Nb,32) uint8 描述子的汉明距离矩阵 (Na,Nb) int32"""
+    a, b = _as_bytes(a), _as_bytes(b)
+    if len(a) == 0 or len(b) == 0:
+        return np.empty((len(a), len(b)), dtype=np.int32)
+    if len(a) * len(b) >= GEMM_MIN_PAIRS:
+        return _hamming_gemm(a, b)
+    return _hamming_xor(a, b)
+
+
+def hamming_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """按最后一维逐对计算汉明距离，a/b 形状可广播，例如 (N,1,32) 与 (N,k,32) -> (N,k)"""
+    if a.shape[-1] % 8 == 0:
+        x = np.ascontiguousarray(a).view(np.uint64) ^ np.ascontiguousarray(b).view(np.uint64)
+        return _popcount64(x).sum(axis=-1, dtype=np.int32)
+    return _POPCOUNT8[a ^ b].sum(axis=-1, dtype=np.int32)
+
+
+def _empty_matches():
+    return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+
+def _ratio_from_dist(dist: np.ndarray, ratio: float, nbits: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    对距离矩阵做 2-NN + 比值测试（会原地改写 dist）。
+    nbits 不为 None 时 dist 是 _signed_dot 的点积矩阵，只把选中的最近/次近两个值换算成距离，
+    省掉整块矩阵的类型转换
+    """
+    if dist.shape[0] == 0 or dist.shape[1] < 2:
+        # 与 knnMatch(k=2) 一致：训练集不足 2 个时没有可用的比值测试
+        return _empty_matches()
+    rows = np.arange(len(dist))
+    if nbits is None:
+        idx1 = dist.argmin(axis=1)
+        d1 = dist[rows, idx1].astype(np.float32)
+        dist[rows, idx1] = np.iinfo(dist.dtype).max
+        d2 = dist.min(axis=1).astype(np.float32)
+    else:
+        idx1 = dist.argmax(axis=1)
+        best = dist[rows, idx1]
+        dist[rows, idx1] = -np.inf
+        d1 = ((nbits - best) * 0.5).astype(np.float32)
+        d2 = ((nbits - dist.max(axis=1)) * 0.5).astype(np.float32)
+    keep = np.nonzero(d1 < ratio * d2)[0]
+    return keep.astype(np.int32), idx1[keep].astype(np.int32), d1[keep]
+
+
+def ratio_match(des1, des2, ratio: float = RATIO_TEST_THRESHOLD) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    2-NN + 比值测试，返回 (queryIdx, trainIdx, distance) 三个数组，
+    等价于 BFMatcher(NORM_HAMMING).knnMatch(des1, des2, k=2) 后做 m.distance < ratio * n.distance
+    """
+    if des1 is None or des2 is None or len(des1) == 0 or len(des2) == 0:
+        return _empty_matches()
+    a, b = _as_bytes(des1), _as_bytes(des2)
+    gemm = len(a) * len(b) >= GEMM_MIN_PAIRS
+    with tracing.span("knn_match"):
+        dist = _signed_dot(a, b) if gemm else _hamming_xor(a, b)
+    with tracing.span("ratio_test"):
+        return _ratio_from_dist(dist, ratio, nbits=a.shape[1] * 8 if gemm else None)
+
+
+def match_many(des_q, gallery_des: Sequence[np.ndarray], ratio: float = RATIO_TEST_THRESHOLD,
+               max_cols: int = MANY_MAX_COLS) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    一个查询对多张图库图片做比值测试匹配：把若干张图的描述子拼成一块，
+    一次矩阵乘得到点积，再按每张图的列区间分别取 2-NN。
+    返回与 gallery_des 一一对应的 (queryIdx, trainIdx, distance) 列表
+    """
+    if des_q is None or len(des_q) == 0:
+        return [_empty_matches()] * len(gallery_des)
+    return match_batch([des_q], gallery_des, ratio, max_cells=len(des_q) * max_cols)[0]
+
+
+def match_batch(queries: Sequence[np.ndarray], gallery_des: Sequence[np.ndarray],
+                ratio: float = RATIO_TEST_THRESHOLD, max_cells: int = BATCH_MAX_CELLS):
+    """
+    多个查询一起对多张图库图片做比值测试匹配：所有查询的描述子拼成矩阵的行，
+    每块图库描述子只转换、参与一次矩阵乘（而不是每个查询各做一遍）；
+    每块的列数按 max_cells / 总行数 确定，控制点积矩阵的内存。
+    返回 results[查询][图片] = (queryIdx, trainIdx, distance)
+    """
+    results = [[_empty_matches()] * len(gallery_des) for _ in queries]
+    live = [i for i, d in enumerate(queries) if d is not None and len(d)]
+    if not live:
+        return results
+    qs = [_as_bytes(queries[i]) for i in live]
+    q_bits = np.concatenate([_signed_bits(q) for q in qs])
+    row_off = np.concatenate([[0], np.cumsum([len(q) for q in qs])])
+    nbits = qs[0].shape[1] * 8
+    width = qs[0].shape[1]
+    max_cols = max(1, max_cells // len(q_bits))
+    start = 0
+    while start < len(gallery_des):
+        # 凑一块不超过 max_cols 行的图片
+        end, cols = start, 0
+        while end < len(gallery_des):
+            n = len(gallery_des[end]) if gallery_des[end] is not None else 0
+            if cols and cols + n > max_cols:
+                break
+            cols += n
+            end += 1
+        block = [_as_bytes(d) if d is not None and len(d) else np.empty((0, width), np.uint8)
+                 for d in gallery_des[start:end]]
+        if cols:
+            with tracing.span("knn_match"):
+                dot = q_bits @ _signed_bits(np.concatenate(block)).T
+            with tracing.span("ratio_test"):
+                for r, qi in enumerate(live):
+                    rows = dot[row_off[r]:row_off[r + 1]]
+                    off = 0
+                    for j, d in enumerate(block):
+                        if len(d) >= 2:
+                            results[qi][start + j] = _ratio_from_dist(rows[:, off:off + len(d)], ratio,
+                                                                      nbits=nbits)
+                        off += len(d)
+        start = end
+    return results
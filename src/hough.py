@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+利用关键点尺度与方向的快速几何验证（相似变换 Hough 投票），可作为 RANSAC 前的预筛，也可以直接代替 RANSAC：
+  - 一对匹配由两端关键点的 尺度比、方向差 和位置唯一确定一个相似变换 (θ, s, tx, ty)
+  - 按 Lowe (SIFT) 的做法在 (θ, log2 s, tx, ty) 四维上分箱投票，每维投到最近的两个箱（共 16 票），
+    每个候选取票数最多的箱（至少 MIN_VOTES 票）
+  - 用该箱内的匹配最小二乘拟合相似变换，重投影误差 < REPROJ_THRESHOLD 的匹配计为内点
+所有候选的匹配拼成一个数组一次算完，没有逐候选的 cv2 调用，可以验证几百个候选。
+需要 (N,6) 的特征点（见 feature_store.KP_FIELDS）；旧特征库只有 (x, y) 时返回 None / -1，由调用方回退到 RANSAC。
+用法：
+  python src/hough.py features/book_1.npz features/book_2.npz
+"""
+import sys
+
+import numpy as np
+
+from src import tracing
+
+ROT_BIN = 30.0            # 方向差的箱宽（度）
+SCALE_BIN = 1.0           # log2 尺度比的箱宽（一个倍频程）
+TRANS_BIN = 100.0         # 平移的箱宽（像素，约为缩放后图片边长的 1/8）
+MIN_VOTES = 3             # 最佳箱至少要有的匹配数
+REPROJ_THRESHOLD = 8.0    # 相似变换只是单应的近似，阈值比 RANSAC 的 5px 略宽
+_N_ROT = int(round(360.0 / ROT_BIN))
+_N_SCALE = 16             # log2 s 箱号截断到 [-8, 8)
+_N_TRANS = 128            # 平移箱号截断到 [-64, 64)
+
+
+def has_shape(pts) -> bool:
+    """特征点是否带有尺度与方向"""
+    return pts is not None and pts.ndim == 2 and pts.shape[1] >= 4 and len(pts) > 0 and np.isfinite(pts[0, 2])
+
+
+def _two_bins(x: np.ndarray):
+    """连续箱坐标 -> 最近的两个箱号"""
+    b0 = np.floor(x - 0.5).astype(np.int64)
+    return b0, b0 + 1
+
+
+def similarity_inliers(pts_q: np.ndarray, candidates) -> np.ndarray:
+    """
+    candidates 为 [(图片id, pts, qidx, tidx)]（与 ransac_validate.rerank 相同），
+    返回每个候选的相似变换内点数（int64）；候选的特征点没有尺度/方向时为 -1。
+    查询本身没有尺度/方向时返回 None
+    """
+    if not has_shape(pts_q) or not candidates:
+        return None
+    with tracing.span("hough"):
+        return _similarity_inliers(np.asarray(pts_q, dtype=np.float64), candidates)
+
+
+def _similarity_inliers(pts_q, candidates):
+    n_c = len(candidates)
+    lens = np.array([len(c[2]) for c in candidates], dtype=np.int64)
+    if lens.sum() == 0:
+        return np.zeros(n_c, dtype=np.int64)
+    cid = np.repeat(np.arange(n_c), lens)
+    q = pts_q[np.concatenate([np.asarray(c[2], dtype=np.int64) for c in candidates]), :4]
+    # 只取 x, y, size, angle 四列；旧格式的候选整段记为 NaN
+    t = np.concatenate([np.asarray(c[1], dtype=np.float64)[np.asarray(c[3], dtype=np.int64), :4]
+                        if np.asarray(c[1]).shape[1] >= 4 else np.full((len(c[3]), 4), np.nan)
+                        for c in candidates])
+    valid = np.isfinite(t[:, 2]) & (t[:, 2] > 0) & (q[:, 2] > 0)
+    known = np.bincount(cid, weights=valid, minlength=n_c) > 0
+
+    # 每对匹配隐含的相似变换：t = s R(θ) q + (tx, ty)
+    s = np.where(valid, t[:, 2] / np.where(q[:, 2] > 0, q[:, 2], 1), 1.0)
+    theta = np.deg2rad(np.where(valid, t[:, 3] - q[:, 3], 0.0))
+    a, b = s * np.cos(theta), s * np.sin(theta)
+    tx = t[:, 0] - (a * q[:, 0] - b * q[:, 1])
+    ty = t[:, 1] - (b * q[:, 0] + a * q[:, 1])
+
+    # 四维分箱，每维两个最近的箱 -> 每对匹配 16 个键
+    r0, r1 = _two_bins(np.mod(np.rad2deg(theta), 360.0) / ROT_BIN)
+    l0, l1 = _two_bins(np.log2(s) / SCALE_BIN + _N_SCALE // 2)
+    u0, u1 = _two_bins(tx / TRANS_BIN + _N_TRANS // 2)
+    v0, v1 = _two_bins(ty / TRANS_BIN + _N_TRANS // 2)
+    keys = []
+    for r in (r0, r1):
+        for l in (l0, l1):
+            for u in (u0, u1):
+                for v in (v0, v1):
+                    k = cid * _N_ROT + np.mod(r, _N_ROT)
+                    k = k * _N_SCALE + np.clip(l, 0, _N_SCALE - 1)
+                    k = k * _N_TRANS + np.clip(u, 0, _N_TRANS - 1)
+                    keys.append(k * _N_TRANS + np.clip(v, 0, _N_TRANS - 1))
+    keys = np.stack(keys, axis=1)                      # (M, 16)
+    keys = np.where(valid[:, None], keys, -1)
+
+    # 每个候选票数最多的箱
+    uniq, votes = np.unique(keys[keys >= 0], return_counts=True)
+    owner = uniq // (_N_ROT * _N_SCALE * _N_TRANS * _N_TRANS)
+    best_votes = np.zeros(n_c, dtype=np.int64)
+    best_key = np.full(n_c, -2, dtype=np.int64)
+    order = np.lexsort((votes, owner))                 # 同一候选内票数升序，最后一个最多
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = owner[order][1:] != owner[order][:-1]
+    best_votes[owner[order][last]] = votes[order][last]
+    best_key[owner[order][last]] = uniq[order][last]
+
+    # 最佳箱内的匹配做最小二乘相似变换拟合（按候选分组求和）
+    w = (keys == best_key[cid][:, None]).any(axis=1) & (best_votes[cid] >= MIN_VOTES)
+    n = np.bincount(cid, weights=w, minlength=n_c)
+    nz = np.maximum(n, 1)
+    mq = np.stack([np.bincount(cid, weights=w * q[:, i], minlength=n_c) / nz for i in (0, 1)], axis=1)
+    mt = np.stack([np.bincount(cid, weights=w * np.nan_to_num(t[:, i]), minlength=n_c) / nz for i in (0, 1)], axis=1)
+    qc = q[:, :2] - mq[cid]
+    tc = np.nan_to_num(t[:, :2]) - mt[cid]
+    pp = np.bincount(cid, weights=w * (qc ** 2).sum(1), minlength=n_c)
+    sa = np.bincount(cid, weights=w * (qc[:, 0] * tc[:, 0] + qc[:, 1] * tc[:, 1]), minlength=n_c)
+    sb = np.bincount(cid, weights=w * (qc[:, 0] * tc[:, 1] - qc[:, 1] * tc[:, 0]), minlength=n_c)
+    fa, fb = sa / np.maximum(pp, 1e-9), sb / np.maximum(pp, 1e-9)
+    px = fa[cid] * qc[:, 0] - fb[cid] * qc[:, 1]
+    py = fb[cid] * qc[:, 0] + fa[cid] * qc[:, 1]
+    err = np.hypot(px - tc[:, 0], py - tc[:, 1])
+    fitted = (n >= MIN_VOTES)[cid]
+    inlier = valid & fitted & (err < REPROJ_THRESHOLD)
+    out = np.bincount(cid, weights=inlier, minlength=n_c).astype(np.int64)
+    tracing.count("hough_candidates", n_c)
+    return np.where(known | (lens == 0), out, -1)
+
+
+if __name__ == "__main__":
+    from src.hamming import ratio_match
+    from src.ransac_validate import load_kps_des, verify_arrays
+    if len(sys.argv) != 3:
+        print("Usage: python src/hough.py features/0001.npz features/0002.npz")
+        sys.exit(1)
+    pts1, des1 = load_kps_des(sys.argv[1])
+    pts2, des2 = load_kps_des(sys.argv[2])
+    qi, ti, _ = ratio_match(des1, des2)
+    sim = similarity_inliers(pts1, [(sys.argv[2], pts2, qi, ti)])
+    print(f"good matches: {len(qi)}  similarity inliers: {None if sim is None else int(sim[0])}  "
+          f"homography inliers: {verify_arrays(pts1, pts2, qi, ti)[0]}")
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+并发、可断点续传的图库采集：按关键词调用 Pexels 搜索 API，下载图片的同时直接做缩放 + ORB，
+特征写进分段图库（见 segments.py）的新段，下载结束时特征已经可以检索，不再需要单独的预处理/提取。
+  - 一个 requests.Session（连接池）复用 TCP/TLS 连接；429/5xx 与连接错误按指数退避重试（尊重 Retry-After）
+  - API 请求经过令牌桶限速（默认 200 次/小时，与 Pexels 的配额一致），
+    响应头 X-Ratelimit-Remaining 为 0 时暂停到 X-Ratelimit-Reset
+  - 下载（I/O 线程）与 解码+ORB（计算线程）用 pipeline.bounded_map 两级有界流水
+  - 每 --segment_size 张图提交一个段；状态文件记录每个关键词的下一页、已取到但未入库的图片、已入库的图片，
+    中断后重跑同一命令从断点继续（最多重新下载最后一个未提交的段）
+--api_url 可以指向本地的替身服务（serve-fixture 子命令：用本地图片伪造搜索 API 与图片下载，可注入失败与限流）。
+用法：
+  export PEXELS_API_KEY=...                               # 或写在 .env
+  python src/ingest.py run --keywords mug desk book --per_keyword 20
+  python src/ingest.py serve-fixture --images dataset/images --port 8899 --fail_rate 0.2
+  python src/ingest.py run --api_url http://127.0.0.1:8899/v1/search --keywords book desk --rate 20
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src import segments
+from src.extra_features import ORB_PARAMS
+from src.pipeline import IMAGE_SUFFIXES, MAX_SIDE, _OrbPerThread, bounded_map, decode_gray, detect
+
+API_URL = "https://api.pexels.com/v1/search"
+SAVE_DIR = Path("dataset/images")
+STATE_FILE = Path("features/ingest_state.json")
+QUOTA_PER_HOUR = 200      # Pexels 默认配额：每小时 200 次 API 请求
+BURST = 5                 # 令牌桶容量：允许短时间连发的请求数
+PER_PAGE = 80             # Pexels 每页最多 80 张
+SEGMENT_SIZE = 200        # 每攒够这么多张图提交一个段
+RETRIES = 5
+BACKOFF = 0.5             # 第 n 次重试前等待 BACKOFF * 2^(n-1) 秒
+TIMEOUT = 10.0
+SIZE = "medium"           # 取的图片尺寸（约 350px 高，缩放到 MAX_SIDE 前已足够小）
+
+
+class TokenBucket:
+    """线程安全的令牌桶：每秒补充 rate 个令牌，最多积攒 capacity 个，acquire() 在没有令牌时阻塞"""
+
+    def __init__(self, rate: float, capacity: float = BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self, n: float = 1.0) -> float:
+        """取 n 个令牌，返回等待的秒数"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return waited
+                delay = (n - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause_until(self, deadline: float):
+        """服务端说配额已用完：清空令牌，deadline（monotonic 时间）之前不再发放"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0.0) - max(0.0, deadline - time.monotonic()) * self.rate
+
+
+def make_session(pool_size: int = 8, retries: int = RETRIES, backoff: float = BACKOFF) -> requests.Session:
+    """带连接池与重试的 Session；所有下载线程共用"""
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",), respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# ---------------- 状态文件 ----------------
+
+def load_state(path: Path) -> dict:
+    """{"keywords": {kw: {"next_page", "per_page", "exhausted"}}, "photos": {图片名: {"keyword", "url"}}, "done": [图片名]}"""
+    if Path(path).exists():
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+        state["done"] = set(state["done"])
+        return state
+    return {"keywords": {}, "photos": {}, "done": set()}
+
+
+def save_state(state: dict, path: Path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(dict(state, done=sorted(state["done"])), f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+# ---------------- 采集 ----------------
+
+class Ingester:
+    def __init__(self, api_url: str = API_URL, api_key: str = None, seg_root: Path = segments.SEG_DIR,
+                 save_dir: Optional[Path] = SAVE_DIR, state_path: Path = STATE_FILE,
+                 rate: float = QUOTA_PER_HOUR / 3600.0, io_workers: int = 8, workers: int = 2,
+                 segment_size: int = SEGMENT_SIZE, max_side: int = MAX_SIDE, timeout: float = TIMEOUT,
+                 retries: int = RETRIES, backoff: float = BACKOFF, verbose: bool = True):
+        self.api_url = api_url
+        self.headers = {"Authorization": api_key} if api_key else {}
+        self.seg_root = Path(seg_root)
+        self.save_dir = Path(save_dir) if save_dir else None
+        self.state_path = Path(state_path)
+        self.state = load_state(self.state_path)
+        self.bucket = TokenBucket(rate)
+        self.session = make_session(io_workers, retries, backoff)
+        self.io_workers = io_workers
+        self.workers = workers
+        self.segment_size = segment_size
+        self.max_side = max_side
+        self.timeout = timeout
+        self.verbose = verbose
+        self._stats_lock = threading.Lock()
+        self.stats = {"api_calls": 0, "api_wait_s": 0.0, "downloaded": 0, "from_disk": 0, "failed": 0,
+                      "committed": 0, "segments": 0}
+        if self.save_dir:
+            self.save_dir.mkdir(parents=True, exist_ok=True)
+        if not segments.has_segments(self.seg_root):
+            segments.init(self.seg_root)
+
+    def count(self, key: str, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg, flush=True)
+
+    def api_page(self, keyword: str, page: int, per_page: int) -> dict:
+        self.count("api_wait_s", self.bucket.acquire())
+        params = {"query": keyword, "per_page": per_page, "page": page, "size": SIZE}
+        r = self.session.get(self.api_url, headers=self.headers, params=params, timeout=self.timeout)
+        self.count("api_calls")
+        remaining, reset = r.headers.get("X-Ratelimit-Remaining"), r.headers.get("X-Ratelimit-Reset")
+        if remaining is not None and int(remaining) <= 0 and reset is not None:
+            # Reset 是配额恢复的 Unix 时间戳
+            self.bucket.pause_until(time.monotonic() + max(0.0, float(reset) - time.time()))
+        r.raise_for_status()
+        return r.json()
+
+    def photos(self, keywords, per_keyword: int):
+        """
+        生成器：先产出状态文件里取到但未入库的图片，再按关键词翻页；产出 (图片名, url)
+        每取到一页就写状态文件，重跑时不会重复请求已经取过的页
+        """
+        st = self.state
+        for name, info in list(st["photos"].items()):
+            if name not in st["done"]:
+                yield name, info["url"]
+        for kw in keywords:
+            # 每页张数在第一次请求时定下来，之后不变，否则页码对应的偏移会错位
+            ks = st["keywords"].setdefault(kw, {"next_page": 1, "per_page": min(PER_PAGE, per_keyword),
+                                                "exhausted": False})
+            while not ks["exhausted"]:
+                have = sum(1 for n, i in st["photos"].items() if i["keyword"] == kw)
+                if have >= per_keyword:
+                    break
+                data = self.api_page(kw, ks["next_page"], ks["per_page"])
+                fresh = []
+                for photo in data.get("photos", [])[:per_keyword - have]:
+                    name = f"{kw.replace(' ', '_')}_{photo['id']}"
+                    if name not in st["photos"]:
+                        st["photos"][name] = {"keyword": kw, "url": photo["src"][SIZE]}
+                        fresh.append(name)
+                ks["next_page"] += 1
+                ks["exhausted"] = not data.get("photos") or not data.get("next_page")
+                save_state(st, self.state_path)
+                self.log(f"{kw}: page {ks['next_page'] - 1}, {len(fresh)} new photos")
+                for name in fresh:
+                    if name not in st["done"]:
+                        yield name, st["photos"][name]["url"]
+
+    def download(self, item):
+        """I/O 线程：下载一张图（已在 save_dir 中的直接读文件），返回 (图片名, 字节)；失败时字节为 None"""
+        name, url = item
+        path = self.save_dir / (name + ".jpg") if self.save_dir else None
+        if path is not None and path.exists():
+            self.count("from_disk")
+            return name, path.read_bytes()
+        try:
+            r = self.session.get(url, timeout=self.timeout)
+            r.raise_for_status()
+            data = r.content
+        except requests.RequestException as e:
+            self.log(f"WARN: download {name} failed: {e}")
+            return name, None
+        if path is not None:
+            tmp = path.with_suffix(".part")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        self.count("downloaded")
+        return name, data
+
+    def run(self, keywords, per_keyword: int) -> dict:
+        local = _OrbPerThread(ORB_PARAMS)
+
+        def compute(item):
+            name, data = item
+            gray = decode_gray(data, self.max_side) if data is not None else None
+            if gray is None:
+                return name, None, None
+            pts, des = detect(gray, local.orb)
+            return name, pts, des
+
+        prefetch = 2 * self.io_workers
+        downloaded = bounded_map(self.download, self.photos(keywords, per_keyword), self.io_workers, prefetch)
+        batch = []
+        for name, pts, des in bounded_map(compute, downloaded, self.workers, prefetch):
+            if des is None:
+                self.count("failed")
+                continue
+            batch.append((name, pts, des))
+            if len(batch) >= self.segment_size:
+                self.commit(batch)
+                batch = []
+        if batch:
+            self.commit(batch)
+        save_state(self.state, self.state_path)
+        return self.stats
+
+    def commit(self, batch):
+        """把一批特征写成一个新段，入库后才在状态文件里记为 done"""
+        name = segments._reserve(self.seg_root)
+        names = segments._write_segment(self.seg_root / name, iter(batch))
+        segments._commit_new(self.seg_root, name, names)
+        self.state["done"].update(names)
+        save_state(self.state, self.state_path)
+        self.count("committed", len(names))
+        self.count("segments")
+        self.log(f"{name}: {len(names)} images committed")
+
+
+# ---------------- 本地替身服务 ----------------
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    """
+    GET /v1/search?query=book&page=1&per_page=80 -> Pexels 格式的 JSON（文件名以 query 开头的本地图片）
+    GET /photos/<文件名>                           -> 图片字节
+    按 fail_rate 随机返回 503；配额用完时返回 429 与 X-Ratelimit-* 头
+    """
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, code, body: bytes, ctype: str, headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        srv = self.server
+        url = urlparse(self.path)
+        with srv.lock:
+            srv.hits[url.path.split("/")[1]] = srv.hits.get(url.path.split("/")[1], 0) + 1
+            flaky = srv.rng.random() < srv.fail_rate
+        if flaky:
+            return self._send(503, b"try again", "text/plain", {"Retry-After": 0})
+        if url.path == "/v1/search":
+            with srv.lock:
+                srv.quota -= 1
+                remaining = srv.quota
+            headers = {"X-Ratelimit-Limit": srv.limit, "X-Ratelimit-Remaining": max(remaining, 0),
+                       "X-Ratelimit-Reset": int(time.time()) + 1}
+            if remaining < 0:
+                return self._send(429, b"{}", "application/json", headers)
+            q = parse_qs(url.query)
+            query = q.get("query", [""])[0].replace(" ", "_")
+            page, per_page = int(q.get("page", ["1"])[0]), int(q.get("per_page", ["15"])[0])
+            files = [p for p in srv.files if p.stem.startswith(query)]
+            chunk = files[(page - 1) * per_page:page * per_page]
+            base = f"http://{self.headers.get('Host')}"
+            body = {"page": page, "per_page": per_page, "total_results": len(files),
+                    "photos": [{"id": srv.files.index(p) + 1, "src": {SIZE: f"{base}/photos/{p.name}"}}
+                               for p in chunk]}
+            if page * per_page < len(files):
+                body["next_page"] = f"{base}/v1/search?query={query}&page={page + 1}&per_page={per_page}"
+            return self._send(200, json.dumps(body).encode("utf-8"), "application/json", headers)
+        if url.path.startswith("/photos/"):
+            p = srv.root / Path(url.path).name
+            if p.exists():
+                return self._send(200, p.read_bytes(), "image/jpeg")
+        self._send(404, b"not found", "text/plain")
+
+
+def fixture_server(images: Path, port: int = 0, fail_rate: float = 0.0, quota: int = 10 ** 9,
+                   seed: int = 0) -> ThreadingHTTPServer:
+    """本地替身服务（未启动，调用方 serve_forever / 放进线程）；port=0 时自动分配端口"""
+    srv = ThreadingHTTPServer(("127.0.0.1", port), _FixtureHandler)
+    srv.daemon_threads = True
+    srv.root = Path(images)
+    srv.files = sorted(p for p in srv.root.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    srv.fail_rate = fail_rate
+    srv.rng = random.Random(seed)
+    srv.limit = srv.quota = quota
+    srv.hits = {}
+    srv.lock = threading.Lock()
+    return srv
+
+
+def _api_key() -> Optional[str]:
+    try:
+        import dotenv
+        dotenv.load_dotenv()
+    except ImportError:
+        pass
+    return os.getenv("PEXELS_API_KEY")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("run", help="search, download and extract into a new segment")
+    p.add_argument("--keywords", nargs="+", required=True)
+    p.add_argument("--per_keyword", type=int, default=20)
+    p.add_argument("--api_url", type=str, default=API_URL, help="search endpoint (or a local fixture server)")
+    p.add_argument("--rate", type=float, default=QUOTA_PER_HOUR, help="API requests per hour")
+    p.add_argument("--io_workers", type=int, default=8, help="concurrent downloads (also the connection pool size)")
+    p.add_argument("--workers", type=int, default=2, help="decode + ORB threads")
+    p.add_argument("--segment_size", type=int, default=SEGMENT_SIZE, help="images per committed segment")
+    p.add_argument("--seg_root", type=str, default=str(segments.SEG_DIR))
+    p.add_argument("--save_dir", type=str, default=str(SAVE_DIR), help="also keep the images here ('' = don't)")
+    p.add_argument("--state", type=str, default=str(STATE_FILE), help="resume state file")
+    p.add_argument("--retries", type=int, default=RETRIES)
+    p = sub.add_parser("serve-fixture", help="local stand-in for the search API and image CDN")
+    p.add_argument("--images", type=str, default=str(SAVE_DIR))
+    p.add_argument("--port", type=int, default=8899)
+    p.add_argument("--fail_rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    p.add_argument("--quota", type=int, default=10 ** 9, help="API calls before answering 429")
+    args = parser.parse_args()
+
+    if args.cmd == "serve-fixture":
+        srv = fixture_server(Path(args.images), args.port, args.fail_rate, args.quota)
+        print(f"{len(srv.files)} images; search at http://127.0.0.1:{args.port}/v1/search")
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    key = _api_key()
+    if args.api_url == API_URL and not key:
+        raise SystemExit("请在环境变量或 .env 文件中配置 PEXELS_API_KEY")
+    t0 = time.time()
+    ing = Ingester(args.api_url, key, Path(args.seg_root), Path(args.save_dir) if args.save_dir else None,
+                   Path(args.state), rate=args.rate / 3600.0, io_workers=args.io_workers, workers=args.workers,
+                   segment_size=args.segment_size, retries=args.retries)
+    stats = ing.run(args.keywords, args.per_keyword)
+    dt = time.time() - t0
+    print(f"{stats['committed']} images in {stats['segments']} segments in {dt:.2f}s "
+          f"({stats['committed'] / max(dt, 1e-9):.1f} img/s); api calls {stats['api_calls']} "
+          f"(waited {stats['api_wait_s']:.1f}s), downloaded {stats['downloaded']}, from disk {stats['from_disk']}, "
+          f"failed {stats['failed']}")
+
+
+if __name__ == "__main__":
+    main()
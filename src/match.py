@@ -2,6 +2,9 @@
 """
 给定两个 features npz 文件 做匹配，返回 good matches (ratio test)
 并可视化保存匹配图像。
+features/<stem>.npz 若已写入合并式特征库 features/store/，直接从特征库读取。
+特征与匹配都以数组形式传递（feature_store.Features / Matches），检索与 RANSAC 直接用下标数组，
+cv2.KeyPoint / cv2.DMatch 只在 visualize 画图时生成。
 用法：
   python src/match.py features/0001.npz features/0002.npz out.jpg
 """
@@ -9,34 +12,54 @@ import sys
 import cv2
 import numpy as np
 from pathlib import Path
+from src.feature_store import DES_DIM, KP_DIM, Features, load_from_store
+from src.hamming import ratio_match
+from src import tracing
 
-#暴力匹配（ORB用Hamming距离）
-bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+class Matches:
+    """
+    一组匹配对：qidx / tidx 为两张图的特征下标（int64），dist 为汉明距离，
+    RANSAC 直接用下标数组取点；dmatches() 才生成 cv2.DMatch
+    """
 
-def match_descriptors(des1, des2, ratio=0.75):
+    __slots__ = ("qidx", "tidx", "dist")
+
+    def __init__(self, qidx, tidx, dist):
+        self.qidx = qidx
+        self.tidx = tidx
+        self.dist = dist
+
+    @classmethod
+    def empty(cls) -> "Matches":
+        e = np.empty(0, dtype=np.int64)
+        return cls(e, e, np.empty(0, dtype=np.float32))
+
+    def __len__(self):
+        return len(self.qidx)
+
+    def dmatches(self) -> list:
+        return to_dmatches(self.qidx, self.tidx, self.dist)
+
+def to_dmatches(qi, ti, dist):
+    """把下标数组转成 cv2.DMatch 列表（visualize / 旧接口使用）"""
+    return [cv2.DMatch(int(q), int(t), float(d)) for q, t, d in zip(qi, ti, dist)]
+
+def match_descriptors(des1, des2, ratio=0.75) -> Matches:
     if des1 is None or des2 is None:
-        return []
+        return Matches.empty()
     if len(des1) == 0 or len(des2) == 0:
-        return []
-    
-     # 强制转换为np.float32（ORB的uint8→float32，数值不变，不影响匹配结果）
-    des1_norm = des1.astype(np.float32) if des1.dtype != np.float32 else des1
-    des2_norm = des2.astype(np.float32) if des2.dtype != np.float32 else des2
-
-    try:
-        # k=2：取每个描述子的前2个最佳匹配
-        matches = bf.knnMatch(des1_norm, des2_norm, k=2)
-    except cv2.error as e:
-        print(f"⚠️ 匹配警告：knnMatch执行失败 - {str(e)[:100]}")
-        return []
-        
-    good = []
-    for m in matches:
-        if len(m) == 2 and m[0].distance < ratio * m[1].distance:
-            good.append(m[0])          # 阈值越小越严格
-    return good
+        return Matches.empty()
+    # 直接在 uint8 描述子上算汉明距离 2-NN + 比值测试（阈值越小越严格）
+    return Matches(*ratio_match(des1, des2, ratio))
 
 def visualize(img1_path, img2_path, kp1, kp2, matches, out_path):
+    # 这里才需要 cv2 对象：Features / Matches 在画图前转换
+    if isinstance(kp1, Features):
+        kp1 = kp1.keypoints()
+    if isinstance(kp2, Features):
+        kp2 = kp2.keypoints()
+    if isinstance(matches, Matches):
+        matches = matches.dmatches()
     img1 = cv2.imread(str(img1_path))
     img2 = cv2.imread(str(img2_path))
     if img1 is None or img2 is None:
@@ -46,33 +69,53 @@ def visualize(img1_path, img2_path, kp1, kp2, matches, out_path):
                           flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
     cv2.imwrite(str(out_path), vis)
 
-def load_kps_and_des(npz_path):
-    a = np.load(npz_path, allow_pickle=True)
-    pts = a.get("pts")
-    des = a.get("des")
+def load_features(npz_path) -> Features:
+    """读一张图的特征（优先特征库中的 memmap 视图），不生成 cv2.KeyPoint"""
+    with tracing.span("load_features"):
+        stored = load_from_store(npz_path)
+        if stored is not None:
+            pts, des = stored
+        else:
+            a = np.load(npz_path, allow_pickle=True)
+            pts = a.get("pts")
+            des = a.get("des")
 
     if des is None:
-        des = np.empty((0, 32), dtype=np.uint8)  # 兜底为ORB标准空数组
+        des = np.empty((0, DES_DIM), dtype=np.uint8)  # 兜底为ORB标准空数组
     else:
-        des = des.astype(np.uint8)  # 非空时再转换类型
+        des = des.astype(np.uint8, copy=False)  # 非空时再转换类型（特征库里已是 uint8，不拷贝）
+    if pts is None:
+        pts = np.empty((0, KP_DIM), dtype=np.float32)
+    return Features(pts, des)
 
+def load_kps_and_des(npz_path):
+    """旧接口：返回 (cv2.KeyPoint 列表, des)；检索路径请用 load_features"""
+    feats = load_features(npz_path)
+    return feats.keypoints(), feats.des
 
+def to_keypoints(pts):
+    """(N,6) 特征点数组还原成 cv2.KeyPoint；旧格式只有 (x, y) 时尺度记为 1"""
     kps = []
-    if pts is not None:
-        for (x,y) in pts:
-            kps.append(cv2.KeyPoint(float(x), float(y), 1))
-    return kps, des
+    if pts is None:
+        return kps
+    for row in np.asarray(pts, dtype=np.float32):
+        x, y = float(row[0]), float(row[1])
+        if len(row) >= 6 and np.isfinite(row[2]):
+            kps.append(cv2.KeyPoint(x, y, float(row[2]), float(row[3]), float(row[5]), int(row[4])))
+        else:
+            kps.append(cv2.KeyPoint(x, y, 1))
+    return kps
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
         print("Usage: python src/match.py features/0001.npz features/0002.npz out.jpg")
         sys.exit(1)
     npz1, npz2, out = sys.argv[1:4]
-    kp1, des1 = load_kps_and_des(npz1)
-    kp2, des2 = load_kps_and_des(npz2)
-    good = match_descriptors(des1, des2)
+    f1 = load_features(npz1)
+    f2 = load_features(npz2)
+    good = match_descriptors(f1.des, f2.des)
     print("Good matches:", len(good))
     # derive image paths
     img1 = Path("dataset/images_pre") / (Path(npz1).stem + ".jpg")
     img2 = Path("dataset/images_pre") / (Path(npz2).stem + ".jpg")
-    visualize(img1, img2, kp1, kp2, good, out)
\ No newline at end of file
+    visualize(img1, img2, f1, f2, good, out)
\ No newline at end of file
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+可替换的全图库匹配后端：查询描述子与整个图库做比值测试匹配并按图投票，
+vote() 返回 Top-nprobe [(图片id, qidx, tidx)]，直接交给 ransac_validate.rerank 精排。
+  - bf：逐图精确 2-NN（hamming.match_many），与暴力检索的匹配完全一致
+  - mih：多索引哈希（mih.py），子串精确查找 + 汉明半径
+  - flann：OpenCV FLANN 的 LSH 索引（cv2.flann_Index，algorithm=6），二值描述子专用：
+    table_number 张哈希表、每张取 key_size 位做键，multi_probe_level 为每张表额外探查的相邻桶（汉明距离）。
+    查询在全图库上取 FLANN_KNN 个近似近邻，按所属图片分组：每张图取最近者，
+    次近邻取同图内的第二近者（没有则用第 FLANN_KNN 个近邻的距离估计，比值测试偏保守）
+FLANN 索引训练一次保存在 features/flann/（index.bin + meta.json），之后按同一份图库描述子 load，
+不再逐查询重建；图库变化（图片列表或描述子数不同）时报告过期并重建。
+用法：
+  python src/matchers.py build --tables 6 --key_size 24 --multi_probe 1
+  python src/matchers.py bench --queries bench/data/1000/queries --backends bf mih flann   # 快速阶段速度 / 召回
+  python src/search_bruteforce.py --query_path dataset/queries/q1.jpg --engine flann
+  python src/search_two_stage.py --query_path dataset/queries/q1.jpg --coarse flann
+  python src/evaluate.py --gt groundtruth.csv --engine brute flann        # 端到端 recall / 延迟对比
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.feature_store import FEAT_DIR, open_gallery
+from src.hamming import RATIO_TEST_THRESHOLD, match_many
+from src.mih import MAX_DIST, load_or_build as load_mih, per_image_matches, rank_votes
+from src import tracing
+
+BACKENDS = ("bf", "mih", "flann")
+FLANN_DIR = FEAT_DIR / "flann"
+INDEX_FILE = "index.bin"
+FLANN_INDEX_LSH = 6
+LSH_TABLES = 6        # 哈希表数：越多召回越高，内存与查询时间线性增长
+LSH_KEY_SIZE = 24     # 每张表的键位数：越长桶越小，查询越快但漏检越多
+LSH_MULTI_PROBE = 1   # 多探查级别：0 只查自己的桶
+FLANN_KNN = 8         # 每个查询描述子在全图库取的近邻数
+
+
+class BruteForceIndex:
+    """不建索引：逐图精确匹配，作为其它后端的对照"""
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+
+    def vote(self, des_q: np.ndarray, nprobe: int, exclude=None, ratio: float = RATIO_TEST_THRESHOLD, **kw):
+        skip = {exclude} if isinstance(exclude, str) else set(exclude or ())
+        idx = [i for i, name in enumerate(self.gallery.ids) if name not in skip]
+        matches = match_many(des_q, [self.gallery.get(i)[1] for i in idx], ratio)
+        ranked = sorted(zip(idx, matches), key=lambda x: len(x[1][0]), reverse=True)[:nprobe]
+        return [(self.gallery.ids[i], qi, ti) for i, (qi, ti, _) in ranked]
+
+
+class FlannLSHIndex:
+    def __init__(self, index, gallery, params: dict, knn: int = FLANN_KNN):
+        self.index = index
+        self.des = np.ascontiguousarray(gallery.des)  # FLANN 只保存指针，描述子必须与索引同寿命
+        self.img_of = np.repeat(np.arange(len(gallery), dtype=np.int32), gallery.counts)
+        self.offsets = gallery.offsets
+        self.names = list(gallery.ids)
+        self.params = params
+        self.knn = knn
+
+    @classmethod
+    def build(cls, gallery, tables: int = LSH_TABLES, key_size: int = LSH_KEY_SIZE,
+              multi_probe: int = LSH_MULTI_PROBE) -> "FlannLSHIndex":
+        params = {"table_number": tables, "key_size": key_size, "multi_probe_level": multi_probe}
+        des = np.ascontiguousarray(gallery.des)
+        index = cv2.flann_Index(des, dict(algorithm=FLANN_INDEX_LSH, **params))
+        return cls(index, gallery, params)
+
+    def save(self, out: Path):
+        out = Path(out)
+        out.mkdir(parents=True, exist_ok=True)
+        self.index.save(str(out / INDEX_FILE))
+        with open(out / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"params": self.params, "n_des": int(len(self.des)), "names": self.names}, f,
+                      ensure_ascii=False)
+
+    @classmethod
+    def load(cls, out: Path, gallery) -> "FlannLSHIndex":
+        out = Path(out)
+        with open(out / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["names"] != list(gallery.ids) or meta["n_des"] != len(gallery.des):
+            raise ValueError(f"{out} is stale; rebuild with python src/matchers.py build")
+        obj = cls(cv2.flann_Index(), gallery, meta["params"])
+        if not obj.index.load(obj.des, str(out / INDEX_FILE)):
+            raise ValueError(f"cannot load {out / INDEX_FILE}")
+        return obj
+
+    def match(self, des_q: np.ndarray, ratio: float = RATIO_TEST_THRESHOLD, **kw):
+        """返回 {图片下标: (qidx, tidx)}，与 MIHIndex.match 相同"""
+        q = np.ascontiguousarray(des_q, dtype=np.uint8)
+        with tracing.span("flann_lookup"):
+            idx, dist = self.index.knnSearch(q, self.knn, params={})
+        idx, dist = idx.astype(np.int64), dist.astype(np.int32)
+        valid = idx >= 0
+        # 同图内没有第二个近邻时，真正的次近邻不会比第 knn 个近邻更近
+        kth = np.where(valid.all(axis=1), dist[:, -1], MAX_DIST + 1)
+        qi = np.repeat(np.arange(len(q)), self.knn)[valid.ravel()]
+        tracing.count("flann_neighbours", len(qi))
+        return per_image_matches(qi, idx[valid], dist[valid], self.img_of, self.offsets, ratio, kth)
+
+    def vote(self, des_q: np.ndarray, nprobe: int, exclude=None, **kw):
+        """按比值测试通过的匹配数投票，返回 Top-nprobe [(图片id, qidx, tidx)]"""
+        return rank_votes(self.match(des_q, **kw), self.names, nprobe, exclude)
+
+
+def load_flann(gallery, out: Path = FLANN_DIR) -> FlannLSHIndex:
+    """读回保存的索引；没有或已过期时按默认参数建一次并保存"""
+    try:
+        return FlannLSHIndex.load(out, gallery)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"FLANN index unavailable ({e}); building {out}", file=sys.stderr)
+        index = FlannLSHIndex.build(gallery)
+        index.save(out)
+        return index
+
+
+def load_backend(name: str, gallery, feat_dir: Path = FEAT_DIR):
+    """按名字取后端；mih / flann 的索引从 <feat_dir>/mih、<feat_dir>/flann 读取"""
+    if name == "bf":
+        return BruteForceIndex(gallery)
+    if name == "mih":
+        return load_mih(gallery, Path(feat_dir) / "mih")
+    if name == "flann":
+        return load_flann(gallery, Path(feat_dir) / FLANN_DIR.name)
+    raise ValueError(f"unknown matcher backend {name}; choose from {', '.join(BACKENDS)}")
+
+
+# ---------------- 评测：快速阶段 ----------------
+
+def bench(args):
+    from src.batch import load_queries, resolve_queries
+    gallery = open_gallery(Path(args.features))
+    queries = [(pts, des) for _, pts, des, _ in load_queries(resolve_queries(args.queries)) if des is not None]
+    reference = BruteForceIndex(gallery)
+    truth = [reference.vote(des, args.nprobe) for _, des in queries]
+    print(f"{len(gallery)} images, {len(gallery.des)} descriptors, {len(queries)} queries, nprobe={args.nprobe}")
+    for name in args.backends:
+        t0 = time.perf_counter()
+        index = reference if name == "bf" else load_backend(name, gallery, args.features)
+        t_load = time.perf_counter() - t0
+        lat, overlap, top1, kept = [], [], [], []
+        for (_, des), ref in zip(queries, truth):
+            t0 = time.perf_counter()
+            got = index.vote(des, args.nprobe)
+            lat.append(time.perf_counter() - t0)
+            ref_names = {n for n, _, _ in ref}
+            overlap.append(len(ref_names & {n for n, _, _ in got}) / max(len(ref_names), 1))
+            top1.append(bool(got) and bool(ref) and got[0][0] == ref[0][0])
+            # 暴力匹配第一名的匹配中被该后端找回的比例
+            if ref and got:
+                mine = {n: set(zip(q.tolist(), t.tolist())) for n, q, t in got}
+                want = set(zip(ref[0][1].tolist(), ref[0][2].tolist()))
+                kept.append(len(want & mine.get(ref[0][0], set())) / max(len(want), 1))
+        lat = np.array(lat) * 1000
+        print(f"  {name:5s} load/build {t_load:6.2f}s  p50 {np.percentile(lat, 50):7.1f} ms  "
+              f"p95 {np.percentile(lat, 95):7.1f} ms  shortlist recall {np.mean(overlap):.3f}  "
+              f"top-1 agree {np.mean(top1):.3f}  match recall {np.mean(kept) if kept else 0:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=str, default=str(FEAT_DIR))
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="train the FLANN LSH index over the gallery and save it")
+    b.add_argument("--tables", type=int, default=LSH_TABLES)
+    b.add_argument("--key_size", type=int, default=LSH_KEY_SIZE)
+    b.add_argument("--multi_probe", type=int, default=LSH_MULTI_PROBE)
+    e = sub.add_parser("bench", help="coarse-stage latency and recall of each backend against bf")
+    e.add_argument("--queries", type=str, required=True, help="directory, glob or list file of queries")
+    e.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    e.add_argument("--nprobe", type=int, default=30)
+    args = parser.parse_args()
+    if args.cmd == "bench":
+        bench(args)
+        return
+    gallery = open_gallery(Path(args.features))
+    out = Path(args.features) / FLANN_DIR.name
+    t0 = time.time()
+    index = FlannLSHIndex.build(gallery, args.tables, args.key_size, args.multi_probe)
+    index.save(out)
+    size = sum(p.stat().st_size for p in out.iterdir())
+    print(f"FLANN LSH index: {len(gallery)} images, {len(gallery.des)} descriptors, "
+          f"{size / 2**20:.1f} MiB, build {time.time() - t0:.2f}s -> {out}")
+
+
+if __name__ == "__main__":
+    main()
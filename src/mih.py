@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+多索引哈希（Multi-Index Hashing）：对整个图库的 ORB 描述子建一次索引，
+查询的所有描述子一次性在全图库范围内找汉明近邻，再换算成每张图的投票与比值测试匹配，
+可以直接交给 ransac_validate.rerank 做 RANSAC 精排（search_bruteforce.py --engine mih）。
+  - 把 256 位描述子切成 m 段，每段一张表：按子串排序的 (keys, ids)。
+    m 按图库规模选（tables_for）：26 万描述子以内用 16 段 × 16 位（8 段时保证半径只有 7，小图库上真实匹配大多漏掉），
+    更大的图库用 8 段 × 32 位（16 位子串的桶随图库线性变大，1 万张图时单次查询要数秒）
+  - 查询：每段做精确子串查找（probe=1 时再加上翻转 1 位的子串），
+    鸽巢原理只保证汉明距离 <= m*(probe+1)-1 的近邻一定被找到（guaranteed_radius：m=8 时 7 / 15，m=16 时 15 / 31），
+    更远的近邻只在某一段恰好相同时按概率找到；超过 MAX_BUCKET 的桶被跳过，其中的近邻不在保证之内
+  - 候选去重后用 popcount 精确算距离，> MAX_DIST 的丢弃（只是过滤，不是检索保证）
+  - 比值测试的次近邻取同图内检索到的第二近者；同图内没有时，用该查询描述子在全图库候选中
+    第 SECOND_K 近的距离估计（候选不足时取 MAX_DIST+1），不再用一个固定的大值让孤立近邻都通过
+索引保存在 features/mih/（.npy，np.load(mmap_mode="r") 打开）。
+用法：
+  python src/mih.py build                                 # 从 features/store 建索引
+  python src/mih.py bench --images 10000 --per_image 500  # 合成图库上的内存/建库/查询评测
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.feature_store import FEAT_DIR, open_gallery
+from src.hamming import RATIO_TEST_THRESHOLD, hamming_rows
+from src import tracing
+
+MIH_DIR = FEAT_DIR / "mih"
+N_TABLES = 8       # 大图库的段数；小图库见 tables_for
+SMALL_TABLES = 16
+SMALL_MAX_DES = 1 << 18  # 16 段（16 位子串）只用于 26 万描述子以内（平均每桶 <= 4 个）
+MAX_DIST = 64      # 候选的最大汉明距离，更远的不可能是可用的 ORB 匹配
+SECOND_K = 8       # 同图内没有次近邻时，取全图库第 SECOND_K 近的候选距离作估计
+MAX_BUCKET = 4096  # 过大的桶（如全 0 描述子）跳过，避免单个子串拖垮查询
+
+
+def tables_for(n_des: int) -> int:
+    """按描述子总数选段数：16 位子串平均每桶 n_des / 2^16 个描述子，超过几个后查询被大桶拖慢，改用 32 位子串"""
+    return SMALL_TABLES if n_des <= SMALL_MAX_DES else N_TABLES
+
+
+def guaranteed_radius(m: int = N_TABLES, probe: int = 0) -> int:
+    """m 段、每段翻转至多 probe 位时一定能找到的近邻半径（鸽巢原理）"""
+    return m * (probe + 1) - 1
+
+
+def kth_distance(qi: np.ndarray, dist: np.ndarray, n_q: int, k: int = SECOND_K, default: int = MAX_DIST + 1):
+    """每个查询描述子在全部候选中第 k 近的距离（候选不足 k 个时为 default），按查询描述子下标索引"""
+    out = np.full(n_q, default, dtype=np.int64)
+    if len(qi) == 0:
+        return out
+    order = np.lexsort((dist, qi))
+    qi, dist = qi[order], dist[order]
+    starts = np.searchsorted(qi, np.arange(n_q))
+    ends = np.searchsorted(qi, np.arange(n_q), side="right")
+    has = ends - starts >= k
+    out[has] = dist[starts[has] + k - 1]
+    return out
+
+
+def _substrings(des: np.ndarray, m: int) -> np.ndarray:
+    """(N,32) uint8 -> (N,m) 子串键（uint32，m=8 时每段 4 字节）"""
+    des = np.ascontiguousarray(des, dtype=np.uint8)
+    width = des.shape[1] // m
+    if width == 4:
+        return des.view(np.uint32).reshape(len(des), m)
+    if width == 2:
+        return des.view(np.uint16).reshape(len(des), m).astype(np.uint32)
+    raise ValueError(f"unsupported table count {m} for {des.shape[1]}-byte descriptors")
+
+
+def _ranges_to_positions(lo: np.ndarray, hi: np.ndarray):
+    """把若干 [lo, hi) 区间展开成一个位置数组，并返回每个位置所属的区间编号"""
+    lens = hi - lo
+    total = int(lens.sum())
+    owner = np.repeat(np.arange(len(lo)), lens)
+    pos = np.repeat(lo - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens) + np.arange(total)
+    return pos, owner
+
+
+def per_image_matches(qi, di, dist, img_of, offsets, ratio: float, second):
+    """
+    全图库近邻 (查询描述子下标, 图库描述子全局下标, 距离) -> {图片下标: (qidx, tidx)}：
+    每个查询描述子在每张图内取最近邻，次近邻取同图内检索到的第二近者做比值测试；
+    同图内没有第二个近邻时用 second（标量，或按查询描述子下标取值的数组）代替
+    """
+    if len(qi) == 0:
+        return {}
+    img = img_of[di]
+    order = np.lexsort((dist, img, qi))
+    qi, di, dist, img = qi[order], di[order], dist[order], img[order]
+    first = np.ones(len(qi), dtype=bool)
+    first[1:] = (qi[1:] != qi[:-1]) | (img[1:] != img[:-1])
+    starts = np.nonzero(first)[0]
+    ends = np.append(starts[1:], len(qi))
+    second = np.asarray(second)
+    fallback = second[qi[starts]] if second.ndim else second
+    second = np.where(ends - starts > 1, dist[np.minimum(starts + 1, len(qi) - 1)], fallback)
+    ok = dist[starts] < ratio * second
+    s = starts[ok]
+    m_img, m_q = img[s], qi[s]
+    m_t = di[s] - offsets[m_img]
+    out = {}
+    order = np.argsort(m_img, kind="stable")
+    m_img, m_q, m_t = m_img[order], m_q[order], m_t[order]
+    bounds = np.nonzero(np.diff(m_img))[0] + 1
+    for grp_q, grp_t, i in zip(np.split(m_q, bounds), np.split(m_t, bounds), m_img[np.r_[0, bounds]] if len(m_img) else []):
+        out[int(i)] = (grp_q, grp_t)
+    return out
+
+
+def rank_votes(per_img: dict, names, nprobe: int, exclude=None):
+    """{图片下标: (qidx, tidx)} 按匹配数投票，返回 Top-nprobe [(图片id, qidx, tidx)]"""
+    skip = {exclude} if isinstance(exclude, str) else set(exclude or ())
+    ranked = sorted(per_img.items(), key=lambda x: len(x[1][0]), reverse=True)
+    return [(names[i], q, t) for i, (q, t) in ranked if names[i] not in skip][:nprobe]
+
+
+class MIHIndex:
+    def __init__(self, keys, ids, des, img_of, offsets, names, m=N_TABLES):
+        self.keys = keys        # m 个 (N,) uint32，已排序
+        self.ids = ids          # m 个 (N,) uint32，对应的描述子下标
+        self.des = des          # (N,32) 全图库描述子（特征库 memmap）
+        self.img_of = img_of    # (N,) int32 描述子所属图片
+        self.offsets = offsets  # 每张图在 des 中的起始位置
+        self.names = list(names)
+        self.m = m
+
+    @classmethod
+    def build(cls, gallery, m: int = None) -> "MIHIndex":
+        des = gallery.des
+        m = m or tables_for(len(des))
+        sub = _substrings(np.asarray(des), m)
+        keys, ids = [], []
+        for t in range(m):
+            order = np.argsort(sub[:, t], kind="stable").astype(np.uint32)
+            keys.append(sub[order, t])
+            ids.append(order)
+        img_of = np.repeat(np.arange(len(gallery), dtype=np.int32), gallery.counts)
+        return cls(keys, ids, des, img_of, gallery.offsets, gallery.ids, m)
+
+    def nbytes(self) -> int:
+        """索引本身（不含描述子）的内存占用"""
+        return sum(k.nbytes + i.nbytes for k, i in zip(self.keys, self.ids)) + self.img_of.nbytes
+
+    def save(self, out: Path):
+        out = Path(out)
+        out.mkdir(parents=True, exist_ok=True)
+        for t in range(self.m):
+            np.save(out / f"keys_{t}.npy", self.keys[t])
+            np.save(out / f"ids_{t}.npy", self.ids[t])
+        with open(out / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"m": self.m, "n_des": int(len(self.des)), "names": self.names}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, out: Path, gallery) -> "MIHIndex":
+        out = Path(out)
+        with open(out / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["names"] != list(gallery.ids) or meta["n_des"] != len(gallery.des):
+            raise ValueError(f"{out} is stale; rebuild with python src/mih.py build")
+        m = meta["m"]
+        keys = [np.load(out / f"keys_{t}.npy", mmap_mode="r") for t in range(m)]
+        ids = [np.load(out / f"ids_{t}.npy", mmap_mode="r") for t in range(m)]
+        img_of = np.repeat(np.arange(len(gallery), dtype=np.int32), gallery.counts)
+        return cls(keys, ids, gallery.des, img_of, gallery.offsets, gallery.ids, m)
+
+    def neighbours(self, des_q: np.ndarray, max_dist: int = MAX_DIST, probe: int = 0, max_bucket: int = MAX_BUCKET):
+        """
+        全图库近邻检索，返回 (q_idx, d_idx, dist)：查询描述子下标、图库描述子全局下标、汉明距离
+        距离 <= guaranteed_radius(self.m, probe) 的近邻全部返回（超过 max_bucket 而被跳过的桶除外），
+        更远（<= max_dist）的只返回碰巧命中的
+        """
+        q = np.ascontiguousarray(des_q, dtype=np.uint8)
+        qsub = _substrings(q, self.m)
+        nbits = 256 // self.m
+        flips = [np.uint32(0)] + ([np.uint32(1 << b) for b in range(nbits)] if probe else [])
+        pairs_q, pairs_d = [], []
+        for t in range(self.m):
+            for f in flips:
+                k = qsub[:, t] ^ f
+                lo = np.searchsorted(self.keys[t], k, side="left")
+                hi = np.searchsorted(self.keys[t], k, side="right")
+                big = hi - lo > max_bucket
+                if big.any():
+                    tracing.count("mih_skipped_buckets", int(big.sum()))
+                    hi = np.where(big, lo, hi)
+                pos, owner = _ranges_to_positions(lo, hi)
+                pairs_q.append(owner)
+                pairs_d.append(np.asarray(self.ids[t])[pos])
+        if not pairs_q:
+            return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int32)
+        qi = np.concatenate(pairs_q).astype(np.int64)
+        di = np.concatenate(pairs_d).astype(np.int64)
+        # 同一对 (查询描述子, 图库描述子) 可能在多张表中命中，去重
+        uniq = np.unique(qi * len(self.des) + di)
+        qi, di = uniq // len(self.des), uniq % len(self.des)
+        dist = hamming_rows(q[qi], np.asarray(self.des[di]))
+        keep = dist <= max_dist
+        return qi[keep], di[keep], dist[keep]
+
+    def match(self, des_q: np.ndarray, ratio: float = RATIO_TEST_THRESHOLD, max_dist: int = MAX_DIST,
+              probe: int = 0):
+        """
+        返回 {图片下标: (qidx, tidx)}：每个查询描述子在每张图内取最近邻，
+        次近邻取同图内检索到的第二近者（没有则用全图库第 SECOND_K 近的候选距离估计）做比值测试
+        """
+        with tracing.span("mih_lookup"):
+            qi, di, dist = self.neighbours(des_q, max_dist, probe)
+        tracing.count("mih_neighbours", len(qi))
+        if len(qi) == 0:
+            return {}
+        second = kth_distance(qi, dist, len(des_q), SECOND_K, max_dist + 1)
+        return per_image_matches(qi, di, dist, self.img_of, self.offsets, ratio, second)
+
+    def vote(self, des_q: np.ndarray, nprobe: int, exclude=None, **kw):
+        """
+        按比值测试通过的匹配数投票，返回 Top-nprobe [(图片id, qidx, tidx)]
+        exclude 为单个图片 id 或 id 集合（如分段图库中已删除的图片）
+        """
+        return rank_votes(self.match(des_q, **kw), self.names, nprobe, exclude)
+
+
+def load_or_build(gallery, out: Path = MIH_DIR) -> MIHIndex:
+    try:
+        return MIHIndex.load(out, gallery)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"MIH index unavailable ({e}); building in memory", file=sys.stderr)
+        return MIHIndex.build(gallery)
+
+
+# ---------------- 评测：合成图库 ----------------
+
+class _SynthGallery:
+    """用真实描述子随机翻转若干位，拼出指定规模的图库（只在内存中，不写特征库）"""
+
+    def __init__(self, base, n_images: int, per_image: int, flip_bits: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        src = np.asarray(base.des)
+        self.counts = np.full(n_images, per_image, dtype=np.int64)
+        self.offsets = np.arange(n_images, dtype=np.int64) * per_image
+        self.ids = [f"synth_{i}" for i in range(n_images)]
+        self.des = src[rng.integers(len(src), size=n_images * per_image)]
+        _flip(self.des, flip_bits, rng)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def _flip(des: np.ndarray, n_bits: int, rng):
+    """每个描述子随机翻转 n_bits 位（原地）"""
+    for _ in range(n_bits):
+        byte = rng.integers(32, size=len(des))
+        bit = rng.integers(8, size=len(des)).astype(np.uint8)
+        des[np.arange(len(des)), byte] ^= (np.uint8(1) << bit)
+
+
+def bench(args):
+    from src.hamming import match_many
+    base = open_gallery(FEAT_DIR)
+    rng = np.random.default_rng(1)
+    g = _SynthGallery(base, args.images, args.per_image, flip_bits=8)
+    t0 = time.time()
+    index = MIHIndex.build(g, m=args.tables)
+    t_build = time.time() - t0
+    lat, hits, bf_lat = [], [], []
+    for qi in rng.choice(len(g), size=args.queries, replace=False):
+        a = g.offsets[qi]
+        q = g.des[a:a + args.per_image].copy()
+        _flip(q, args.noise, rng)  # 查询 = 同一张图的描述子再加噪声
+        t0 = time.time()
+        top = index.vote(q, 5, probe=args.probe)
+        lat.append(time.time() - t0)
+        hits.append(bool(top) and top[0][0] == g.ids[qi])
+        if args.brute and len(bf_lat) < 3:
+            t0 = time.time()
+            match_many(q, [g.des[g.offsets[i]:g.offsets[i] + g.counts[i]] for i in range(len(g))])
+            bf_lat.append(time.time() - t0)
+    print(f"images={args.images} descriptors={len(g.des)} tables={index.m} probe={args.probe}")
+    print(f"  descriptors {g.des.nbytes / 2**20:.1f} MiB, index {index.nbytes() / 2**20:.1f} MiB, build {t_build:.2f}s")
+    print(f"  query p50 {np.median(lat) * 1000:.1f} ms, p95 {np.percentile(lat, 95) * 1000:.1f} ms, "
+          f"top-1 recall {np.mean(hits):.3f}")
+    if bf_lat:
+        print(f"  brute-force match_many {np.mean(bf_lat) * 1000:.1f} ms/query")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build")
+    b.add_argument("--tables", type=int, choices=[N_TABLES, SMALL_TABLES],
+                   help="substring tables (default: from the descriptor count)")
+    b.add_argument("--out", type=str, default=str(MIH_DIR))
+    e = sub.add_parser("bench")
+    e.add_argument("--images", type=int, default=10000)
+    e.add_argument("--per_image", type=int, default=500)
+    e.add_argument("--tables", type=int, choices=[N_TABLES, SMALL_TABLES],
+                   help="substring tables (default: from the descriptor count)")
+    e.add_argument("--probe", type=int, default=0, choices=[0, 1])
+    e.add_argument("--noise", type=int, default=8, help="bits flipped in query descriptors")
+    e.add_argument("--queries", type=int, default=20)
+    e.add_argument("--brute", action="store_true", help="also time brute-force match_many")
+    args = parser.parse_args()
+    if args.cmd == "bench":
+        bench(args)
+        return
+    gallery = open_gallery(FEAT_DIR)
+    t0 = time.time()
+    index = MIHIndex.build(gallery, m=args.tables)
+    index.save(Path(args.out))
+    print(f"MIH index: {len(gallery)} images, {len(gallery.des)} descriptors, "
+          f"{index.nbytes() / 2**20:.1f} MiB, build {time.time() - t0:.2f}s -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
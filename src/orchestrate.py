@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+进程内流水线编排：预处理、特征提取、索引构建与检索组成一张阶段依赖图，在同一个进程里执行，
+不再每一步都起一个解释器、重新 import cv2、重新打开特征库。
+  - 每个阶段声明 依赖阶段、输入路径、参数、输出路径。依赖完成后计算指纹
+    sha1(参数 + 输入文件的 路径/大小/mtime)，与 features/pipeline_state.json 中上次成功时的指纹相同
+    且输出都在时跳过该阶段；上游重跑并改写了输出，下游的指纹随之改变而重跑
+  - 依赖已满足的阶段在线程池中并行（预处理与提取互不依赖；bow / vlad / mih / flann 各索引互不依赖），
+    解码、ORB、矩阵运算都在 cv2 / numpy 中释放 GIL
+  - 某阶段失败时其下游标记为 blocked，其它分支照常完成
+  - 检索阶段没有输出文件（cache=False），每次都执行
+  - 每个阶段的状态（ran / skipped / failed / blocked）与耗时汇总输出
+指纹只看文件的大小与 mtime（与 extra_features.py 增量提取的快速路径相同），不读文件内容；
+提取阶段内部仍按 manifest 的内容哈希增量处理。
+用法（命令行入口见 cli.py）：
+  python src/cli.py run_all dataset/queries/q1.jpg --coarse bow
+  python src/cli.py run_all dataset/queries/q1.jpg --dry_run      # 只看哪些阶段会执行
+  python src/cli.py run_all dataset/queries/q1.jpg --force extract # 忽略指纹强制重跑某些阶段
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence
+
+from src.feature_store import FEAT_DIR, INDEX_FILE as STORE_INDEX, open_gallery, store_dir
+from src.pipeline import MAX_SIDE, list_images
+
+STATE_FILE = "pipeline_state.json"
+IMG_DIR = Path("dataset/images")
+PRE_DIR = Path("dataset/images_pre")
+INDEXES = ("bow", "vlad", "mih", "flann")
+# 各检索方式的快速阶段需要的索引
+COARSE_INDEX = {"bow": "bow", "vlad": "vlad", "flann": "flann"}
+BOW_PARAMS = {"k": 10, "depth": 4, "iters": 10, "sample": 200000}
+VLAD_PARAMS = {"k": 64, "dim": 256, "iters": 10, "sample": 200000, "train_images": 4096}
+
+
+def path_fingerprint(path):
+    """文件：[大小, mtime]；目录：其下（不递归）每个文件的 [名字, 大小, mtime]；不存在："-" """
+    p = Path(path)
+    if p.is_file():
+        st = p.stat()
+        return [st.st_size, st.st_mtime_ns]
+    if p.is_dir():
+        return [[f.name, f.stat().st_size, f.stat().st_mtime_ns] for f in sorted(p.iterdir()) if f.is_file()]
+    return "-"
+
+
+class Stage:
+    def __init__(self, name: str, run: Callable, deps: Sequence[str] = (), inputs: Sequence = (),
+                 params: Optional[dict] = None, outputs: Sequence = (), cache: bool = True):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.inputs = [Path(p) for p in inputs]
+        self.params = params or {}
+        self.outputs = [Path(p) for p in outputs]
+        self.cache = cache
+
+    def fingerprint(self) -> str:
+        data = {"params": self.params, "inputs": {str(p): path_fingerprint(p) for p in self.inputs}}
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def outputs_exist(self) -> bool:
+        return all(p.exists() for p in self.outputs)
+
+
+class Pipeline:
+    """阶段依赖图；run() 返回每个阶段的 {name, status, seconds, result}，顺序同 stages"""
+
+    def __init__(self, stages: List[Stage], state_dir: Path = FEAT_DIR, workers: int = 2):
+        self.stages = {s.name: s for s in stages}
+        for s in stages:
+            missing = [d for d in s.deps if d not in self.stages]
+            if missing:
+                raise ValueError(f"stage {s.name} depends on unknown stage(s) {', '.join(missing)}")
+        self.state_path = Path(state_dir) / STATE_FILE
+        self.workers = workers
+        self._lock = threading.Lock()
+
+    def _load_state(self) -> dict:
+        if not self.state_path.exists():
+            return {}
+        with open(self.state_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_state(self, state: dict):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_path.with_suffix(".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=1)
+        os.replace(tmp, self.state_path)
+
+    def _closure(self, targets) -> List[str]:
+        """targets 及其全部上游，按依赖顺序"""
+        order, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for d in self.stages[name].deps:
+                visit(d)
+            order.append(name)
+        for t in targets:
+            visit(t)
+        return order
+
+    def _execute(self, stage: Stage, state: dict, force: bool) -> dict:
+        t0 = time.perf_counter()
+        fp = stage.fingerprint() if stage.cache else None
+        if fp is not None and not force and state.get(stage.name, {}).get("fingerprint") == fp \
+                and stage.outputs_exist():
+            return {"status": "skipped", "seconds": time.perf_counter() - t0, "result": None}
+        result = stage.run()
+        seconds = time.perf_counter() - t0
+        if fp is not None:
+            with self._lock:
+                state[stage.name] = {"fingerprint": fp, "seconds": round(seconds, 3), "finished": time.time()}
+                self._save_state(state)
+        return {"status": "ran", "seconds": seconds, "result": result}
+
+    def plan(self, targets=None, force=()) -> List[dict]:
+        """不执行，只报告每个阶段当前会跳过还是执行（上游要执行时下游记为 pending）"""
+        state = self._load_state()
+        out, todo = [], set()
+        for name in self._closure(targets or list(self.stages)):
+            s = self.stages[name]
+            if any(d in todo for d in s.deps):
+                status = "pending"
+            elif s.cache and name not in force and s.outputs_exist() \
+                    and state.get(name, {}).get("fingerprint") == s.fingerprint():
+                status = "skip"
+            else:
+                status = "run"
+            if status != "skip":
+                todo.add(name)
+            out.append({"name": name, "status": status})
+        return out
+
+    def run(self, targets=None, force=()) -> List[dict]:
+        """
+        执行 targets（默认全部）及其上游；force 中的阶段忽略指纹重跑。
+        依赖满足的阶段并行提交，任一阶段完成后再检查哪些阶段可以开始
+        """
+        names = self._closure(targets or list(self.stages))
+        state = self._load_state()
+        report = {}
+        pending = list(names)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as ex:
+            while pending or running:
+                for name in list(pending):
+                    deps = [report.get(d) for d in self.stages[name].deps]
+                    if any(r is not None and r["status"] in ("failed", "blocked") for r in deps):
+                        report[name] = {"status": "blocked", "seconds": 0.0, "result": None}
+                        pending.remove(name)
+                    elif all(r is not None for r in deps):
+                        running[ex.submit(self._execute, self.stages[name], state, name in force)] = name
+                        pending.remove(name)
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    name = running.pop(fut)
+                    try:
+                        report[name] = fut.result()
+                    except Exception as e:  # 单个阶段失败不影响其它分支
+                        report[name] = {"status": "failed", "seconds": 0.0, "result": None,
+                                        "error": f"{type(e).__name__}: {e}"}
+        return [dict(report[n], name=n) for n in names]
+
+
+def print_report(report: List[dict], wall: float):
+    for r in report:
+        line = f"  {r['name']:10s} {r['status']:8s} {r['seconds']:8.2f}s"
+        if r.get("error"):
+            line += "  " + r["error"]
+        print(line)
+    print(f"  {'total':10s} {'':8s} {wall:8.2f}s (wall)")
+
+
+# ---------------- 默认流水线 ----------------
+
+def _preprocess(src: Path, feat_dir: Path, max_side: int):
+    from src.preprocess import preprocess_all
+    return preprocess_all(src, PRE_DIR, feat_dir, max_side)
+
+
+def _extract(src: Path, feat_dir: Path, max_side: int, workers: int, dedup: bool):
+    from src.extra_features import extract_to_store
+    files = list_images(src)
+    if dedup:
+        from src.dedup import load_clusters
+        dups = load_clusters(feat_dir)
+        files = [p for p in files if dups is None or p.stem not in dups.hidden]
+    stats, n_new, n_removed, n_failed = extract_to_store(files, store_dir(feat_dir), workers=workers,
+                                                         max_side=max_side)
+    print(f"Feature store -> {store_dir(feat_dir)}: extracted {n_new}, removed {n_removed}, "
+          f"unchanged {len(stats) - n_new}, unreadable {n_failed}")
+    return len(stats)
+
+
+def _build_index(name: str, feat_dir: Path):
+    gallery = open_gallery(feat_dir)
+    out = feat_dir / name if name != "vlad" else feat_dir / "global"
+    if name == "bow":
+        from src.vocab import INDEX_FILE, VOCAB_FILE, train_bow
+        vocab, index = train_bow(gallery, **BOW_PARAMS)
+        out.mkdir(parents=True, exist_ok=True)
+        vocab.save(out / VOCAB_FILE)
+        index.save(out / INDEX_FILE)
+    elif name == "vlad":
+        from src.global_desc import MODEL_FILE, train_global
+        model, index = train_global(gallery, **VLAD_PARAMS)
+        out.mkdir(parents=True, exist_ok=True)
+        model.save(out / MODEL_FILE)
+        index.save(out)
+    elif name == "mih":
+        from src.mih import MIHIndex
+        MIHIndex.build(gallery).save(out)
+    else:
+        from src.matchers import FlannLSHIndex
+        FlannLSHIndex.build(gallery).save(out)
+    return len(gallery)
+
+
+def _index_params(name: str) -> dict:
+    if name == "bow":
+        return BOW_PARAMS
+    if name == "vlad":
+        return VLAD_PARAMS
+    if name == "flann":
+        from src.matchers import LSH_KEY_SIZE, LSH_MULTI_PROBE, LSH_TABLES
+        return {"tables": LSH_TABLES, "key_size": LSH_KEY_SIZE, "multi_probe": LSH_MULTI_PROBE}
+    from src.mih import N_TABLES, SMALL_MAX_DES, SMALL_TABLES
+    return {"tables": N_TABLES, "small_tables": SMALL_TABLES, "small_max_des": SMALL_MAX_DES}
+
+
+def _index_outputs(name: str, feat_dir: Path) -> list:
+    if name == "bow":
+        from src.vocab import INDEX_FILE, VOCAB_FILE
+        return [feat_dir / "bow" / VOCAB_FILE, feat_dir / "bow" / INDEX_FILE]
+    if name == "vlad":
+        from src.global_desc import MODEL_FILE, VECTORS_FILE
+        return [feat_dir / "global" / MODEL_FILE, feat_dir / "global" / VECTORS_FILE]
+    if name == "flann":
+        from src.matchers import INDEX_FILE
+        return [feat_dir / "flann" / INDEX_FILE, feat_dir / "flann" / "meta.json"]
+    return [feat_dir / "mih" / "meta.json"]
+
+
+def _search(query: Path, feat_dir: Path, coarse: str, topk: int, nprobe: int, verify: str):
+    from src import search_two_stage
+    from src.query_cache import default_cache
+    gallery = open_gallery(feat_dir)
+    pts, des = default_cache().get_path(query)
+    if des is None:
+        raise ValueError(f"cannot read query {query}")
+    kw = {}
+    if coarse == "bow":
+        from src.vocab import load_bow
+        kw["bow"] = load_bow(feat_dir / "bow")
+    elif coarse == "vlad":
+        from src.global_desc import load_global
+        kw["glob"] = load_global(feat_dir / "global")
+    elif coarse == "flann":
+        from src.matchers import FlannLSHIndex
+        kw["flann"] = FlannLSHIndex.load(feat_dir / "flann", gallery)
+    return search_two_stage.search(gallery, pts, des, topk, nprobe, coarse=coarse, verify=verify, **kw)
+
+
+def default_graph(query: Optional[Path] = None, src: Path = IMG_DIR, feat_dir: Path = FEAT_DIR,
+                  max_side: int = MAX_SIDE, coarse: str = "match", indexes: Sequence[str] = (), topk: int = 5,
+                  nprobe: int = 30, verify: str = "homography", workers: int = 1, dedup: bool = False) -> List[Stage]:
+    """
+    preprocess ─┐(dedup 时)
+    extract ────┴─> bow / vlad / mih / flann（indexes，加上 coarse 需要的那个）─> search（给了 query 时）
+    """
+    from src.dedup import CLUSTERS_FILE, DHASH_RADIUS, HASH_FILE, PHASH_RADIUS
+    from src.extra_features import extract_params
+    src, feat_dir = Path(src), Path(feat_dir)
+    stages = [
+        Stage("preprocess", lambda: _preprocess(src, feat_dir, max_side), inputs=[src],
+              params={"max_side": max_side, "phash_radius": PHASH_RADIUS, "dhash_radius": DHASH_RADIUS},
+              outputs=[PRE_DIR, feat_dir / HASH_FILE, feat_dir / CLUSTERS_FILE]),
+        Stage("extract", lambda: _extract(src, feat_dir, max_side, workers, dedup),
+              deps=["preprocess"] if dedup else [],
+              inputs=[src] + ([feat_dir / CLUSTERS_FILE] if dedup else []),
+              params=dict(extract_params(max_side), dedup=dedup),
+              outputs=[store_dir(feat_dir) / STORE_INDEX]),
+    ]
+    needed = list(dict.fromkeys(list(indexes) + ([COARSE_INDEX[coarse]] if coarse in COARSE_INDEX else [])))
+    for name in needed:
+        stages.append(Stage(name, lambda name=name: _build_index(name, feat_dir), deps=["extract"],
+                            inputs=[store_dir(feat_dir)],
+                            params=_index_params(name),
+                            outputs=_index_outputs(name, feat_dir)))
+    if query is not None:
+        deps = ["extract"] + ([COARSE_INDEX[coarse]] if coarse in COARSE_INDEX else [])
+        stages.append(Stage("search", lambda: _search(Path(query), feat_dir, coarse, topk, nprobe, verify),
+                            deps=deps, cache=False))
+    return stages
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+融合的流式预处理 + 提取：解码 -> 缩放到 MAX_SIDE -> 灰度 -> ORB 全部在内存中完成，
+不再经过 dataset/images_pre 的 JPEG 中转（省一次解码、一次有损重编码和一份磁盘占用）。
+  - decode_gray：源图远大于 MAX_SIDE 时用 cv2.IMREAD_REDUCED_GRAYSCALE_{2,4,8} 降采样解码
+  - stream_features：生成器，读文件与解码+ORB 分别在两个有界队列的线程池中进行，I/O 与计算重叠
+preprocess.py 写出的预处理图只用于可视化，提取不再依赖它。
+用法：
+  python src/pipeline.py dataset/images          # 流式提取并打印吞吐
+"""
+import hashlib
+import io
+import itertools
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.feature_store import KP_DIM
+from src import tracing
+
+MAX_SIDE = 800
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+_REDUCED = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+            (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+
+try:
+    from PIL import Image
+except ImportError:  # 没有 Pillow 时无法只读文件头，退化为全尺寸解码
+    Image = None
+
+
+def image_size(data: bytes):
+    """只解析文件头得到 (w, h)；无法判断时返回 None"""
+    if Image is None:
+        return None
+    try:
+        return Image.open(io.BytesIO(data)).size
+    except Exception:
+        return None
+
+
+def decode_gray(data: bytes, max_side: int = MAX_SIDE):
+    """
+    从编码字节解码为最长边不超过 max_side 的灰度图；解码失败返回 None
+    源图最长边至少是 max_side 的 2/4/8 倍时，直接按该倍数降采样解码
+    """
+    with tracing.span("decode"):
+        buf = np.frombuffer(data, dtype=np.uint8)
+        flag = cv2.IMREAD_GRAYSCALE
+        size = image_size(data) if max_side else None
+        if size is not None:
+            for factor, reduced in _REDUCED:
+                if max(size) >= max_side * factor:
+                    flag = reduced
+                    break
+        img = cv2.imdecode(buf, flag)
+        if img is None:
+            return None
+        h, w = img.shape[:2]
+        scale = min(1.0, max_side / max(h, w)) if max_side else 1.0
+        if scale != 1.0:
+            img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        return img
+
+
+def detect(gray, detector):
+    """
+    对灰度图提取 ORB，返回 pts (N,6) float32 与 des (N,32) uint8
+    pts 的列为 x, y, size, angle, octave, response（feature_store.KP_FIELDS），供相似变换验证使用
+    特征按 response 从大到小排序：des[:n] 就是最强的 n 个特征（级联快速阶段直接切前缀）
+    """
+    with tracing.span("extract"):
+        kp, des = detector.detectAndCompute(gray, None)
+    if des is None:
+        des = np.empty((0, 32), dtype=np.uint8)
+    des = des.astype(np.uint8)
+    if kp:
+        pts = np.array([k.pt + (k.size, k.angle, k.octave, k.response) for k in kp], dtype=np.float32)
+        order = np.argsort(-pts[:, 5], kind="stable")
+        pts, des = pts[order], des[order]
+    else:
+        pts = np.empty((0, KP_DIM), dtype=np.float32)
+    return pts, des
+
+
+def load_gray(p: Path, max_side: int = MAX_SIDE):
+    """读文件并 decode_gray，返回 (sha1, gray)；gray 为 None 表示无法解码"""
+    data = Path(p).read_bytes()
+    return hashlib.sha1(data).hexdigest(), decode_gray(data, max_side)
+
+
+def list_images(src_dir: Path):
+    return sorted(p for p in Path(src_dir).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+
+
+_END = object()
+
+
+def bounded_map(fn, items, workers: int, prefetch: int):
+    """
+    有序的线程池 map：最多 prefetch 个任务在途（即有界队列），
+    上游是生成器时只按需拉取，不会一次把全部输入读进内存
+    """
+    it = iter(items)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        pending = deque(ex.submit(fn, x) for x in itertools.islice(it, max(1, prefetch)))
+        while pending:
+            fut = pending.popleft()
+            nxt = next(it, _END)
+            if nxt is not _END:
+                pending.append(ex.submit(fn, nxt))
+            yield fut.result()
+
+
+class _OrbPerThread(threading.local):
+    # ORB 对象不是线程安全的：每个计算线程各建一个
+    def __init__(self, params):
+        self.orb = cv2.ORB_create(**params)
+
+
+def stream_features(paths, orb_params: dict, max_side: int = MAX_SIDE, workers: int = 2,
+                    prefetch: int = 8, io_workers: int = 2, save_dir: Path = None):
+    """
+    生成器：按输入顺序产出 (path, sha1, pts, des)，解码失败时 pts/des 为 None
+    读文件（I/O 线程）与 解码+缩放+ORB（计算线程，cv2 释放 GIL）通过两级有界队列流水
+    save_dir 不为 None 时顺便把缩放后的灰度图写出（仅用于可视化）
+    """
+    local = _OrbPerThread(orb_params)
+
+    def read(p):
+        return p, Path(p).read_bytes()
+
+    def compute(item):
+        p, data = item
+        sha1 = hashlib.sha1(data).hexdigest()
+        gray = decode_gray(data, max_side)
+        if gray is None:
+            return p, sha1, None, None
+        if save_dir is not None:
+            cv2.imwrite(str(Path(save_dir) / Path(p).name), gray)
+        pts, des = detect(gray, local.orb)
+        return p, sha1, pts, des
+
+    raw = bounded_map(read, paths, io_workers, prefetch)
+    yield from bounded_map(compute, raw, workers, prefetch)
+
+
+if __name__ == "__main__":
+    from src.extra_features import ORB_PARAMS
+    src = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("dataset/images")
+    files = list_images(src)
+    t0 = time.time()
+    n_kp = sum(len(des) for _, _, _, des in stream_features(files, ORB_PARAMS) if des is not None)
+    dt = time.time() - t0
+    print(f"{len(files)} images in {dt:.2f}s ({len(files) / max(dt, 1e-9):.1f} img/s), {n_kp} keypoints")
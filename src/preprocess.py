@@ -2,38 +2,56 @@
 """
 预处理：从 dataset/images -> dataset/images_pre
 功能：统一最长边为 max_side（默认800），并灰度化保存
+特征提取已在内存中完成同样的缩放（见 pipeline.py），这里写出的图片只用于 match.py 等可视化，
+也可以在提取时加 --save-pre 顺便写出。
+同时为每张图计算感知哈希（dHash + pHash，见 dedup.py）写到 features/phash.npz，并聚类近重复图片
+（features/dedup.json），供 extra_features.py --dedup 与检索时的 --dedup 使用。
 用法：python src/preprocess.py
+（cli.py run_all 在进程内调用 preprocess_all，输入与参数不变时跳过，见 orchestrate.py）
 """
 import cv2
 from pathlib import Path
+from src import dedup
+from src.feature_store import FEAT_DIR
+from src.pipeline import MAX_SIDE, list_images, load_gray
 
 SRC_DIR = Path("dataset/images")
 OUT_DIR = Path("dataset/images_pre")
-MAX_SIDE = 800
-
-OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 def preprocess_image(p: Path, out_dir: Path, max_side: int = MAX_SIDE):
-    img = cv2.imread(str(p))
-    if img is None:
+    # 与特征提取同一条解码+缩放路径，保证可视化坐标与特征点一致
+    _, gray = load_gray(p, max_side)
+    if gray is None:
         print("WARN: cannot read", p)
-        return
-    h, w = img.shape[:2]
-    scale = min(1.0, max_side / max(h, w))
-    if scale != 1.0:
-        img = cv2.resize(img, (int(w*scale), int(h*scale)))
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return None
     out_path = out_dir / p.name
     cv2.imwrite(str(out_path), gray)
+    return dedup.image_hashes(gray)
 
-def main():
-    files = sorted([p for p in SRC_DIR.iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png")])
+def preprocess_all(src_dir: Path = SRC_DIR, out_dir: Path = OUT_DIR, feat_dir: Path = FEAT_DIR,
+                   max_side: int = MAX_SIDE) -> int:
+    """预处理 src_dir 下全部图片，写出哈希与近重复簇，返回处理的图片数"""
+    files = list_images(src_dir)
     if not files:
-        print("No images found in", SRC_DIR)
-        return
+        print("No images found in", src_dir)
+        return 0
+    out_dir.mkdir(parents=True, exist_ok=True)
+    hashes = {}
     for p in files:
-        preprocess_image(p, OUT_DIR)
-    print("Preprocessed", len(files), "images ->", OUT_DIR)
+        h = preprocess_image(p, out_dir, max_side)
+        if h is not None:
+            hashes[p.stem] = h
+    print("Preprocessed", len(files), "images ->", out_dir)
+    feat_dir.mkdir(parents=True, exist_ok=True)
+    dedup.save_hashes(hashes, feat_dir)
+    clusters = dedup.cluster(hashes)
+    dedup.save_clusters(clusters, feat_dir)
+    print(f"Perceptual hashes -> {feat_dir / dedup.HASH_FILE}: {len(clusters)} representatives, "
+          f"{len(hashes) - len(clusters)} near-duplicates")
+    return len(files)
+
+def main():
+    preprocess_all()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+查询图片的进程内特征提取 + 有界 LRU 缓存：检索入口直接接受原始查询图片，
+用与建库相同的 解码 -> 缩放 -> ORB 流程（pipeline.decode_gray / detect）现场提取，
+不再要求先跑一次 extra_features.py，也不会因为与图库同名而读到图库里的特征。
+  - 缓存键 = 图片内容 sha1 + 提取参数（ORB 参数与 max_side）的哈希，参数变化后旧条目自然失效
+  - 内存层：OrderedDict LRU，最多 max_items 条
+  - 磁盘层（可选）：<disk_dir>/<key>.npz，最多 max_disk_items 个文件，按访问时间（mtime）淘汰
+重复或重试的查询不再付出提取开销。
+用法：
+  python src/query_cache.py dataset/queries/q1.jpg       # 提取（或命中缓存）并打印耗时
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.extra_features import ORB_PARAMS, extract_params
+from src.feature_store import FEAT_DIR
+from src.pipeline import MAX_SIDE, decode_gray, detect
+from src import tracing
+
+CACHE_DIR = FEAT_DIR / "query_cache"
+MAX_ITEMS = 256
+MAX_DISK_ITEMS = 10000
+
+
+def params_digest(max_side: int = MAX_SIDE) -> str:
+    return hashlib.sha1(json.dumps(extract_params(max_side), sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+class QueryFeatureCache:
+    """线程安全；get_bytes / get_path 返回 (pts, des)，解码失败时 (None, None)"""
+
+    def __init__(self, max_items: int = MAX_ITEMS, disk_dir=None, max_disk_items: int = MAX_DISK_ITEMS,
+                 max_side: int = MAX_SIDE):
+        self.max_items = max_items
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.max_disk_items = max_disk_items
+        self.max_side = max_side
+        self.params = params_digest(max_side)
+        self.hits = self.disk_hits = self.misses = 0
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._disk_count = None
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    def _orb(self):
+        # ORB 对象不是线程安全的，每个线程一个
+        if not hasattr(self._local, "orb"):
+            self._local.orb = cv2.ORB_create(**ORB_PARAMS)
+        return self._local.orb
+
+    def key(self, data: bytes) -> str:
+        return hashlib.sha1(data).hexdigest() + "-" + self.params
+
+    def _mem_get(self, key):
+        with self._lock:
+            v = self._mem.get(key)
+            if v is not None:
+                self._mem.move_to_end(key)
+            return v
+
+    def _mem_put(self, key, value):
+        with self._lock:
+            self._mem[key] = value
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+
+    def _disk_get(self, key):
+        p = self.disk_dir / (key + ".npz")
+        try:
+            with np.load(p) as a:
+                value = (a["pts"], a["des"])
+            os.utime(p)  # 记录访问时间，供 LRU 淘汰
+            return value
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+
+    def _disk_put(self, key, pts, des):
+        tmp = self.disk_dir / (key + ".tmp.npz")
+        np.savez(tmp, pts=pts, des=des)
+        os.replace(tmp, self.disk_dir / (key + ".npz"))
+        with self._lock:
+            if self._disk_count is None:
+                self._disk_count = sum(1 for _ in self.disk_dir.glob("*.npz"))
+            else:
+                self._disk_count += 1
+            over = self._disk_count - self.max_disk_items
+        if over > 0:
+            # 一次多淘汰 10%，避免之后每次写入都重新扫描目录
+            self._evict_disk(over + self.max_disk_items // 10)
+
+    def _evict_disk(self, n: int):
+        files = sorted(self.disk_dir.glob("*.npz"), key=lambda p: p.stat().st_mtime)
+        for p in files[:n]:
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._disk_count = max(0, self._disk_count - n)
+
+    def get_bytes(self, data: bytes):
+        key = self.key(data)
+        v = self._mem_get(key)
+        if v is not None:
+            self.hits += 1
+            tracing.count("query_cache_hit")
+            return v
+        if self.disk_dir is not None:
+            v = self._disk_get(key)
+            if v is not None:
+                self.disk_hits += 1
+                tracing.count("query_cache_disk_hit")
+                self._mem_put(key, v)
+                return v
+        self.misses += 1
+        tracing.count("query_cache_miss")
+        gray = decode_gray(data, self.max_side)
+        if gray is None:
+            return None, None
+        pts, des = detect(gray, self._orb())
+        self._mem_put(key, (pts, des))
+        if self.disk_dir is not None:
+            self._disk_put(key, pts, des)
+        return pts, des
+
+    def get_path(self, path):
+        with tracing.span("load_features"):
+            data = Path(path).read_bytes()
+        return self.get_bytes(data)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "items": len(self._mem)}
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_cache(disk: bool = True) -> QueryFeatureCache:
+    """进程内共享的缓存（检索 CLI 使用，磁盘层在 features/query_cache/）"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = QueryFeatureCache(disk_dir=CACHE_DIR if disk else None)
+        return _default
+
+
+if __name__ == "__main__":
+    cache = default_cache()
+    for arg in sys.argv[1:]:
+        t0 = time.perf_counter()
+        pts, des = cache.get_path(arg)
+        n = 0 if des is None else len(des)
+        print(f"{arg}: {n} keypoints in {(time.perf_counter() - t0) * 1000:.1f} ms {cache.stats()}")
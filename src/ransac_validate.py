@@ -1,88 +1,196 @@
 #!/usr/bin/env python3
 """
 使用 RANSAC (findHomography) 对 matches 做几何验证，返回内点数和 mask。
+rerank 的 verify 参数可以换成更便宜的相似变换 Hough 验证（见 hough.py）：
+  homography  逐候选 findHomography（默认）
+  prefilter   先对全部候选做一次向量化 Hough 验证，不一致的候选不再进入 RANSAC
+  similarity  只做 Hough 验证，分数为相似变换内点数（可以把 nprobe 提高到几百）
+逐个候选的提示信息（⚠️/🔍/✅）默认不输出，设置环境变量 FR_VERBOSE=1 时才打印；
+阶段耗时与内点数统计见 tracing.py。
 示例：python src/ransac_validate.py features/0001.npz features/0002.npz
 """
 import numpy as np
 import cv2
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
-from typing import Tuple, List, Optional, Union
+from typing import Sequence, Tuple, List, Optional, Union
+from src.feature_store import KP_DIM, load_from_store
+from src.hamming import ratio_match
+from src.hough import similarity_inliers
+from src.match import Matches
+from src import tracing
 
 # ========== 原有核心配置：完全保留 ==========
 RANSAC_REPROJ_THRESHOLD = 5.0
 MATCHER_NORM_TYPE = cv2.NORM_HAMMING
 RATIO_TEST_THRESHOLD = 0.75
+RERANK_WORKERS = 4  # 并行 RANSAC 线程数（cv2.findHomography 会释放 GIL）
+VERIFY_MODES = ("homography", "prefilter", "similarity")
+PREFILTER_MIN_INLIERS = 4  # Hough 内点数低于该值的候选不做 RANSAC（单应至少需要 4 对点）
+VERBOSE = os.environ.get("FR_VERBOSE", "") not in ("", "0")
+
+def _log(msg: str):
+    # 检索时每个候选都会经过这里，print 本身就是可测的开销，默认关闭
+    if VERBOSE:
+        print(msg)
 
 def load_kps_des(npz_path: Union[str, Path]) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
     """
     加载npz文件中的特征点(pts)和描述子(des)
     优化：补充des格式规范，解决None和维度异常问题
+    features/<stem>.npz 已在合并式特征库中时直接返回特征库里的 memmap 视图
     """
     npz_path = Path(npz_path)
-    if not npz_path.exists():
-        print(f"❌ 错误：文件 {npz_path} 不存在")
+    with tracing.span("load_features"):
+        return _load_kps_des(npz_path)
+
+def _load_kps_des(npz_path: Path):
+    stored = load_from_store(npz_path)
+    if stored is None and not npz_path.exists():
+        print(f"❌ 错误：文件 {npz_path} 不存在", file=sys.stderr)
         return None, None
     
     try:
-        a = np.load(npz_path, allow_pickle=True)
-        pts = a.get("pts")
-        des = a.get("des")
+        if stored is not None:
+            pts, des = stored
+        else:
+            a = np.load(npz_path, allow_pickle=True)
+            pts = a.get("pts")
+            des = a.get("des")
         
         # ========== 优化点1：补充des None判断和格式兜底 ==========
         if pts is None:
-            pts = np.empty((0, 2), dtype=np.float32)
+            pts = np.empty((0, KP_DIM), dtype=np.float32)
         if des is None:
             des = np.empty((0, 32), dtype=np.uint8)  # ORB标准空描述子
-            print(f"⚠️ 警告：文件 {npz_path} 的des为None，已兜底为空数组")
+            _log(f"⚠️ 警告：文件 {npz_path} 的des为None，已兜底为空数组")
         
         # ========== 优化点2：补充des合法性校验（维度+长度） ==========
         if len(pts) == 0 or len(des) == 0:
-            print(f"⚠️ 警告：文件 {npz_path} 的特征点/描述子为空")
+            _log(f"⚠️ 警告：文件 {npz_path} 的特征点/描述子为空")
             return pts, des  # 不再返回None，返回空数组，兼容后续逻辑
         # 校验ORB描述子维度（32维），避免维度不匹配导致knnMatch失败
         if des.ndim == 2 and des.shape[1] != 32:
-            print(f"⚠️ 警告：文件 {npz_path} 的des非ORB标准32维，维度为{des.shape[1]}")
+            _log(f"⚠️ 警告：文件 {npz_path} 的des非ORB标准32维，维度为{des.shape[1]}")
         
         return pts, des
     except Exception as e:
-        print(f"❌ 错误：读取 {npz_path} 失败 - {str(e)}")
+        print(f"❌ 错误：读取 {npz_path} 失败 - {str(e)}", file=sys.stderr)
         return None, None
 
-def get_good_matches(des1: np.ndarray, des2: np.ndarray) -> List[cv2.DMatch]:
+def get_good_matches(des1: np.ndarray, des2: np.ndarray) -> Matches:
     """
-    生成高质量匹配对（BF匹配器 + 比值测试）
-    优化：增加异常捕获，解决大量knnMatch警告
+    生成高质量匹配对（汉明距离 2-NN + 比值测试，见 hamming.py），以下标数组返回（不生成 DMatch）
     """
     # ========== 优化点3：先校验des1/des2有效性，避免无效调用knnMatch ==========
     if des1 is None or des2 is None or len(des1) == 0 or len(des2) == 0:
-        print("⚠️ 警告：无效的描述子，无法进行匹配")
-        return []
-    # 类型规范化，兼容ORB uint8类型
-    des1_norm = des1.astype(np.float32) if des1.dtype != np.float32 else des1
-    des2_norm = des2.astype(np.float32) if des2.dtype != np.float32 else des2
-
-    bf = cv2.BFMatcher(MATCHER_NORM_TYPE, crossCheck=False)
-    raw_matches = []
-    try:
-        # ========== 原有核心逻辑：knnMatch + 比值测试 ==========
-        raw_matches = bf.knnMatch(des1_norm, des2_norm, k=2)
-    except cv2.error as e:
-        print(f"⚠️ 匹配警告：knnMatch执行失败 - {str(e)[:100]}")
-        return []
-
-    good_matches = []
-    # 优化：增加m的长度判断，避免索引越界
-    for m_pair in raw_matches:
-        if len(m_pair) == 2:
-            m, n = m_pair
-            if m.distance < RATIO_TEST_THRESHOLD * n.distance:
-                good_matches.append(m)
+        _log("⚠️ 警告：无效的描述子，无法进行匹配")
+        return Matches.empty()
+    # 直接在 uint8 描述子上做汉明距离 2-NN + 比值测试（不再转 float32）
+    good_matches = Matches(*ratio_match(des1, des2, RATIO_TEST_THRESHOLD))
     
-    print(f"🔍 原始匹配数：{len(raw_matches)} | 筛选后good matches数：{len(good_matches)}")
+    _log(f"🔍 原始匹配数：{len(des1)} | 筛选后good matches数：{len(good_matches)}")
     return good_matches
 
-def ransac_inliers(npz1: Union[str, Path], npz2: Union[str, Path], good_matches: List[cv2.DMatch]) -> Tuple[int, Optional[np.ndarray]]:
+def verify_arrays(pts1: np.ndarray, pts2: np.ndarray, qidx: np.ndarray, tidx: np.ndarray) -> Tuple[int, Optional[np.ndarray]]:
+    """
+    数组版 RANSAC：pts1/pts2 为两张图的特征点 (N,2)，qidx/tidx 为匹配对的下标数组，
+    直接用花式索引取点，不经过 DMatch 对象，也不读文件
+    """
+    if pts1 is None or pts2 is None or len(qidx) < 4:
+        return 0, None
+    src = np.asarray(pts1, dtype=np.float32)[qidx, :2].reshape(-1, 1, 2)
+    dst = np.asarray(pts2, dtype=np.float32)[tidx, :2].reshape(-1, 1, 2)
+    with tracing.span("ransac"):
+        M, mask = cv2.findHomography(src, dst, cv2.RANSAC, RANSAC_REPROJ_THRESHOLD)
+    inliers = int(mask.sum()) if mask is not None else 0
+    tracing.count("ransac_verified")
+    tracing.count("inliers", inliers)
+    return inliers, mask
+
+def ransac_from_points(pts1: np.ndarray, pts2: np.ndarray,
+                       good_matches: Union[Matches, List[cv2.DMatch]]) -> Tuple[int, Optional[np.ndarray]]:
+    """
+    与 ransac_inliers 相同的 RANSAC 验证，但直接使用内存中的特征点数组（不读文件、不打印）
+    good_matches 为 match.Matches 时直接用其下标数组；兼容旧的 DMatch 列表
+    """
+    if isinstance(good_matches, Matches):
+        return verify_arrays(pts1, pts2, good_matches.qidx, good_matches.tidx)
+    qidx = np.fromiter((m.queryIdx for m in good_matches), dtype=np.int64, count=len(good_matches))
+    tidx = np.fromiter((m.trainIdx for m in good_matches), dtype=np.int64, count=len(good_matches))
+    return verify_arrays(pts1, pts2, qidx, tidx)
+
+_pools = {}
+
+def _get_pool(workers: int) -> ThreadPoolExecutor:
+    pool = _pools.get(workers)
+    if pool is None:
+        pool = _pools[workers] = ThreadPoolExecutor(max_workers=workers)
+    return pool
+
+def rerank(pts_q: np.ndarray, candidates: Sequence[tuple], topk: int, workers: int = RERANK_WORKERS,
+           verify: str = "homography") -> List[Tuple[str, int]]:
+    """
+    并行 RANSAC 精排 + 提前终止。candidates 为 [(图片id, pts, qidx, tidx)]。
+    内点数不会超过 good match 数，因此按匹配数从大到小分批验证：
+    当前第 K 名的内点数 >= 下一个候选的匹配数时，后面的候选不可能再进入 Top-K，直接停止。
+    返回 [(图片id, 内点数)]，按内点数降序（并列时 good match 多者在前，再按候选顺序）
+    verify 见模块说明；特征点没有尺度/方向（旧特征库）的候选始终走 RANSAC
+    """
+    if verify not in VERIFY_MODES:
+        raise ValueError(f"unknown verify mode {verify}")
+    if verify != "homography":
+        sim = similarity_inliers(pts_q, candidates)
+        if sim is not None:
+            if verify == "prefilter":
+                # 未通过的候选不做 RANSAC，按 0 个内点排在最后（与 RANSAC 找不到内点时的结果一致）
+                passed = [c for c, n in zip(candidates, sim) if n < 0 or n >= PREFILTER_MIN_INLIERS]
+                rejected = sorted((c for c, n in zip(candidates, sim) if 0 <= n < PREFILTER_MIN_INLIERS),
+                                  key=lambda c: len(c[2]), reverse=True)
+                out = rerank(pts_q, passed, topk, workers) if passed else []
+                return out + [(c[0], 0) for c in rejected[:topk - len(out)]]
+            else:
+                scored = [(int(n), -len(c[2]), i) for i, (c, n) in enumerate(zip(candidates, sim)) if n >= 0]
+                rest = [c for c, n in zip(candidates, sim) if n < 0]
+                scored.sort(key=lambda x: (-x[0], x[1], x[2]))
+                out = [(candidates[i][0], n) for n, _, i in scored[:topk]]
+                if rest:
+                    out = sorted(out + rerank(pts_q, rest, topk, workers), key=lambda x: -x[1])[:topk]
+                return out
+    with tracing.span("sort"):
+        order = sorted(range(len(candidates)), key=lambda i: len(candidates[i][2]), reverse=True)
+    if tracing.enabled():
+        tracing.count("rerank_candidates", len(candidates))
+        tracing.count("good_matches", sum(len(c[2]) for c in candidates))
+    pool = _get_pool(workers) if workers > 1 else None
+    scored = []   # (inliers, 在 order 中的名次)
+    best = []     # 当前 Top-K 内点数的小顶堆
+    pos = 0
+    while pos < len(order):
+        bound = len(candidates[order[pos]][2])
+        if len(best) >= topk and best[0] >= bound:
+            break
+        wave = range(pos, min(pos + max(1, workers), len(order)))
+        pos = wave.stop
+        args = [(pts_q,) + tuple(candidates[order[r]][1:4]) for r in wave]
+        if pool is not None:
+            counts = [res[0] for res in pool.map(tracing.bind(lambda a: verify_arrays(*a)), args)]
+        else:
+            counts = [verify_arrays(*a)[0] for a in args]
+        for r, n in zip(wave, counts):
+            scored.append((n, r))
+            if len(best) < topk:
+                heapq.heappush(best, n)
+            elif n > best[0]:
+                heapq.heapreplace(best, n)
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    return [(candidates[order[r]][0], n) for n, r in scored[:topk]]
+
+def ransac_inliers(npz1: Union[str, Path], npz2: Union[str, Path],
+                   good_matches: Union[Matches, List[cv2.DMatch]]) -> Tuple[int, Optional[np.ndarray]]:
     """
     原有逻辑完全保留，仅优化注释，不改变参数和返回值
     """
@@ -90,18 +198,15 @@ def ransac_inliers(npz1: Union[str, Path], npz2: Union[str, Path], good_matches:
     pts2, _ = load_kps_des(npz2)
     
     if pts1 is None or pts2 is None or len(good_matches) < 4:
-        print("⚠️ 跳过RANSAC：特征点不足或匹配数<4")
+        _log("⚠️ 跳过RANSAC：特征点不足或匹配数<4")
         return 0, None
     
-    src = np.float32([pts1[m.queryIdx] for m in good_matches]).reshape(-1, 1, 2)
-    dst = np.float32([pts2[m.trainIdx] for m in good_matches]).reshape(-1, 1, 2)
-    
-    M, mask = cv2.findHomography(src, dst, cv2.RANSAC, RANSAC_REPROJ_THRESHOLD)
-    inliers = int(mask.sum()) if mask is not None else 0
-    print(f"✅ RANSAC验证完成 | 内点数：{inliers} (内点数越高，图片越相似)")
+    inliers, mask = ransac_from_points(pts1, pts2, good_matches)
+    _log(f"✅ RANSAC验证完成 | 内点数：{inliers} (内点数越高，图片越相似)")
     return inliers, mask
 
 if __name__ == "__main__":
+    VERBOSE = True  # 命令行单次验证时保留原有的提示输出
     if len(sys.argv) != 3:
         print("❌ 用法错误！正确示例：")
         print("python src/ransac_validate.py features/0001.npz features/0002.npz")
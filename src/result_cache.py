@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+检索结果缓存：同一张（或重传的）查询图再次到来时，直接返回上次的 Top-K，不再跑快速阶段与 RANSAC。
+  - 缓存键 = 查询特征（pts + des 的字节）的 sha1 + 检索参数（topk、nprobe、比值阈值、RANSAC 阈值、模式……）
+  - 每个条目属于一个图库版本（gallery_version：分段图库的 generation / 特征库 index 的修改时间），
+    图库一变，旧版本的条目全部作废（内存层清空，磁盘层删除旧版本目录），不需要手动失效
+  - 内存层：OrderedDict LRU，按条目数（max_items）和/或字节数（max_bytes，按结果 JSON 大小计）淘汰
+  - 磁盘层（可选）：<disk_dir>/<版本哈希>/<key>.json，进程重启后仍可命中
+  - stats() 给出 hits / disk_hits / misses / evictions / invalidations，用于确定缓存大小
+检索函数通过 cached() 接入，见 search_two_stage.search(cache=...) 与 search_server.py --result_cache。
+用法：
+  python src/result_cache.py features/result_cache        # 查看磁盘层的版本与条目数
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from src.feature_store import FEAT_DIR, INDEX_FILE
+from src.hough import REPROJ_THRESHOLD as HOUGH_THRESHOLD
+from src.ransac_validate import RANSAC_REPROJ_THRESHOLD, RATIO_TEST_THRESHOLD
+from src import tracing
+
+RESULT_CACHE_DIR = FEAT_DIR / "result_cache"
+MAX_ITEMS = 1024
+
+
+def gallery_version(gallery) -> str:
+    """图库内容的版本号：图库有任何变化时都会改变"""
+    generation = getattr(gallery, "generation", None)
+    if generation is not None:
+        # 分段图库：每次写 manifest 都会增加 generation；再带上 mtime，防止删库重建后 generation 从头计数
+        from src.segments import MANIFEST_FILE
+        root = Path(gallery.root)
+        st = (root / MANIFEST_FILE).stat()
+        return f"segments:{root.resolve()}:{generation}:{st.st_mtime_ns}"
+    root = getattr(gallery, "root", None)
+    if root is not None:
+        st = (Path(root) / INDEX_FILE).stat()
+        return f"store:{Path(root).resolve()}:{st.st_mtime_ns}:{len(gallery)}"
+    # 逐个 .npz 组装的内存图库没有单一文件可看，用 id 列表与特征总数
+    ids = hashlib.sha1("\n".join(gallery.ids).encode("utf-8")).hexdigest()[:16]
+    return f"npz:{ids}:{len(gallery.des)}"
+
+
+def files_version(*paths) -> str:
+    """辅助索引（BoW / VLAD 等）文件的修改时间，索引重建后缓存键随之改变"""
+    return ":".join(str(Path(p).stat().st_mtime_ns) if Path(p).exists() else "-" for p in paths)
+
+
+def search_params(**kw) -> dict:
+    """缓存键里的检索参数：调用方给出的参数，加上影响结果的全局阈值（比值测试缺省值、RANSAC / Hough 重投影阈值）"""
+    kw.setdefault("ratio", RATIO_TEST_THRESHOLD)
+    return dict(kw, ransac=RANSAC_REPROJ_THRESHOLD, hough=HOUGH_THRESHOLD)
+
+
+def _digest(s: str) -> str:
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()[:16]
+
+
+class ResultCache:
+    """线程安全；条目为 [(图片id, 分数)]"""
+
+    def __init__(self, max_items: int = MAX_ITEMS, max_bytes: int = None, disk_dir=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.hits = self.disk_hits = self.misses = self.evictions = self.invalidations = 0
+        self.bytes = 0
+        self.version = None
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(pts, des, params: dict) -> str:
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(des).tobytes())
+        if pts is not None:
+            h.update(np.ascontiguousarray(pts, dtype=np.float32).tobytes())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+        return h.hexdigest()
+
+    def _switch(self, version: str):
+        # 调用方持有锁；图库变化：丢掉旧版本的全部条目
+        if self.version is not None:
+            self.invalidations += 1
+            self._mem.clear()
+            self.bytes = 0
+        self.version = version
+        if self.disk_dir is not None:
+            keep = _digest(version)
+            if self.disk_dir.exists():
+                for d in self.disk_dir.iterdir():
+                    if d.is_dir() and d.name != keep:
+                        shutil.rmtree(d, ignore_errors=True)
+
+    def _disk_path(self, version: str, key: str) -> Path:
+        return self.disk_dir / _digest(version) / (key + ".json")
+
+    def get(self, key: str, version: str):
+        with self._lock:
+            if version != self.version:
+                self._switch(version)
+            hit = self._mem.get(key)
+            if hit is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                tracing.count("result_cache_hit")
+                return hit[0]
+        if self.disk_dir is not None:
+            try:
+                data = self._disk_path(version, key).read_bytes()
+            except OSError:
+                data = None
+            if data is not None:
+                results = [tuple(r) for r in json.loads(data.decode("utf-8"))]
+                with self._lock:
+                    self.disk_hits += 1
+                    if version == self.version:
+                        self._insert(key, results, len(data))
+                tracing.count("result_cache_disk_hit")
+                return results
+        with self._lock:
+            self.misses += 1
+        tracing.count("result_cache_miss")
+        return None
+
+    def _insert(self, key, results, size):
+        # 调用方持有锁
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self._mem[key] = (results, size)
+        self.bytes += size
+        while self._mem and (len(self._mem) > self.max_items
+                             or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _, (_, n) = self._mem.popitem(last=False)
+            self.bytes -= n
+            self.evictions += 1
+
+    def put(self, key: str, version: str, results):
+        results = [(str(name), int(score)) for name, score in results]
+        data = json.dumps(results, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            # 只有 get() 让版本前进：按旧图库算完的慢请求晚于新版本写回时直接丢弃，
+            # 不能切回旧版本、清掉当前版本的条目与磁盘目录
+            if version != self.version:
+                return
+            self._insert(key, results, len(data))
+        if self.disk_dir is not None:
+            p = self._disk_path(version, key)
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_name(p.name + ".tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, p)
+
+    def cached(self, version: str, pts, des, params: dict, compute):
+        """命中直接返回，否则调用 compute() 并写入缓存"""
+        key = self.key(pts, des, params)
+        results = self.get(key, version)
+        if results is None:
+            results = compute()
+            self.put(key, version, results)
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+                    "items": len(self._mem), "bytes": self.bytes, "evictions": self.evictions,
+                    "invalidations": self.invalidations}
+
+
+if __name__ == "__main__":
+    root = Path(sys.argv[1]) if len(sys.argv) > 1 else RESULT_CACHE_DIR
+    if not root.exists():
+        print(f"{root} does not exist")
+        sys.exit(1)
+    for d in sorted(p for p in root.iterdir() if p.is_dir()):
+        files = list(d.glob("*.json"))
+        print(f"{d.name}: {len(files)} entries, {sum(f.stat().st_size for f in files)} bytes")
@@ -2,10 +2,21 @@
 """
 暴力检索：给定查询图的 features（或查询图片路径），遍历 features/ 目录对每张图片计算匹配并用 RANSAC 计数内点，
 按内点数排序返回 Top-K。
+--query_path 的图片在进程内提取特征（与建库相同的缩放 + ORB），结果按内容哈希缓存（见 query_cache.py），
+不需要事先运行 extra_features.py。
 用法：
   python src/search_bruteforce.py --query_path dataset/queries/q1.jpg --topk 5
 或先用 features 文件：
   python src/search_bruteforce.py --query_feat features/q1.npz --topk 5
+--engine mih 时不逐图匹配，改用多索引哈希（src/mih.py）在整个图库上一次性找近邻、按图投票，
+只对得票最多的 nprobe 张图做 RANSAC：
+  python src/search_bruteforce.py --query_path dataset/queries/q1.jpg --engine mih --nprobe 50
+--engine flann 同理，近邻改由预先训练并保存在 features/flann/ 的 FLANN LSH 索引给出（见 src/matchers.py）：
+  python src/search_bruteforce.py --query_path dataset/queries/q1.jpg --engine flann --nprobe 50
+批量（目录 / glob / 列表文件，JSONL 输出，见 src/batch.py）：
+  python src/search_bruteforce.py --queries dataset/queries --batch 32 > results.jsonl
+--dedup 时只匹配近重复簇的代表（features/dedup.json，见 src/dedup.py），结果再展开成簇内所有图片。
+阶段耗时（--trace [PATH] 或 FR_TRACE=1）与单次查询的 cProfile（--profile q.prof）见 src/tracing.py
 """
 import argparse
 import sys
@@ -13,8 +24,15 @@ from pathlib import Path
 import time
 import numpy as np
 import cv2
-from src.match import load_kps_and_des, match_descriptors
-from src.ransac_validate import ransac_inliers
+from src.match import load_features, match_descriptors
+from src.batch import BATCH_SIZE, run as run_batch
+from src.hamming import RATIO_TEST_THRESHOLD, match_batch, match_many
+from src.ransac_validate import RERANK_WORKERS, VERIFY_MODES, load_kps_des, rerank, verify_arrays
+from src.feature_store import load_from_store, open_gallery
+from src.matchers import load_backend
+from src.dedup import CLUSTERS_FILE, load_clusters
+from src.query_cache import default_cache
+from src import tracing
 
 FEAT_DIR = Path("features")
 
@@ -22,44 +40,134 @@ def features_for_image(img_path):
     # if given image path, assume features/<stem>.npz exists
     p = Path(img_path)
     feat = FEAT_DIR / (p.stem + ".npz")
-    if not feat.exists():
-        raise FileNotFoundError(f"{feat} not found; run extract_features.py first")
+    if not feat.exists() and load_from_store(feat) is None:
+        raise FileNotFoundError(f"{feat} not found; run extra_features.py first")
     return feat
 
 def score_query(query_feat_path, candidate_feat_path):
-    kp1, des1 = load_kps_and_des(query_feat_path)
-    kp2, des2 = load_kps_and_des(candidate_feat_path)
-    good = match_descriptors(des1, des2)
-    inliers, mask = ransac_inliers(query_feat_path, candidate_feat_path, good)
+    # 每个文件只读一次，匹配与 RANSAC 都在下标数组上完成（不生成 KeyPoint / DMatch）
+    q = load_features(query_feat_path)
+    c = load_features(candidate_feat_path)
+    good = match_descriptors(q.des, c.des)
+    inliers, _ = verify_arrays(q.pts, c.pts, good.qidx, good.tidx)
     return inliers
 
+def _skip(exclude, dups):
+    # 不参与匹配的图片：exclude，以及 dups（dedup.Clusters）中的非代表成员
+    return dups.skip(exclude) if dups is not None else {exclude}
+
+def _expand(results, topk, exclude, dups):
+    return dups.expand(results, topk, exclude) if dups is not None else results
+
+def search(gallery, pts_q, des_q, topk=5, exclude=None, workers=RERANK_WORKERS, ratio=RATIO_TEST_THRESHOLD,
+           verify="homography", dups=None):
+    """
+    在已加载的图库（FeatureStore）上逐图匹配 + RANSAC，返回 [(图片id, 内点数)] Top-K
+    RANSAC 按匹配数从大到小并行验证，Top-K 确定后剩余图片不再验证（结果与全部验证一致）
+    dups 为 dedup.Clusters 时只匹配各簇代表，结果展开到簇内所有图片
+    """
+    skip = _skip(exclude, dups)
+    idx = [i for i, name in enumerate(gallery.ids) if name not in skip]
+    matches = match_many(des_q, [gallery.get(i)[1] for i in idx], ratio)
+    candidates = [(gallery.ids[i], gallery.get(i)[0], qi, ti) for i, (qi, ti, _) in zip(idx, matches)]
+    return _expand(rerank(pts_q, candidates, topk, workers=workers, verify=verify), topk, exclude, dups)
+
+def search_batch(gallery, queries, topk=5, workers=RERANK_WORKERS, verify="homography", dups=None):
+    """
+    一批查询 [(pts, des, exclude)] 一起做逐图匹配（每张图库图片每批只参与一次矩阵乘），再逐个 RANSAC；
+    生成器，按顺序产出每个查询的 [(图片id, 内点数)]
+    """
+    # 只去掉所有查询都跳过的图片：某个查询排除了簇代表时，顶替它的成员仍要参与这一批的匹配
+    skips = [_skip(exclude, dups) for _, _, exclude in queries]
+    common = set.intersection(*skips) if skips else set()
+    idx = [i for i, name in enumerate(gallery.ids) if name not in common]
+    matches = match_batch([des for _, des, _ in queries], [gallery.get(i)[1] for i in idx])
+    for (pts_q, _, exclude), skip, per_img in zip(queries, skips, matches):
+        candidates = [(gallery.ids[i], gallery.get(i)[0], qi, ti)
+                      for i, (qi, ti, _) in zip(idx, per_img) if gallery.ids[i] not in skip]
+        yield _expand(rerank(pts_q, candidates, topk, workers=workers, verify=verify), topk, exclude, dups)
+
+def search_mih(gallery, index, pts_q, des_q, topk=5, nprobe=50, exclude=None, workers=RERANK_WORKERS, probe=0,
+               ratio=RATIO_TEST_THRESHOLD, verify="homography", dups=None):
+    """
+    用 MIH 索引（mih.MIHIndex，或 matchers 中的其它后端）在全图库上检索近邻并按图投票，
+    对 Top-nprobe 做 RANSAC，返回 [(图片id, 内点数)]
+    """
+    voted = index.vote(des_q, nprobe, exclude=_skip(exclude, dups), probe=probe, ratio=ratio)
+    candidates = [(name, gallery.get_by_name(name)[0], qi, ti) for name, qi, ti in voted]
+    return _expand(rerank(pts_q, candidates, topk, workers=workers, verify=verify), topk, exclude, dups)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--query_path", type=str, help="path to query image (dataset/queries/xxx.jpg)")
     parser.add_argument("--query_feat", type=str, help="path to query feature (.npz)")
     parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=RERANK_WORKERS, help="RANSAC threads")
+    parser.add_argument("--verify", choices=VERIFY_MODES, default="homography",
+                        help="geometric check: homography RANSAC, Hough similarity pre-filter, or similarity only")
+    parser.add_argument("--engine", choices=["brute", "mih", "flann"], default="brute",
+                        help="per-image matching, gallery-wide multi-index hashing or a prebuilt FLANN LSH index")
+    parser.add_argument("--nprobe", type=int, default=50, help="images verified by RANSAC with --engine mih/flann")
+    parser.add_argument("--probe", type=int, default=0, choices=[0, 1], help="MIH substring flip radius")
+    parser.add_argument("--dedup", action="store_true",
+                        help="match only near-duplicate cluster representatives, then expand (see src/dedup.py)")
+    parser.add_argument("--queries", type=str, help="batch mode: directory, glob or list file of queries (JSONL output)")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="queries per coarse-stage batch")
+    tracing.add_arguments(parser)
     args = parser.parse_args()
+    tracing.setup(args)
+    dups = None
+    if args.dedup:
+        dups = load_clusters(FEAT_DIR)
+        if dups is None:
+            print(f"{FEAT_DIR / CLUSTERS_FILE} not found; run python src/dedup.py build")
+            return
+
+    if args.queries:
+        gallery = open_gallery(FEAT_DIR)
+        if args.engine != "brute":
+            index = load_backend(args.engine, gallery, FEAT_DIR)
+            fn = lambda qs: (search_mih(gallery, index, pts, des, args.topk, args.nprobe, exclude=ex,
+                                        workers=args.workers, probe=args.probe, verify=args.verify, dups=dups)
+                             for pts, des, ex in qs)
+        else:
+            fn = lambda qs: search_batch(gallery, qs, args.topk, workers=args.workers, verify=args.verify, dups=dups)
+        run_batch(args.queries, fn, batch_size=args.batch)
+        return
 
     if args.query_feat:
         qfeat = Path(args.query_feat)
     elif args.query_path:
-        qfeat = features_for_image(args.query_path)
+        qfeat = Path(args.query_path)
     else:
         print("Provide --query_path or --query_feat")
         return
 
-    all_feats = sorted(FEAT_DIR.glob("*.npz"))
-    results = []
-    t0 = time.time()
-    for f in all_feats:
-        if f == qfeat: continue
-        score = score_query(qfeat, f)
-        results.append((f.name, score))
-    results.sort(key=lambda x: x[1], reverse=True)
+    gallery = open_gallery(FEAT_DIR)
+    index = load_backend(args.engine, gallery, FEAT_DIR) if args.engine != "brute" else None
+    with tracing.query(qfeat.name), tracing.profile(args.profile):
+        if args.query_feat:
+            pts_q, des_q = load_kps_des(qfeat)
+            exclude = qfeat.stem if qfeat.parent == FEAT_DIR else None
+        elif qfeat.exists():
+            pts_q, des_q = default_cache().get_path(qfeat)
+            exclude = None
+        else:
+            print(f"{qfeat} not found")
+            return
+        if des_q is None:
+            return
+        t0 = time.time()
+        if index is not None:
+            results = search_mih(gallery, index, pts_q, des_q, args.topk, args.nprobe, exclude=exclude,
+                                 workers=args.workers, probe=args.probe, verify=args.verify, dups=dups)
+        else:
+            results = search(gallery, pts_q, des_q, args.topk, exclude=exclude, workers=args.workers,
+                             verify=args.verify, dups=dups)
     elapsed = time.time() - t0
     print(f"Query {qfeat.name} done. elapsed {elapsed:.3f}s. Top-{args.topk}:")
-    for name, score in results[:args.topk]:
-        print(f"{name}\tinliers={score}")
+    for name, score in results:
+        print(f"{name}.npz\tinliers={score}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+search_server.py 的轻量客户端（标准库 http.client，特征上传用 numpy 编码），evaluate.py / cli.py / shards.py
+通过它查询常驻服务。
+地址写法：http://127.0.0.1:8765 或 unix:/tmp/feature-search.sock
+用法：
+  python src/search_client.py --query_path dataset/queries/q1.png --topk 5
+  python src/search_client.py --query_feat features/book_1.npz --mode brute
+"""
+import argparse
+import http.client
+import io
+import json
+import socket
+from pathlib import Path
+from urllib.parse import urlencode, urlparse
+
+import numpy as np
+
+DEFAULT_SERVER = "http://127.0.0.1:8765"
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class SearchClient:
+    def __init__(self, server: str = DEFAULT_SERVER, timeout: float = 60.0):
+        self.server = server
+        self.timeout = timeout
+
+    def _conn(self):
+        if self.server.startswith("unix:"):
+            return _UnixHTTPConnection(self.server[len("unix:"):], self.timeout)
+        u = urlparse(self.server)
+        return http.client.HTTPConnection(u.hostname, u.port or 80, timeout=self.timeout)
+
+    def _request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> dict:
+        conn = self._conn()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            data = json.loads(resp.read().decode("utf-8"))
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise RuntimeError(f"search server error {resp.status}: {data.get('error')}")
+        return data
+
+    def health(self) -> dict:
+        return self._request("GET", "/health")
+
+    def is_up(self) -> bool:
+        try:
+            self.health()
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    def search_bytes(self, data: bytes, topk=5, mode="two_stage", nprobe=30, coarse="match") -> dict:
+        q = urlencode({"topk": topk, "mode": mode, "nprobe": nprobe, "coarse": coarse})
+        return self._request("POST", "/search?" + q, body=data,
+                             headers={"Content-Type": "application/octet-stream"})
+
+    def search_image(self, image_path, **kw) -> dict:
+        return self.search_bytes(Path(image_path).read_bytes(), **kw)
+
+    def search_arrays(self, pts, des, topk=5, mode="two_stage", nprobe=30, coarse="match", verify="homography",
+                      exclude=None) -> dict:
+        """直接发送已提取的特征（服务端不再解码/提取），分片检索的协调端用它"""
+        return self.search_npz(encode_features(pts, des), topk=topk, mode=mode, nprobe=nprobe, coarse=coarse,
+                               verify=verify, exclude=exclude)
+
+    def search_npz(self, data: bytes, topk=5, mode="two_stage", nprobe=30, coarse="match", verify="homography",
+                   exclude=None) -> dict:
+        params = {"topk": topk, "mode": mode, "nprobe": nprobe, "coarse": coarse, "verify": verify}
+        if exclude is not None:
+            params["exclude"] = exclude
+        return self._request("POST", "/search?" + urlencode(params), body=data,
+                             headers={"Content-Type": "application/x-npz"})
+
+    def search_feat(self, feat_path, topk=5, mode="two_stage", nprobe=30, coarse="match") -> dict:
+        body = json.dumps({"query_feat": str(feat_path), "topk": topk, "mode": mode,
+                           "nprobe": nprobe, "coarse": coarse}).encode("utf-8")
+        return self._request("POST", "/search", body=body, headers={"Content-Type": "application/json"})
+
+
+def encode_features(pts, des) -> bytes:
+    """(pts, des) -> search_npz 的请求体；同一查询发往多个分片时只编码一次"""
+    buf = io.BytesIO()
+    np.savez(buf, pts=np.asarray(pts, dtype=np.float32), des=np.asarray(des, dtype=np.uint8))
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", type=str, default=DEFAULT_SERVER)
+    parser.add_argument("--query_path", type=str, help="query image, sent as bytes")
+    parser.add_argument("--query_feat", type=str, help="query feature (.npz) readable by the server")
+    parser.add_argument("--topk", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=30)
+    parser.add_argument("--mode", choices=["two_stage", "brute", "mih"], default="two_stage")
+    parser.add_argument("--coarse", choices=["match", "bow", "vlad"], default="match")
+    args = parser.parse_args()
+    client = SearchClient(args.server)
+    kw = dict(topk=args.topk, mode=args.mode, nprobe=args.nprobe, coarse=args.coarse)
+    if args.query_feat:
+        res = client.search_feat(args.query_feat, **kw)
+    elif args.query_path:
+        res = client.search_image(args.query_path, **kw)
+    else:
+        print("Provide --query_path or --query_feat")
+        return
+    print(f"elapsed {res['elapsed_ms']:.1f} ms. Top-{args.topk}:")
+    for r in res["results"]:
+        print(f"{r['name']}\tscore={r['score']}")
+
+
+if __name__ == "__main__":
+    main()
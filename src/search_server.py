@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+常驻检索服务：启动时一次性加载图库（特征库 memmap、BoW 索引），之后通过本地 HTTP
+（或 Unix socket）接受查询，省掉每次查询的解释器启动、cv2 导入与特征加载。
+features/segments/manifest.json 存在时使用分段图库（见 segments.py）：每次查询前检查 manifest，
+新增/删除的图片无需重启即可生效，--compact_interval 开启后台合并。
+接口：
+  GET  /health                         -> {"images": N, "bow": true/false, "vlad": true/false, "segments": ...,
+                                            "query_cache": {...}, "result_cache": {...}}
+  POST /search?topk=5&mode=two_stage&nprobe=30&coarse=match&verify=homography   （mode: two_stage / brute / mih）
+       请求体为图片字节（Content-Type: image/* 或 application/octet-stream），
+       或 JSON {"query_feat": "features/xxx.npz"}（参数也可以放在 JSON 里），
+       或已提取好的特征 np.savez(pts=..., des=...)（Content-Type: application/x-npz，可带 &exclude=图片id），
+       分片检索（shards.py）的协调端只提取一次查询特征，把描述子发给各分片
+       -> {"results": [{"name": ..., "score": ...}], "elapsed_ms": ...}
+查询在固定大小的线程池中执行（匹配与 RANSAC 都在 numpy/cv2 中释放 GIL）。
+同一查询（相同特征 + 参数）的结果按图库版本缓存（见 result_cache.py），图库变化后自动作废；
+--result_cache 0 关闭，--result_cache_dir 让缓存跨重启保留。
+设置 FR_TRACE=trace.jsonl 启动时，每个请求的各阶段耗时写入该文件（见 tracing.py）。
+用法：
+  python src/search_server.py --port 8765 --workers 4
+  python src/search_server.py --unix /tmp/feature-search.sock
+  python src/search_server.py --features features/shards/shard-00 --port 8801   # 只服务一个分片
+客户端见 search_client.py
+"""
+import argparse
+import io
+import json
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from src.feature_store import FEAT_DIR, open_gallery
+from src.pipeline import MAX_SIDE
+from src.query_cache import QueryFeatureCache
+from src.result_cache import MAX_ITEMS, ResultCache, files_version, gallery_version, search_params
+from src.ransac_validate import load_kps_des
+from src import search_bruteforce, search_two_stage, segments, tracing
+from src.mih import load_or_build
+from src.matchers import FLANN_DIR, INDEX_FILE as FLANN_FILE, load_flann
+from src.vocab import BOW_DIR, load_bow
+from src.global_desc import GLOBAL_DIR, VECTORS_FILE, load_global
+
+DEFAULT_PORT = 8765
+MODES = ("two_stage", "brute", "mih")
+NPZ_TYPE = "application/x-npz"
+
+
+class SearchEngine:
+    """持有常驻内存的图库与索引，search() 可被多个线程并发调用"""
+
+    def __init__(self, feat_dir=FEAT_DIR, bow_dir=BOW_DIR, max_side=MAX_SIDE, global_dir=GLOBAL_DIR, cache_dir=None,
+                 result_items=MAX_ITEMS, result_bytes=None, result_dir=None):
+        self.feat_dir = Path(feat_dir)
+        self.seg_root = self.feat_dir / segments.SEG_DIR.name
+        self.segmented = segments.has_segments(self.seg_root)
+        self._gallery = None if self.segmented else open_gallery(self.feat_dir)
+        self._mih = None
+        self._mih_lock = threading.Lock()
+        self._flann = None
+        self._flann_lock = threading.Lock()
+        self.bow = load_bow(bow_dir) if (Path(bow_dir) / "index.npz").exists() else None
+        self.glob = load_global(global_dir) if (Path(global_dir) / VECTORS_FILE).exists() else None
+        self.max_side = max_side
+        # 重复/重试的查询图片直接命中缓存，不再解码和提取
+        self.cache = QueryFeatureCache(max_side=max_side, disk_dir=cache_dir)
+        # 重复查询直接返回上次的结果；BoW / VLAD / FLANN 索引的版本跟着文件走
+        self.results = ResultCache(result_items, result_bytes, result_dir) if result_items > 0 else None
+        self._index_files = (Path(bow_dir) / "index.npz", Path(global_dir) / VECTORS_FILE,
+                             self.feat_dir / FLANN_DIR.name / FLANN_FILE, self.feat_dir / FLANN_DIR.name / "meta.json")
+        self.index_version = files_version(*self._index_files)
+
+    @property
+    def gallery(self):
+        # 分段图库每次取用时检查 manifest，变化后只打开新段
+        return segments.open_segments(self.seg_root) if self.segmented else self._gallery
+
+    def mih(self):
+        with self._mih_lock:
+            if self._mih is None:
+                self._mih = load_or_build(self._gallery, self.feat_dir / "mih")
+            return self._mih
+
+    def flann(self):
+        # FLANN LSH 索引从 <feat_dir>/flann 读回一次，之后所有请求共用
+        with self._flann_lock:
+            if self._flann is None:
+                self._flann = load_flann(self._gallery, self.feat_dir / FLANN_DIR.name)
+                # 索引不存在或已过期时 load_flann 会重建并保存，版本以实际加载的文件为准
+                self.index_version = files_version(*self._index_files)
+            return self._flann
+
+    def features_from_bytes(self, data: bytes):
+        pts, des = self.cache.get_bytes(data)
+        if des is None:
+            raise ValueError("cannot decode query image")
+        return pts, des
+
+    def search(self, pts_q, des_q, topk=5, mode="two_stage", nprobe=30, coarse="match", exclude=None,
+               verify="homography"):
+        def compute():
+            return self._search(pts_q, des_q, topk, mode, nprobe, coarse, exclude, verify)
+        if self.results is None:
+            return compute()
+        params = search_params(mode=mode, topk=topk, nprobe=nprobe, exclude=exclude, verify=verify,
+                               coarse=coarse if mode == "two_stage" else None)
+        if mode == "two_stage" and coarse in ("bow", "vlad", "flann"):
+            if coarse == "flann" and not self.segmented:
+                self.flann()
+            params["index"] = self.index_version
+        return self.results.cached(gallery_version(self.gallery), pts_q, des_q, params, compute)
+
+    def _search(self, pts_q, des_q, topk, mode, nprobe, coarse, exclude, verify):
+        if self.segmented:
+            if mode == "two_stage" and coarse != "match":
+                raise ValueError(f"coarse={coarse} is not available on a segmented gallery; use match or mode=mih")
+            return segments.search(self.gallery, pts_q, des_q, topk, engine=mode, nprobe=nprobe, exclude=exclude,
+                                   verify=verify)
+        if mode == "brute":
+            return search_bruteforce.search(self.gallery, pts_q, des_q, topk, exclude=exclude, verify=verify)
+        if mode == "mih":
+            return search_bruteforce.search_mih(self.gallery, self.mih(), pts_q, des_q, topk, nprobe, exclude=exclude,
+                                                verify=verify)
+        if coarse == "bow" and self.bow is None:
+            raise ValueError("BoW index not built; run python src/vocab.py build")
+        if coarse == "vlad" and self.glob is None:
+            raise ValueError("global descriptors not built; run python src/global_desc.py build")
+        return search_two_stage.search(self.gallery, pts_q, des_q, topk, nprobe, coarse=coarse,
+                                       bow=self.bow, exclude=exclude, glob=self.glob, verify=verify,
+                                       flann=self.flann() if coarse == "flann" else None)
+
+
+def _param(params: dict, name: str, default, cast=str):
+    v = params.get(name, default)
+    if isinstance(v, list):
+        v = v[0]
+    return cast(v)
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    server_version = "FeatureSearch/1.0"
+
+    def address_string(self):
+        # Unix socket 下 client_address 不是 (host, port)
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, fmt, *args):
+        if not self.server.quiet:
+            super().log_message(fmt, *args)
+
+    def _reply(self, code: int, obj: dict):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            return self._reply(404, {"error": "not found"})
+        engine = self.server.engine
+        gallery = engine.gallery
+        self._reply(200, {"images": len(gallery), "bow": engine.bow is not None,
+                          "vlad": engine.glob is not None, "query_cache": engine.cache.stats(),
+                          "result_cache": engine.results.stats() if engine.results is not None else None,
+                          "segments": len(gallery.segments) if engine.segmented else None})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/search":
+            return self._reply(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        params = parse_qs(url.query)
+        ctype = self.headers.get("Content-Type", "")
+        try:
+            fut = self.server.pool.submit(self._run, body, ctype, params)
+            self._reply(200, fut.result())
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:  # 服务不能因为单个查询崩溃
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def _run(self, body: bytes, ctype: str, params: dict) -> dict:
+        with tracing.query(self.path):
+            return self._search(body, ctype, params)
+
+    def _search(self, body: bytes, ctype: str, params: dict) -> dict:
+        engine = self.server.engine
+        t0 = time.perf_counter()
+        exclude = None
+        if ctype.startswith("application/json"):
+            req = json.loads(body.decode("utf-8") or "{}")
+            params = dict(params, **{k: v for k, v in req.items() if k != "query_feat"})
+            qfeat = Path(req["query_feat"])
+            pts_q, des_q = load_kps_des(qfeat)
+            if des_q is None:
+                raise FileNotFoundError(f"{qfeat} not found")
+            if qfeat.parent == engine.feat_dir:
+                exclude = qfeat.stem
+        elif ctype.startswith(NPZ_TYPE):
+            with np.load(io.BytesIO(body)) as a:
+                pts_q, des_q = a["pts"], a["des"]
+            exclude = _param(params, "exclude", None) if "exclude" in params else None
+        else:
+            pts_q, des_q = engine.features_from_bytes(body)
+        mode = _param(params, "mode", "two_stage")
+        if mode not in MODES:
+            raise ValueError(f"unknown mode {mode}")
+        results = engine.search(pts_q, des_q, topk=_param(params, "topk", 5, int), mode=mode,
+                                nprobe=_param(params, "nprobe", 30, int),
+                                coarse=_param(params, "coarse", "match"), exclude=exclude,
+                                verify=_param(params, "verify", "homography"))
+        return {"results": [{"name": n, "score": int(s)} for n, s in results],
+                "query_keypoints": len(des_q),
+                "elapsed_ms": (time.perf_counter() - t0) * 1000}
+
+
+class SearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine: SearchEngine, workers: int, quiet: bool = True):
+        super().__init__(address, SearchHandler)
+        self.engine = engine
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.quiet = quiet
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixSearchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, path: str, engine: SearchEngine, workers: int, quiet: bool = True):
+            if os.path.exists(path):
+                os.unlink(path)
+            super().__init__(path, SearchHandler)
+            self.engine = engine
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+            self.quiet = quiet
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", type=str, help="listen on a Unix socket path instead of TCP")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="concurrent searches")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    parser.add_argument("--features", type=str, default=str(FEAT_DIR),
+                        help="gallery directory (store/, segments/, bow/, global/), e.g. one shard")
+    parser.add_argument("--cache_dir", type=str, help="also keep extracted query features on disk here")
+    parser.add_argument("--result_cache", type=int, default=MAX_ITEMS,
+                        help="cached query results (0 = off); invalidated when the gallery changes")
+    parser.add_argument("--result_cache_mb", type=float, help="also bound the result cache by size")
+    parser.add_argument("--result_cache_dir", type=str, help="persist cached results here across restarts")
+    parser.add_argument("--compact_interval", type=float, default=0,
+                        help="seconds between background segment compactions (0 = off)")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    feat_dir = Path(args.features)
+    engine = SearchEngine(feat_dir, bow_dir=feat_dir / BOW_DIR.name, global_dir=feat_dir / GLOBAL_DIR.name,
+                          cache_dir=args.cache_dir, result_items=args.result_cache,
+                          result_bytes=int(args.result_cache_mb * 2 ** 20) if args.result_cache_mb else None,
+                          result_dir=args.result_cache_dir)
+    print(f"Loaded {len(engine.gallery)} images (bow={'yes' if engine.bow else 'no'}, "
+          f"vlad={'yes' if engine.glob else 'no'}, segmented={'yes' if engine.segmented else 'no'}) "
+          f"in {time.time() - t0:.2f}s")
+    if engine.segmented and args.compact_interval > 0:
+        segments.Compactor(engine.seg_root, args.compact_interval).start()
+    if args.unix:
+        server = UnixSearchServer(args.unix, engine, args.workers, quiet=not args.verbose)
+        print("Listening on unix:" + args.unix)
+    else:
+        server = SearchServer((args.host, args.port), engine, args.workers, quiet=not args.verbose)
+        print(f"Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
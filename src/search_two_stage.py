@@ -2,59 +2,227 @@
 """
 两阶段检索：
   - 快速阶段：使用不带 RANSAC 的粗匹配 count 来筛选 Top-N
+    （--coarse bow 时改用视觉词袋倒排索引打分，需先运行 python src/vocab.py build；
+     --coarse vlad 时改用全局 VLAD 向量的内积排序，需先运行 python src/global_desc.py build；
+     --coarse cascade 时分级：先只用查询与图库各自响应最强的 --cascade_n 个特征给全图库打分，
+     前 --cascade_keep 张再做全特征匹配，取 Top-N 进入精排。特征按 response 排序存储，切前缀即可；
+     --coarse flann 时用预先训练并保存的 FLANN LSH 索引在全图库上一次找近邻、按图投票，见 matchers.py）
   - 精排阶段：对 Top-N 使用 RANSAC 计内点数并输出 Top-K
+--query_path 的图片在进程内提取特征并按内容哈希缓存（见 query_cache.py）
+search(cache=ResultCache) 时整个检索结果按 查询特征 + 参数 + 图库版本 缓存（见 result_cache.py），
+CLI 加 --result_cache [目录] 时缓存落在 features/result_cache/，重复查询跨进程命中。
 用法：
   python src/search_two_stage.py --query_path dataset/queries/q1.jpg --topk 5 --nprobe 30
+  python src/search_two_stage.py --query_path dataset/queries/q1.jpg --coarse bow
+  python src/search_two_stage.py --query_path dataset/queries/q1.jpg --coarse vlad
+  python src/search_two_stage.py --query_path dataset/queries/q1.jpg --coarse cascade --cascade_n 100 --cascade_keep 200
+  python src/search_two_stage.py --query_path dataset/queries/q1.jpg --coarse flann
+  python src/search_two_stage.py --queries dataset/queries --batch 32 > results.jsonl   # 批量，JSONL 输出
+  python src/search_two_stage.py --query_feat features/book_1.npz --trace --profile q.prof  # 阶段耗时 + cProfile
 """
 import argparse
 from pathlib import Path
 import time
-from src.match import load_kps_and_des, match_descriptors
-from src.ransac_validate import ransac_inliers
+from src.batch import BATCH_SIZE, run as run_batch
+from src.hamming import RATIO_TEST_THRESHOLD, match_batch, match_many, ratio_match
+from src.match import match_descriptors
+from src.ransac_validate import RERANK_WORKERS, VERIFY_MODES, load_kps_des, rerank
+from src.feature_store import open_gallery
+from src.vocab import BOW_DIR, load_bow
+from src.global_desc import GLOBAL_DIR, VECTORS_FILE, load_global
+from src.matchers import FLANN_DIR, INDEX_FILE as FLANN_FILE, load_flann
+from src import tracing
+from src.query_cache import default_cache
+from src.result_cache import RESULT_CACHE_DIR, ResultCache, files_version, gallery_version, search_params
 
 FEAT_DIR = Path("features")
+CASCADE_N = 100      # 级联第一级：查询与图库各取前 N 个（响应最强的）特征
+CASCADE_KEEP = 200   # 第一级之后保留、做全特征匹配的图片数
 
 def quick_score(des1, des2):
     # count of good matches (ratio test) as quick proxy
     good = match_descriptors(des1, des2)
     return len(good), good
 
+def _shortlist(gallery, des_q, names, ratio=RATIO_TEST_THRESHOLD):
+    # 只对快速阶段选出的图片做比值测试匹配
+    topn = []
+    for name in names:
+        if name not in gallery:
+            continue
+        pts_f, des_f = gallery.get_by_name(name)
+        qi, ti, _ = ratio_match(des_q, des_f, ratio)
+        topn.append((name, pts_f, qi, ti))
+    return topn
+
+def _by_matches(scores, n):
+    with tracing.span("sort"):
+        scores.sort(key=lambda x: len(x[2]), reverse=True)
+    return scores[:n]
+
+def _promote(gallery, des_q, idx, prefix, keep, ratio=RATIO_TEST_THRESHOLD):
+    """级联的第二级：第一级（前缀匹配）得分最高的 keep 张图做全特征匹配，返回 [(图片id, pts, qidx, tidx)]"""
+    order = sorted(range(len(idx)), key=lambda j: len(prefix[j][0]), reverse=True)[:keep]
+    tracing.count("cascade_promoted", len(order))
+    full = match_many(des_q, [gallery.get(idx[j])[1] for j in order], ratio)
+    return [(gallery.ids[idx[j]], gallery.get(idx[j])[0], qi, ti) for j, (qi, ti, _) in zip(order, full)]
+
+def search(gallery, pts_q, des_q, topk=5, nprobe=30, coarse="match", bow=None, exclude=None,
+           workers=RERANK_WORKERS, glob=None, ratio=RATIO_TEST_THRESHOLD, verify="homography",
+           cascade_n=CASCADE_N, cascade_keep=CASCADE_KEEP, flann=None, cache=None):
+    """
+    在已加载的图库（FeatureStore）上做两阶段检索，返回 [(图片id, 内点数)] Top-K
+    bow 为 (vocab, index)，coarse="bow" 时使用；glob 为 (VLADModel, GlobalIndex)，coarse="vlad" 时使用；
+    flann 为 matchers.FlannLSHIndex，coarse="flann" 时使用（不传则从 features/flann 读取）；
+    exclude 为需要跳过的图库 id（查询自身）；ratio 为比值测试阈值
+    coarse="cascade" 时各级预算为 cascade_n（第一级特征数）-> cascade_keep（全特征匹配图片数）-> nprobe（精排）
+    匹配结果全程是下标数组，精排阶段并行 RANSAC 并在 Top-K 不再变化时提前停止
+    cache 为 result_cache.ResultCache 时先查缓存；图库或索引文件变化后旧结果自动作废
+    """
+    if cache is not None:
+        params = search_params(mode="two_stage", topk=topk, nprobe=nprobe, coarse=coarse, exclude=exclude,
+                               ratio=ratio, verify=verify)
+        if coarse == "cascade":
+            params.update(cascade_n=cascade_n, cascade_keep=cascade_keep)
+        elif coarse in ("bow", "vlad", "flann"):
+            # 传入的是内存中的索引对象时无从得知其版本，以默认索引文件为准
+            params["index"] = files_version({"bow": BOW_DIR / "index.npz", "vlad": GLOBAL_DIR / VECTORS_FILE,
+                                             "flann": FLANN_DIR / FLANN_FILE}[coarse])
+        return cache.cached(gallery_version(gallery), pts_q, des_q, params,
+                            lambda: search(gallery, pts_q, des_q, topk, nprobe, coarse, bow, exclude, workers, glob,
+                                           ratio, verify, cascade_n, cascade_keep, flann))
+    if coarse == "bow":
+        # quick stage: 倒排索引只访问查询单词的 postings，再只对 Top-N 做 knnMatch
+        vocab, index = bow if bow is not None else load_bow(BOW_DIR)
+        topn = _shortlist(gallery, des_q, [n for n, _ in index.query(vocab, des_q, nprobe, exclude=exclude)], ratio)
+    elif coarse == "vlad":
+        # quick stage: 查询编码成一个全局向量，与整个图库一次矩阵-向量乘
+        model, index = glob if glob is not None else load_global(GLOBAL_DIR)
+        topn = _shortlist(gallery, des_q, [n for n, _ in index.query(model.encode(des_q), nprobe, exclude=exclude)],
+                          ratio)
+    elif coarse == "flann":
+        # quick stage: 全图库近似近邻一次查完，按图投票（索引训练一次，从磁盘读回）
+        index = flann if flann is not None else load_flann(gallery)
+        topn = [(name, gallery.get_by_name(name)[0], qi, ti)
+                for name, qi, ti in index.vote(des_q, nprobe, exclude=exclude, ratio=ratio)]
+    elif coarse == "cascade":
+        # quick stage 1: 只用前缀（最强的 cascade_n 个特征）给全图库打分；stage 2: 幸存者全特征匹配
+        idx = [i for i, name in enumerate(gallery.ids) if name != exclude]
+        with tracing.span("cascade_prefix"):
+            prefix = match_many(des_q[:cascade_n], [gallery.get(i)[1][:cascade_n] for i in idx], ratio)
+        with tracing.span("cascade_full"):
+            topn = _by_matches(_promote(gallery, des_q, idx, prefix, cascade_keep, ratio), nprobe)
+    else:
+        # quick stage: 一次调用把查询与整个图库逐图做 2-NN + 比值测试
+        idx = [i for i, name in enumerate(gallery.ids) if name != exclude]
+        matches = match_many(des_q, [gallery.get(i)[1] for i in idx], ratio)
+        scores = [(gallery.ids[i], gallery.get(i)[0], qi, ti) for i, (qi, ti, _) in zip(idx, matches)]
+        topn = _by_matches(scores, nprobe)
+    # refine stage
+    return rerank(pts_q, topn, topk, workers=workers, verify=verify)
+
+def search_batch(gallery, queries, topk=5, nprobe=30, coarse="match", bow=None, workers=RERANK_WORKERS, glob=None,
+                 verify="homography", cascade_n=CASCADE_N, cascade_keep=CASCADE_KEEP, flann=None):
+    """
+    一批查询 [(pts, des, exclude)]：快速阶段一起做（match 时每张图库图片每批只参与一次矩阵乘，
+    vlad 时一次 GEMM），然后逐个精排；生成器，按顺序产出每个查询的 [(图片id, 内点数)]
+    """
+    if coarse == "match":
+        matches = match_batch([des for _, des, _ in queries], [gallery.get(i)[1] for i in range(len(gallery))])
+        for (pts_q, _, exclude), per_img in zip(queries, matches):
+            scores = [(gallery.ids[i], gallery.get(i)[0], qi, ti)
+                      for i, (qi, ti, _) in enumerate(per_img) if gallery.ids[i] != exclude]
+            yield rerank(pts_q, _by_matches(scores, nprobe), topk, workers=workers, verify=verify)
+    elif coarse == "cascade":
+        # 第一级整批一起做（前缀矩阵乘），第二级与精排逐个查询
+        idx = list(range(len(gallery)))
+        prefix = match_batch([des[:cascade_n] for _, des, _ in queries],
+                             [gallery.get(i)[1][:cascade_n] for i in idx])
+        for (pts_q, des_q, exclude), per_img in zip(queries, prefix):
+            keep = [j for j in idx if gallery.ids[j] != exclude]
+            cands = _promote(gallery, des_q, keep, [per_img[j] for j in keep], cascade_keep)
+            yield rerank(pts_q, _by_matches(cands, nprobe), topk, workers=workers, verify=verify)
+    elif coarse == "vlad":
+        model, index = glob if glob is not None else load_global(GLOBAL_DIR)
+        qs = [model.encode(des) for _, des, _ in queries]
+        short = index.query_batch(qs, nprobe, [ex for _, _, ex in queries]) if qs else []
+        for (pts_q, des_q, _), top in zip(queries, short):
+            yield rerank(pts_q, _shortlist(gallery, des_q, [n for n, _ in top]), topk, workers=workers, verify=verify)
+    elif coarse == "flann":
+        flann = flann if flann is not None else load_flann(gallery)
+        for pts_q, des_q, exclude in queries:
+            yield search(gallery, pts_q, des_q, topk, nprobe, coarse="flann", exclude=exclude, workers=workers,
+                         verify=verify, flann=flann)
+    else:
+        bow = bow if bow is not None else load_bow(BOW_DIR)
+        for pts_q, des_q, exclude in queries:
+            yield search(gallery, pts_q, des_q, topk, nprobe, coarse="bow", bow=bow, exclude=exclude, workers=workers,
+                         verify=verify)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--query_path", type=str, help="path to query image (dataset/queries/xxx.jpg)")
     parser.add_argument("--query_feat", type=str, help="path to query feature (.npz)")
     parser.add_argument("--topk", type=int, default=5)
     parser.add_argument("--nprobe", type=int, default=30, help="Top-N to refine")
+    parser.add_argument("--coarse", choices=["match", "bow", "vlad", "cascade", "flann"], default="match",
+                        help="quick stage: per-image knnMatch, BoW inverted index, VLAD global vectors, "
+                             "a strongest-features-first cascade or a prebuilt FLANN LSH index")
+    parser.add_argument("--cascade_n", type=int, default=CASCADE_N, help="cascade tier 1: features per image")
+    parser.add_argument("--cascade_keep", type=int, default=CASCADE_KEEP,
+                        help="cascade tier 2: images promoted to full matching")
+    parser.add_argument("--workers", type=int, default=RERANK_WORKERS, help="RANSAC threads")
+    parser.add_argument("--verify", choices=VERIFY_MODES, default="homography",
+                        help="geometric check: homography RANSAC, Hough similarity pre-filter, or similarity only")
+    parser.add_argument("--queries", type=str, help="batch mode: directory, glob or list file of queries (JSONL output)")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="queries per coarse-stage batch")
+    parser.add_argument("--result_cache", nargs="?", const=str(RESULT_CACHE_DIR),
+                        help="reuse results of identical earlier queries, kept on disk (default features/result_cache)")
+    tracing.add_arguments(parser)
     args = parser.parse_args()
+    tracing.setup(args)
+
+    if args.queries:
+        gallery = open_gallery(FEAT_DIR)
+        bow = load_bow(BOW_DIR) if args.coarse == "bow" else None
+        glob = load_global(GLOBAL_DIR) if args.coarse == "vlad" else None
+        run_batch(args.queries, lambda qs: search_batch(gallery, qs, args.topk, args.nprobe, coarse=args.coarse,
+                                                         bow=bow, workers=args.workers, glob=glob,
+                                                         verify=args.verify, cascade_n=args.cascade_n,
+                                                         cascade_keep=args.cascade_keep),
+                  batch_size=args.batch)
+        return
 
     if args.query_feat:
         qfeat = Path(args.query_feat)
     elif args.query_path:
-        qfeat = Path("features") / (Path(args.query_path).stem + ".npz")
+        qfeat = Path(args.query_path)
     else:
         print("Provide --query_path or --query_feat")
         return
 
-    all_feats = sorted(FEAT_DIR.glob("*.npz"))
-    # quick stage
-    scores = []
-    for f in all_feats:
-        if f == qfeat: continue
-        kp_q, des_q = load_kps_and_des(qfeat)
-        kp_f, des_f = load_kps_and_des(f)
-        cnt, good = quick_score(des_q, des_f)
-        scores.append((f, cnt, good))
-    scores.sort(key=lambda x: x[1], reverse=True)
-    topn = scores[:args.nprobe]
-    # refine stage
-    refined = []
-    for f, cnt, good in topn:
-        inliers, mask = ransac_inliers(str(qfeat), str(f), good)
-        refined.append((f.name, inliers))
-    refined.sort(key=lambda x: x[1], reverse=True)
+    gallery = open_gallery(FEAT_DIR)
+    cache = ResultCache(disk_dir=args.result_cache) if args.result_cache else None
+    with tracing.query(qfeat.name), tracing.profile(args.profile):
+        if args.query_feat:
+            pts_q, des_q = load_kps_des(qfeat)
+            exclude = qfeat.stem if qfeat.parent == FEAT_DIR else None
+        elif qfeat.exists():
+            pts_q, des_q = default_cache().get_path(qfeat)
+            exclude = None
+        else:
+            print(f"{qfeat} not found")
+            return
+        if des_q is None:
+            return
+        refined = search(gallery, pts_q, des_q, args.topk, args.nprobe, coarse=args.coarse, exclude=exclude,
+                         workers=args.workers, verify=args.verify, cascade_n=args.cascade_n,
+                         cascade_keep=args.cascade_keep, cache=cache)
     print("Refined Top-K:")
-    for name, inl in refined[:args.topk]:
-        print(name, inl)
+    for name, inl in refined:
+        print(name + ".npz", inl)
+    if cache is not None:
+        print("result cache:", cache.stats())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""
+分段式图库：图库由若干只追加的段（segment）组成，增删图片不再需要重建整个特征库和索引。
+  - 每个段是一个独立的合并式特征库（见 feature_store.py）加上它自己的 MIH 索引（见 mih.py），写完后不再修改
+  - 新增图片：提取后写成一个新的小段；同名图片视为更新，旧段中的条目记为墓碑（tombstone）
+  - 删除图片：只在 manifest 中记墓碑，检索时跳过
+  - 检索：每个存活段各自做快速阶段，候选按匹配数合并后只做一次 RANSAC 精排（合并各段的 Top-K）
+  - 合并（compaction）：分层策略，同一层级攒满 MERGE_FACTOR 个段就合并成一个大段；
+    墓碑比例超过 MAX_DELETED 的段单独重写。可以后台定期运行（search_server.py --compact_interval）
+目录结构（默认 features/segments/）：
+  manifest.json     # {"generation", "next_seq", "segments": [{"name", "images", "tombstones"}]}，整体原子替换
+  seg-000001/       # 特征库文件 + mih/
+  LOCK              # 写 manifest 时的文件锁（多个写进程/合并进程互斥）
+读者按 manifest 的修改时间重新打开，未变化的段直接复用；被合并掉的段在读者仍持有 memmap 时删除是安全的。
+用法：
+  python src/segments.py init --from_store              # 把现有 features/store 作为第一个段
+  python src/segments.py add dataset/new_images/*.jpg   # 新图片写成一个新段
+  python src/segments.py delete 0001 0002               # 删除（记墓碑）
+  python src/segments.py compact                        # 按分层策略合并小段；--full 合并成一个段
+  python src/segments.py info
+  python src/segments.py search --query_path dataset/queries/q1.jpg --engine mih
+"""
+import argparse
+import heapq
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.extra_features import ORB_PARAMS
+from src.feature_store import FEAT_DIR, FeatureStore, FeatureStoreWriter, find_store
+from src.hamming import RATIO_TEST_THRESHOLD, match_many
+from src.mih import MIHIndex
+from src.pipeline import MAX_SIDE, stream_features
+from src.query_cache import default_cache
+from src.ransac_validate import RERANK_WORKERS, VERIFY_MODES, load_kps_des, rerank
+from src import tracing
+
+try:
+    import fcntl
+except ImportError:  # Windows：只保证进程内互斥
+    fcntl = None
+
+SEG_DIR = FEAT_DIR / "segments"
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "LOCK"
+MIH_SUBDIR = "mih"
+ENGINES = ("mih", "two_stage", "brute")
+MERGE_FACTOR = 8     # 同一层级的段数达到该值时合并
+MIN_SEGMENT = 1000   # 存活图片数小于该值的段都算第 0 层
+MAX_DELETED = 0.3    # 墓碑比例超过该值的段单独重写
+
+
+# ---------------- manifest ----------------
+
+_thread_lock = threading.Lock()
+
+
+@contextmanager
+def locked(root: Path):
+    """manifest 的读-改-写临界区：进程内用线程锁，进程间用 flock"""
+    with _thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(Path(root) / LOCK_FILE, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_manifest(root: Path = SEG_DIR) -> dict:
+    p = Path(root) / MANIFEST_FILE
+    if not p.exists():
+        raise FileNotFoundError(f"{p} not found; run python src/segments.py init")
+    with open(p, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, root: Path = SEG_DIR):
+    # 先写临时文件再替换，读者看到的始终是完整的 manifest
+    manifest["generation"] = manifest.get("generation", 0) + 1
+    tmp = Path(root) / (MANIFEST_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, Path(root) / MANIFEST_FILE)
+
+
+def init(root: Path = SEG_DIR, from_store: Optional[Path] = None) -> dict:
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    with locked(root):
+        if (root / MANIFEST_FILE).exists():
+            raise FileExistsError(f"{root / MANIFEST_FILE} already exists")
+        save_manifest({"generation": 0, "next_seq": 1, "segments": []}, root)
+    if from_store is not None:
+        store = find_store(from_store)
+        if store is None:
+            raise FileNotFoundError(f"no feature store under {from_store}")
+        name = _reserve(root)
+        _write_segment(root / name, ((store.ids[i],) + store.get(i) for i in range(len(store))))
+        _commit_new(root, name, store.ids)
+    return load_manifest(root)
+
+
+def _reserve(root: Path) -> str:
+    """分配一个新段名（seg-000001 递增）"""
+    with locked(root):
+        manifest = load_manifest(root)
+        seq = manifest["next_seq"]
+        manifest["next_seq"] = seq + 1
+        save_manifest(manifest, root)
+    return f"seg-{seq:06d}"
+
+
+def _write_segment(seg_root: Path, items) -> List[str]:
+    """items 为 (名字, pts, des)；写特征库并建该段的 MIH 索引，返回写入的名字"""
+    with FeatureStoreWriter(seg_root) as w:
+        for name, pts, des in items:
+            w.add(name, pts, des)
+    store = FeatureStore.open(seg_root)
+    MIHIndex.build(store).save(seg_root / MIH_SUBDIR)
+    return store.ids
+
+
+def _commit_new(root: Path, name: str, names) -> dict:
+    """把写好的新段加入 manifest；同名图片在旧段中记墓碑（新段里的版本生效）"""
+    names = set(names)
+    with locked(root):
+        manifest = load_manifest(root)
+        for entry in manifest["segments"]:
+            hit = names & _segment_ids(root, entry["name"])
+            if hit:
+                entry["tombstones"] = sorted(set(entry["tombstones"]) | hit)
+        manifest["segments"].append({"name": name, "images": len(names), "tombstones": []})
+        save_manifest(manifest, root)
+    return manifest
+
+
+_IDS: Dict[Tuple[str, str], frozenset] = {}
+
+
+def _segment_ids(root: Path, name: str) -> frozenset:
+    # 段写完后不再变化，名字集合可以一直缓存
+    key = (str(Path(root).resolve()), name)
+    ids = _IDS.get(key)
+    if ids is None:
+        ids = _IDS[key] = frozenset(str(x) for x in np.load(Path(root) / name / "index.npz")["ids"])
+    return ids
+
+
+# ---------------- 写：新增 / 删除 / 合并 ----------------
+
+def add_images(paths, root: Path = SEG_DIR, max_side: int = MAX_SIDE, workers: int = 2) -> Optional[str]:
+    """提取 paths 中的图片并写成一个新段，返回段名（没有可用图片时返回 None）"""
+    root = Path(root)
+    paths = [Path(p) for p in paths]
+    name = _reserve(root)
+    skipped = []
+
+    def items():
+        for p, _, pts, des in stream_features(paths, ORB_PARAMS, max_side, workers=workers):
+            if des is None:
+                skipped.append(p)
+                continue
+            yield p.stem, pts, des
+
+    names = _write_segment(root / name, items())
+    for p in skipped:
+        print("WARN: cannot read", p)
+    if not names:
+        shutil.rmtree(root / name, ignore_errors=True)
+        return None
+    _commit_new(root, name, names)
+    return name
+
+
+def delete(names, root: Path = SEG_DIR) -> int:
+    """把 names 记为墓碑，返回实际删除的图片数"""
+    root = Path(root)
+    names = set(names)
+    n = 0
+    with locked(root):
+        manifest = load_manifest(root)
+        for entry in manifest["segments"]:
+            dead = set(entry["tombstones"])
+            hit = (names & _segment_ids(root, entry["name"])) - dead
+            if hit:
+                entry["tombstones"] = sorted(dead | hit)
+                n += len(hit)
+        if n:
+            save_manifest(manifest, root)
+    return n
+
+
+def _live(entry: dict) -> int:
+    return entry["images"] - len(entry["tombstones"])
+
+
+def _level(n: int, factor: int, min_segment: int) -> int:
+    level, size = 0, min_segment
+    while n >= size:
+        level += 1
+        size *= factor
+    return level
+
+
+def plan_merge(manifest: dict, factor: int = MERGE_FACTOR, min_segment: int = MIN_SEGMENT,
+               max_deleted: float = MAX_DELETED, full: bool = False) -> List[str]:
+    """选出下一次要合并的段名；没有需要合并的返回 []"""
+    segs = manifest["segments"]
+    if full:
+        return [e["name"] for e in segs] if len(segs) > 1 or any(e["tombstones"] for e in segs) else []
+    for e in segs:
+        if e["tombstones"] and len(e["tombstones"]) >= max_deleted * e["images"]:
+            return [e["name"]]
+    levels: Dict[int, List[str]] = {}
+    for e in segs:
+        levels.setdefault(_level(_live(e), factor, min_segment), []).append(e["name"])
+    for level in sorted(levels):
+        if len(levels[level]) >= factor:
+            return levels[level][:factor]
+    return []
+
+
+def merge(names: List[str], root: Path = SEG_DIR) -> Optional[str]:
+    """
+    把 names 中各段的存活图片写成一个新段并在 manifest 中替换它们；返回新段名（全部已删除时为 None）
+    写新段期间不持锁，期间发生的新增/删除在提交时补记为新段的墓碑
+    """
+    root = Path(root)
+    snapshot = {e["name"]: set(e["tombstones"]) for e in load_manifest(root)["segments"] if e["name"] in names}
+    if len(snapshot) != len(names):
+        return None
+    stores = [FeatureStore.open(root / n) for n in names]
+    live = sum(len(s) - len(snapshot[n]) for n, s in zip(names, stores))
+    new = _reserve(root) if live else None
+
+    def items():
+        for n, s in zip(names, stores):
+            for i, img in enumerate(s.ids):
+                if img not in snapshot[n]:
+                    pts, des = s.get(i)
+                    yield img, pts, des
+
+    merged = _write_segment(root / new, items()) if new else []
+    with locked(root):
+        manifest = load_manifest(root)
+        current = {e["name"]: e for e in manifest["segments"]}
+        if any(n not in current for n in names):
+            # 其它合并进程已经处理了这些段
+            if new:
+                shutil.rmtree(root / new, ignore_errors=True)
+            return None
+        dead = set()
+        for n in names:
+            dead |= set(current[n]["tombstones"]) - snapshot[n]
+        pos = min(i for i, e in enumerate(manifest["segments"]) if e["name"] in names)
+        rest = [e for e in manifest["segments"] if e["name"] not in names]
+        if new:
+            rest.insert(pos, {"name": new, "images": len(merged), "tombstones": sorted(dead & set(merged))})
+        manifest["segments"] = rest
+        save_manifest(manifest, root)
+    for n in names:
+        shutil.rmtree(root / n, ignore_errors=True)
+    return new
+
+
+def compact(root: Path = SEG_DIR, factor: int = MERGE_FACTOR, min_segment: int = MIN_SEGMENT,
+            max_deleted: float = MAX_DELETED, full: bool = False, verbose: bool = False) -> int:
+    """反复按 plan_merge 合并，直到没有需要合并的段；返回合并次数"""
+    rounds = 0
+    while True:
+        names = plan_merge(load_manifest(root), factor, min_segment, max_deleted, full)
+        if not names:
+            return rounds
+        t0 = time.time()
+        new = merge(names, root)
+        rounds += 1
+        if verbose:
+            print(f"merged {len(names)} segments -> {new or '(all deleted)'} in {time.time() - t0:.2f}s")
+        if full:
+            return rounds
+
+
+class Compactor(threading.Thread):
+    """后台线程：每 interval 秒做一次 compact()"""
+
+    def __init__(self, root: Path = SEG_DIR, interval: float = 60.0, **kw):
+        super().__init__(daemon=True)
+        self.root, self.interval, self.kw = Path(root), interval, kw
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            try:
+                compact(self.root, **self.kw)
+            except Exception as e:  # 合并失败不能影响检索，下一轮重试
+                print(f"compaction failed: {type(e).__name__}: {e}")
+
+    def stop(self):
+        self._halt.set()
+
+
+# ---------------- 读：打开与检索 ----------------
+
+class Segment:
+    """一个段：完整的特征库、MIH 索引，以及去掉墓碑后的视图 view（同样是 FeatureStore，共享 memmap）"""
+
+    def __init__(self, name: str, store: FeatureStore, mih: MIHIndex, dead=()):
+        self.name = name
+        self.store = store
+        self.mih = mih
+        self.dead = frozenset(dead)
+        if self.dead:
+            keep = np.array([x not in self.dead for x in store.ids], dtype=bool)
+            self.view = FeatureStore([x for x, k in zip(store.ids, keep) if k], store.offsets[keep],
+                                     store.counts[keep], store.pts, store.des, root=store.root)
+        else:
+            self.view = store
+
+    def __len__(self):
+        return len(self.view)
+
+
+class SegmentedGallery:
+    def __init__(self, root: Path, generation: int, segments: List[Segment]):
+        self.root = Path(root)
+        self.generation = generation
+        self.segments = segments
+
+    def __len__(self):
+        return sum(len(s) for s in self.segments)
+
+    def __contains__(self, name):
+        return any(name in s.view for s in self.segments)
+
+    @property
+    def ids(self) -> List[str]:
+        return [x for s in self.segments for x in s.view.ids]
+
+    def get_by_name(self, name: str):
+        for s in self.segments:
+            if name in s.view:
+                return s.view.get_by_name(name)
+        raise KeyError(name)
+
+
+def _open_segment(root: Path, entry: dict, prev: Optional[Segment]) -> Segment:
+    # 段文件不会变化：已打开的段只需要按新的墓碑重建视图
+    if prev is not None:
+        return Segment(entry["name"], prev.store, prev.mih, entry["tombstones"])
+    store = FeatureStore.open(root / entry["name"])
+    try:
+        mih = MIHIndex.load(root / entry["name"] / MIH_SUBDIR, store)
+    except (FileNotFoundError, ValueError):
+        mih = MIHIndex.build(store)
+    return Segment(entry["name"], store, mih, entry["tombstones"])
+
+
+_OPENED: Dict[str, Tuple[int, SegmentedGallery]] = {}
+_open_lock = threading.Lock()
+
+
+def open_segments(root: Path = SEG_DIR) -> SegmentedGallery:
+    """打开分段图库；manifest 没变时返回缓存的对象，变了则只打开新增的段"""
+    root = Path(root)
+    key = str(root.resolve())
+    with _open_lock:
+        mtime = (root / MANIFEST_FILE).stat().st_mtime_ns
+        hit = _OPENED.get(key)
+        if hit is not None and hit[0] == mtime:
+            return hit[1]
+        with locked(root):
+            manifest = load_manifest(root)
+            prev = {s.name: s for s in hit[1].segments} if hit is not None else {}
+            segments = [_open_segment(root, e, prev.get(e["name"])) for e in manifest["segments"]]
+        gallery = SegmentedGallery(root, manifest["generation"], segments)
+        _OPENED[key] = (mtime, gallery)
+        return gallery
+
+
+def has_segments(root: Path = SEG_DIR) -> bool:
+    return (Path(root) / MANIFEST_FILE).exists()
+
+
+def _candidates(seg: Segment, des_q, engine: str, nprobe: int, exclude, ratio: float):
+    """单个段的快速阶段，返回 [(图片id, pts, qidx, tidx)]"""
+    if engine == "mih":
+        voted = seg.mih.vote(des_q, nprobe, exclude=seg.dead | {exclude}, ratio=ratio)
+        return [(name, seg.view.get_by_name(name)[0], qi, ti) for name, qi, ti in voted]
+    view = seg.view
+    idx = [i for i, name in enumerate(view.ids) if name != exclude]
+    matches = match_many(des_q, [view.get(i)[1] for i in idx], ratio)
+    return [(view.ids[i], view.get(i)[0], qi, ti) for i, (qi, ti, _) in zip(idx, matches)]
+
+
+def search(gallery: SegmentedGallery, pts_q, des_q, topk: int = 5, engine: str = "mih", nprobe: int = 50,
+           exclude: str = None, workers: int = RERANK_WORKERS, ratio: float = RATIO_TEST_THRESHOLD,
+           verify: str = "homography"):
+    """
+    逐段做快速阶段，各段候选按比值测试匹配数合并成全局 Top-nprobe（brute 不截断），
+    再统一 RANSAC 精排，返回 [(图片id, 内点数)]；精排代价与段数无关
+    """
+    merged = []
+    for seg in gallery.segments:
+        if len(seg):
+            with tracing.span("segment_coarse"):
+                merged.extend(_candidates(seg, des_q, engine, nprobe, exclude, ratio))
+    tracing.count("segments", len(gallery.segments))
+    if engine != "brute":
+        merged = heapq.nlargest(nprobe, merged, key=lambda c: len(c[2]))
+    return rerank(pts_q, merged, topk, workers=workers, verify=verify)
+
+
+def info(root: Path = SEG_DIR):
+    manifest = load_manifest(root)
+    total = 0
+    for e in manifest["segments"]:
+        total += _live(e)
+        print(f"{e['name']}  images={e['images']:>8d}  deleted={len(e['tombstones']):>6d}  "
+              f"level={_level(_live(e), MERGE_FACTOR, MIN_SEGMENT)}")
+    print(f"generation {manifest['generation']}: {len(manifest['segments'])} segments, {total} live images")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default=str(SEG_DIR), help="segments directory")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("init", help="create an empty segmented gallery")
+    p.add_argument("--from_store", action="store_true", help="import features/store as the first segment")
+    p = sub.add_parser("add", help="extract images into a new segment")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--workers", type=int, default=2)
+    p = sub.add_parser("delete", help="tombstone images by id")
+    p.add_argument("names", nargs="+")
+    p = sub.add_parser("compact", help="merge small segments")
+    p.add_argument("--full", action="store_true", help="merge everything into one segment")
+    p.add_argument("--factor", type=int, default=MERGE_FACTOR)
+    p.add_argument("--min_segment", type=int, default=MIN_SEGMENT)
+    sub.add_parser("info", help="list segments")
+    p = sub.add_parser("search", help="search all live segments")
+    p.add_argument("--query_path", type=str)
+    p.add_argument("--query_feat", type=str)
+    p.add_argument("--engine", choices=ENGINES, default="mih")
+    p.add_argument("--topk", type=int, default=5)
+    p.add_argument("--nprobe", type=int, default=50)
+    p.add_argument("--workers", type=int, default=RERANK_WORKERS, help="RANSAC threads")
+    p.add_argument("--verify", choices=VERIFY_MODES, default="homography")
+    tracing.add_arguments(p)
+    args = parser.parse_args()
+    root = Path(args.root)
+
+    t0 = time.time()
+    if args.cmd == "init":
+        manifest = init(root, FEAT_DIR if args.from_store else None)
+        print(f"{root}: {len(manifest['segments'])} segments in {time.time() - t0:.2f}s")
+    elif args.cmd == "add":
+        name = add_images(args.images, root, workers=args.workers)
+        print(f"{name or 'nothing'} written ({len(args.images)} images) in {time.time() - t0:.2f}s")
+    elif args.cmd == "delete":
+        print(f"deleted {delete(args.names, root)} images")
+    elif args.cmd == "compact":
+        n = compact(root, args.factor, args.min_segment, full=args.full, verbose=True)
+        print(f"{n} merges in {time.time() - t0:.2f}s")
+    elif args.cmd == "info":
+        info(root)
+    else:
+        tracing.setup(args)
+        gallery = open_segments(root)
+        qpath = Path(args.query_feat or args.query_path or "")
+        with tracing.query(qpath.name), tracing.profile(args.profile):
+            if args.query_feat:
+                pts_q, des_q = load_kps_des(qpath)
+            elif qpath.is_file():
+                pts_q, des_q = default_cache().get_path(qpath)
+            else:
+                print("Provide --query_path or --query_feat")
+                return
+            if des_q is None:
+                return
+            t0 = time.time()
+            results = search(gallery, pts_q, des_q, args.topk, args.engine, args.nprobe, workers=args.workers,
+                             verify=args.verify)
+        print(f"{len(gallery)} images in {len(gallery.segments)} segments, {time.time() - t0:.3f}s. Top-{args.topk}:")
+        for name, score in results:
+            print(f"{name}\tinliers={score}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+分片检索（scatter-gather）：把图库按图片 id 的哈希切成 N 个分片，每个分片由一个独立的 search_server.py
+进程服务（本机多进程，或其他主机上的 HTTP / Unix socket 地址），协调端：
+  - 只提取一次查询特征，把 (pts, des) 编码后并发发给所有分片（search_client.search_npz）
+  - 每个分片在本地做快速阶段 + RANSAC，返回自己的 Top-K
+  - 协调端按内点数合并成全局 Top-K；超时或出错的分片跳过，结果标记为 partial
+分片之间不共享任何状态，单个分片的图库只有 1/N，快速阶段（逐图匹配 / MIH 投票）的耗时按 1/N 下降；
+--nprobe 是全局的 RANSAC 预算，每个分片只验证 ceil(nprobe / N) 张（至少 topk 张），精排总量不随分片数增长。
+目录结构（默认 features/shards/）：
+  shard-00/store/   # 分片的合并式特征库（见 feature_store.py）
+  shard-00/mih/     # 分片的 MIH 索引（见 mih.py）
+  workers.txt       # serve 启动的本机分片地址，每行一个，search/bench 默认读它
+用法：
+  python src/shards.py split --n 4                                  # 由 features/store 切出 4 个分片
+  python src/shards.py serve                                        # 每个分片起一个服务进程（Ctrl-C 退出）
+  python src/shards.py search --query_path dataset/queries/q1.jpg --timeout 2
+  python src/shards.py search --query_feat features/book_1.npz --shards http://host-a:8801,http://host-b:8801
+  python src/shards.py bench --queries dataset/queries --n 1,2,4 --concurrency 8   # 吞吐随分片数的变化
+"""
+import argparse
+import heapq
+import math
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from src.batch import load_queries, resolve_queries
+from src.feature_store import FEAT_DIR, FeatureStoreWriter, open_gallery
+from src.mih import MIHIndex
+from src.query_cache import default_cache
+from src.ransac_validate import VERIFY_MODES, load_kps_des
+from src.search_client import SearchClient, encode_features
+from src.search_server import MODES
+
+SHARD_DIR = FEAT_DIR / "shards"
+WORKERS_FILE = "workers.txt"
+BASE_PORT = 8801
+SHARD_TIMEOUT = 10.0   # 单个分片的超时（秒），超时的分片不计入结果
+START_TIMEOUT = 120.0  # 等待本机分片进程加载图库的时间
+
+
+def shard_of(name: str, n: int) -> int:
+    """图片 id -> 分片号；crc32 与进程无关，重新切分或新增图片时分配稳定"""
+    return zlib.crc32(name.encode("utf-8")) % n
+
+
+def shard_dirs(root: Path = SHARD_DIR) -> List[Path]:
+    return sorted(p for p in Path(root).glob("shard-*") if (p / "store").is_dir())
+
+
+def split(n: int, root: Path = SHARD_DIR, feat_dir: Path = FEAT_DIR, mih: bool = True) -> List[Path]:
+    """把 feat_dir 的图库切成 n 个分片写到 root/shard-XX/，返回分片目录"""
+    gallery = open_gallery(feat_dir)
+    root = Path(root)
+    for old in shard_dirs(root):
+        if int(old.name.split("-")[1]) >= n:
+            # 分片数变少时，多出来的旧分片不能留着被 serve 拾起
+            shutil.rmtree(old)
+    dirs = [root / f"shard-{i:02d}" for i in range(n)]
+    writers = [FeatureStoreWriter(d / "store", kp_dim=gallery.pts.shape[1]) for d in dirs]
+    for i, name in enumerate(gallery.ids):
+        pts, des = gallery.get(i)
+        writers[shard_of(name, n)].add(name, pts, des)
+    for d, w in zip(dirs, writers):
+        w.close()
+        if mih:
+            MIHIndex.build(open_gallery(d)).save(d / "mih")
+    return dirs
+
+
+def read_addresses(spec: str = None, root: Path = SHARD_DIR) -> List[str]:
+    """--shards 的写法：逗号分隔的地址，@文件（每行一个），缺省读 root/workers.txt"""
+    if spec and not spec.startswith("@"):
+        return [a.strip() for a in spec.split(",") if a.strip()]
+    path = Path(spec[1:]) if spec else Path(root) / WORKERS_FILE
+    if not path.exists():
+        raise FileNotFoundError(f"{path} not found; pass --shards or run python src/shards.py serve")
+    return [line.strip() for line in path.read_text().splitlines() if line.strip()]
+
+
+class ShardedSearch:
+    """
+    scatter-gather 协调端，search() 可被多个线程并发调用。
+    返回 ([(图片id, 内点数)], {地址: "ok" / "timeout" / "error: ..."})，状态里不全是 ok 即为部分结果
+    """
+
+    def __init__(self, addresses: List[str], timeout: float = SHARD_TIMEOUT, max_inflight: int = 64):
+        if not addresses:
+            raise ValueError("no shard addresses")
+        self.clients = [SearchClient(a, timeout=timeout) for a in addresses]
+        self.timeout = timeout
+        # 线程只等待网络，分片数 x 并发查询数
+        self.pool = ThreadPoolExecutor(max_workers=max(len(addresses), 1) * max_inflight)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def per_shard_nprobe(self, nprobe: int, topk: int) -> int:
+        return max(topk, math.ceil(nprobe / len(self.clients)))
+
+    def search(self, pts_q, des_q, topk=5, mode="mih", nprobe=30, coarse="match", verify="homography",
+               exclude=None, timeout: float = None) -> Tuple[List[Tuple[str, int]], Dict[str, str]]:
+        body = encode_features(pts_q, des_q)
+        kw = dict(topk=topk, mode=mode, nprobe=self.per_shard_nprobe(nprobe, topk), coarse=coarse,
+                  verify=verify, exclude=exclude)
+        futs = {self.pool.submit(c.search_npz, body, **kw): c.server for c in self.clients}
+        # 整体截止时间 = 单分片超时：各分片并行，最慢的分片决定延迟
+        done, _ = wait(futs, timeout=self.timeout if timeout is None else timeout)
+        merged, status = [], {}
+        for fut, addr in futs.items():
+            if fut not in done:
+                fut.cancel()
+                status[addr] = "timeout"
+            elif fut.exception() is not None:
+                status[addr] = f"error: {fut.exception()}"
+            else:
+                status[addr] = "ok"
+                merged.extend((r["name"], int(r["score"])) for r in fut.result()["results"])
+        # 同分按 id 排序，保证结果与分片返回顺序无关
+        results = heapq.nsmallest(topk, merged, key=lambda r: (-r[1], r[0]))
+        return results, status
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def is_partial(status: Dict[str, str]) -> bool:
+    return any(s != "ok" for s in status.values())
+
+
+@contextmanager
+def local_workers(dirs: List[Path], base_port: int = BASE_PORT, unix_dir: str = None, workers: int = 1,
+                  start_timeout: float = START_TIMEOUT):
+    """为每个分片目录起一个 search_server 进程，全部就绪后产出地址列表，退出时结束进程"""
+    procs, addresses = [], []
+    try:
+        for i, d in enumerate(dirs):
+            cmd = [sys.executable, "-m", "src.search_server", "--features", str(d), "--workers", str(workers)]
+            if unix_dir:
+                sock = str(Path(unix_dir) / f"{d.name}.sock")
+                cmd += ["--unix", sock]
+                addresses.append("unix:" + sock)
+            else:
+                cmd += ["--port", str(base_port + i)]
+                addresses.append(f"http://127.0.0.1:{base_port + i}")
+            procs.append(subprocess.Popen(cmd, stdout=subprocess.DEVNULL))
+        deadline = time.time() + start_timeout
+        for addr, p in zip(addresses, procs):
+            client = SearchClient(addr, timeout=5)
+            while not client.is_up():
+                if p.poll() is not None:
+                    raise RuntimeError(f"shard worker {addr} exited with code {p.returncode}")
+                if time.time() > deadline:
+                    raise TimeoutError(f"shard worker {addr} not ready after {start_timeout:.0f}s")
+                time.sleep(0.2)
+        yield addresses
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
+def load_query(q: str):
+    """查询图片走进程内提取（带缓存）；features/ 下的 .npz 视为图库图片，检索时排除自身"""
+    p = Path(q)
+    if p.suffix == ".npz":
+        pts, des = load_kps_des(p)
+        return pts, des, (p.stem if p.parent == FEAT_DIR else None)
+    pts, des = default_cache().get_path(p)
+    return pts, des, None
+
+
+def bench(coord: ShardedSearch, queries, concurrency: int, **kw) -> dict:
+    """并发 concurrency 个查询压测，返回吞吐与延迟"""
+    def one(q):
+        t0 = time.perf_counter()
+        _, status = coord.search(q[0], q[1], exclude=q[2], **kw)
+        return time.perf_counter() - t0, is_partial(status)
+
+    for q in queries[:min(len(queries), len(coord) + 1)]:
+        one(q)  # 预热：各分片把 memmap / MIH 索引读入页缓存
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        out = list(ex.map(one, queries))
+    wall = time.perf_counter() - t0
+    lat = np.array([t for t, _ in out]) * 1000
+    return {"qps": len(queries) / wall, "p50_ms": float(np.percentile(lat, 50)),
+            "p95_ms": float(np.percentile(lat, 95)), "partial": sum(p for _, p in out)}
+
+
+def _query_arguments(p):
+    p.add_argument("--shards", type=str, help="comma-separated addresses or @file (default: <root>/workers.txt)")
+    p.add_argument("--topk", type=int, default=5)
+    p.add_argument("--mode", choices=MODES, default="mih")
+    p.add_argument("--nprobe", type=int, default=30, help="total images verified, split across shards")
+    p.add_argument("--verify", choices=VERIFY_MODES, default="homography")
+    p.add_argument("--timeout", type=float, default=SHARD_TIMEOUT, help="per-shard timeout in seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default=str(SHARD_DIR), help="shards directory")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("split", help="split the gallery into N shard directories")
+    p.add_argument("--n", type=int, required=True)
+    p.add_argument("--features", type=str, default=str(FEAT_DIR), help="gallery to split")
+    p.add_argument("--no_mih", action="store_true", help="do not build per-shard MIH indexes")
+    p = sub.add_parser("serve", help="start one local search_server per shard")
+    p.add_argument("--base_port", type=int, default=BASE_PORT)
+    p.add_argument("--unix_dir", type=str, help="listen on Unix sockets in this directory instead of TCP")
+    p.add_argument("--workers", type=int, default=1, help="concurrent searches per shard process")
+    p = sub.add_parser("search", help="scatter-gather one query")
+    _query_arguments(p)
+    p.add_argument("--query_path", type=str)
+    p.add_argument("--query_feat", type=str)
+    p = sub.add_parser("bench", help="throughput vs shard count")
+    _query_arguments(p)
+    p.add_argument("--queries", type=str, required=True, help="directory, glob or list file of queries")
+    p.add_argument("--n", type=str, help="shard counts to compare, e.g. 1,2,4 (splits and starts local workers)")
+    p.add_argument("--features", type=str, default=str(FEAT_DIR), help="gallery split for --n")
+    p.add_argument("--concurrency", type=int, default=8, help="queries in flight")
+    p.add_argument("--unix_dir", type=str, help="local workers listen on Unix sockets in this directory")
+    args = parser.parse_args()
+    root = Path(args.root)
+
+    t0 = time.time()
+    if args.cmd == "split":
+        dirs = split(args.n, root, Path(args.features), mih=not args.no_mih)
+        sizes = [len(open_gallery(d)) for d in dirs]
+        print(f"{len(dirs)} shards under {root} (images per shard: {sizes}) in {time.time() - t0:.2f}s")
+    elif args.cmd == "serve":
+        dirs = shard_dirs(root)
+        if not dirs:
+            raise SystemExit(f"no shards under {root}; run python src/shards.py split --n N first")
+        with local_workers(dirs, args.base_port, args.unix_dir, args.workers) as addresses:
+            (root / WORKERS_FILE).write_text("".join(a + "\n" for a in addresses))
+            print(f"{len(addresses)} shard workers ready in {time.time() - t0:.2f}s:")
+            for a in addresses:
+                print("  " + a)
+            try:
+                signal.sigwait([signal.SIGINT, signal.SIGTERM])
+            except KeyboardInterrupt:
+                pass
+            (root / WORKERS_FILE).unlink(missing_ok=True)
+    elif args.cmd == "search":
+        q = args.query_feat or args.query_path
+        if not q:
+            print("Provide --query_path or --query_feat")
+            return
+        pts, des, exclude = load_query(q)
+        if des is None:
+            print(f"{q}: no features")
+            return
+        coord = ShardedSearch(read_addresses(args.shards, root), timeout=args.timeout)
+        t0 = time.time()
+        results, status = coord.search(pts, des, args.topk, mode=args.mode, nprobe=args.nprobe,
+                                       verify=args.verify, exclude=exclude)
+        print(f"Query {Path(q).name} done. elapsed {time.time() - t0:.3f}s over {len(coord)} shards"
+              f"{' (PARTIAL)' if is_partial(status) else ''}. Top-{args.topk}:")
+        for name, score in results:
+            print(f"{name}.npz\tinliers={score}")
+        for addr, s in status.items():
+            if s != "ok":
+                print(f"  shard {addr}: {s}")
+        coord.close()
+    else:
+        queries = [(pts, des, ex) for _, pts, des, ex in load_queries(resolve_queries(args.queries))
+                   if des is not None]
+        kw = dict(topk=args.topk, mode=args.mode, nprobe=args.nprobe, verify=args.verify)
+        print(f"{len(queries)} queries, concurrency {args.concurrency}, mode {args.mode}, nprobe {args.nprobe}")
+        print(f"{'shards':>6} {'qps':>8} {'speedup':>8} {'p50 ms':>8} {'p95 ms':>8} {'partial':>8}")
+        base = None
+        for n in ([int(x) for x in args.n.split(",")] if args.n else [None]):
+            if n is None:
+                coord = ShardedSearch(read_addresses(args.shards, root), timeout=args.timeout)
+                r = bench(coord, queries, args.concurrency, **kw)
+            else:
+                dirs = split(n, root / f"n{n}", Path(args.features), mih=args.mode == "mih")
+                with local_workers(dirs, BASE_PORT, args.unix_dir) as addresses:
+                    coord = ShardedSearch(addresses, timeout=args.timeout)
+                    r = bench(coord, queries, args.concurrency, **kw)
+            coord.close()
+            base = base or r["qps"]
+            print(f"{len(coord):>6d} {r['qps']:>8.2f} {r['qps'] / base:>7.2f}x {r['p50_ms']:>8.1f} "
+                  f"{r['p95_ms']:>8.1f} {r['partial']:>8d}")
+
+
+if __name__ == "__main__":
+    main()
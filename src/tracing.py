@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+轻量插桩：统计检索路径上每个阶段的耗时与调用次数（特征读取、汉明 kNN、比值测试、RANSAC、排序、
+查询特征提取等），以及各阶段的候选数、good match 数、内点数。
+  - 关闭时 span() 直接返回一个共享的空上下文管理器，count() 只做一次布尔判断，几乎没有开销
+  - 开启后每个查询（tracing.query）结束时输出一行 JSON，进程退出时输出各阶段的汇总直方图
+  - profile() 对单个查询做 cProfile（或 pyinstrument，如已安装）采样
+开启方式：
+  环境变量 FR_TRACE=1（输出到 stderr）或 FR_TRACE=trace.jsonl（追加到文件）
+  或各检索入口的 --trace [PATH] / --profile out.prof 参数
+阶段名称：load_features, decode, extract, knn_match, ratio_test, sort, ransac,
+         bow_query, vlad_encode, vlad_rank, mih_lookup
+用法：
+  FR_TRACE=1 python src/search_two_stage.py --query_feat features/book_1.npz
+  python src/search_bruteforce.py --query_feat features/book_1.npz --trace trace.jsonl
+  python src/tracing.py trace.jsonl            # 对已有的 trace 文件重新汇总
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+ENV_VAR = "FR_TRACE"
+# 直方图桶上界（毫秒）
+HIST_EDGES_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
+_enabled = False
+_out = None
+_local = threading.local()
+_agg_lock = threading.Lock()
+_agg_stages = defaultdict(list)    # 阶段 -> 每个查询内该阶段的总秒数
+_agg_counters = defaultdict(list)  # 计数器 -> 每个查询的值
+_agg_total = []
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+class QueryTrace:
+    """一个查询的记录：各阶段 [调用次数, 秒] 与计数器；可能被多个 RANSAC 线程同时写入"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            s = self.stages.get(stage)
+            if s is None:
+                self.stages[stage] = [1, seconds]
+            else:
+                s[0] += 1
+                s[1] += seconds
+
+    def count(self, key: str, n: int):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + int(n)
+
+    def to_dict(self, total: float) -> dict:
+        return {"query": self.name, "total_ms": total * 1000,
+                "stages": {k: {"calls": c, "ms": s * 1000} for k, (c, s) in self.stages.items()},
+                "counters": dict(self.counters)}
+
+
+class _Span:
+    __slots__ = ("stage", "rec", "t0")
+
+    def __init__(self, stage: str, rec: QueryTrace):
+        self.stage = stage
+        self.rec = rec
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.rec.add(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+# 不在任何查询内的阶段（如启动时加载图库）记到这里，随汇总一起输出
+_background = QueryTrace("<outside query>")
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def _current() -> QueryTrace:
+    return getattr(_local, "rec", None) or _background
+
+
+def span(stage: str):
+    """with tracing.span("ransac"): ...  关闭时返回共享的空对象"""
+    if not _enabled:
+        return _NULL
+    return _Span(stage, _current())
+
+
+def count(key: str, n: int = 1):
+    if _enabled:
+        _current().count(key, n)
+
+
+def bind(fn):
+    """让线程池中执行的 fn 记到提交它的查询下（线程池的线程没有调用方的 thread-local）"""
+    if not _enabled:
+        return fn
+    rec = _current()
+
+    def run(*args, **kw):
+        prev = getattr(_local, "rec", None)
+        _local.rec = rec
+        try:
+            return fn(*args, **kw)
+        finally:
+            _local.rec = prev
+
+    return run
+
+
+class query:
+    """with tracing.query(name): ...  界定一个查询，结束时输出它的 JSON 记录"""
+
+    __slots__ = ("name", "rec", "prev")
+
+    def __init__(self, name: str):
+        self.name = str(name)
+
+    def __enter__(self):
+        if _enabled:
+            self.prev = getattr(_local, "rec", None)
+            self.rec = _local.rec = QueryTrace(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if not _enabled:
+            return False
+        _local.rec = self.prev
+        total = time.perf_counter() - self.rec.t0
+        record = self.rec.to_dict(total)
+        with _agg_lock:
+            _agg_total.append(total)
+            for stage, (_, s) in self.rec.stages.items():
+                _agg_stages[stage].append(s)
+            for key, v in self.rec.counters.items():
+                _agg_counters[key].append(v)
+            _write(record)
+        return False
+
+
+def _write(record: dict):
+    out = _out or sys.stderr
+    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    out.flush()
+
+
+def histogram(seconds) -> dict:
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    counts = np.histogram(ms, bins=(0,) + HIST_EDGES_MS)[0]
+    return {(f"<={e:g}ms" if np.isfinite(e) else f">{HIST_EDGES_MS[-2]:g}ms"): int(c)
+            for e, c in zip(HIST_EDGES_MS, counts) if c}
+
+
+def _stats(values, scale=1.0) -> dict:
+    v = np.asarray(values, dtype=np.float64) * scale
+    return {"n": int(len(v)), "mean": float(v.mean()), "p50": float(np.percentile(v, 50)),
+            "p95": float(np.percentile(v, 95)), "p99": float(np.percentile(v, 99)), "max": float(v.max())}
+
+
+def summarize(totals, stages, counters) -> dict:
+    out = {"queries": len(totals)}
+    if totals:
+        out["total_ms"] = dict(_stats(totals, 1000), hist=histogram(totals))
+    out["stages_ms"] = {k: dict(_stats(v, 1000), hist=histogram(v)) for k, v in sorted(stages.items())}
+    out["counters"] = {k: _stats(v) for k, v in sorted(counters.items())}
+    return out
+
+
+def summary() -> dict:
+    with _agg_lock:
+        s = summarize(_agg_total, _agg_stages, _agg_counters)
+    if _background.stages:
+        s["outside_query"] = _background.to_dict(0.0)["stages"]
+    return s
+
+
+def print_summary(s: dict, out=None):
+    out = out or sys.stderr
+    out.write(f"trace: {s['queries']} queries\n")
+    if "total_ms" in s:
+        t = s["total_ms"]
+        out.write(f"  {'total':18s} p50 {t['p50']:9.2f} ms  p95 {t['p95']:9.2f} ms  max {t['max']:9.2f} ms\n")
+    for k, t in s["stages_ms"].items():
+        out.write(f"  {k:18s} p50 {t['p50']:9.2f} ms  p95 {t['p95']:9.2f} ms  max {t['max']:9.2f} ms\n")
+    for k, t in s["counters"].items():
+        out.write(f"  {k:18s} mean {t['mean']:10.1f}  p95 {t['p95']:10.1f}\n")
+
+
+def _report():
+    if not _enabled or (not _agg_total and not _background.stages):
+        return
+    s = summary()
+    if _out is not None:
+        _write({"summary": s})
+    print_summary(s)
+
+
+def enable(path=None):
+    """开启插桩；path 为 None 时写 stderr，否则追加到文件"""
+    global _enabled, _out
+    if path:
+        _out = open(path, "a", encoding="utf-8")
+    if not _enabled:
+        atexit.register(_report)
+    _enabled = True
+
+
+class profile:
+    """
+    with tracing.profile("q.prof"): ...  对包住的代码做一次 cProfile，写出 .prof 并打印前 25 个热点；
+    path 以 .html 结尾且安装了 pyinstrument 时改用 pyinstrument
+    """
+
+    def __init__(self, path):
+        self.path = str(path) if path else None
+        self.prof = None
+
+    def __enter__(self):
+        if not self.path:
+            return self
+        if self.path.endswith(".html"):
+            try:
+                from pyinstrument import Profiler
+                self.prof = Profiler()
+                self.prof.start()
+                return self
+            except ImportError:
+                self.path = self.path[:-len(".html")] + ".prof"
+        import cProfile
+        self.prof = cProfile.Profile()
+        self.prof.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.prof is None:
+            return False
+        if self.path.endswith(".html"):
+            self.prof.stop()
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(self.prof.output_html())
+        else:
+            import pstats
+            self.prof.disable()
+            self.prof.dump_stats(self.path)
+            pstats.Stats(self.prof, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+        sys.stderr.write(f"profile written to {self.path}\n")
+        return False
+
+
+def add_arguments(parser):
+    """给检索入口加 --trace / --profile 参数"""
+    parser.add_argument("--trace", nargs="?", const="-", default=None,
+                        help="per-query stage timings as JSONL (to PATH, or stderr without a value)")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="cProfile the search into this .prof file (.html uses pyinstrument)")
+
+
+def setup(args):
+    if getattr(args, "trace", None):
+        enable(None if args.trace == "-" else args.trace)
+
+
+_env = os.environ.get(ENV_VAR, "")
+if _env and _env != "0":
+    enable(None if _env.lower() in ("1", "true", "stderr", "-") else _env)
+
+
+def main():
+    # 重新汇总 trace 文件（例如把多次运行的记录合并）
+    totals, stages, counters = [], defaultdict(list), defaultdict(list)
+    for path in sys.argv[1:]:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                if "query" not in rec:
+                    continue
+                totals.append(rec["total_ms"] / 1000)
+                for k, v in rec["stages"].items():
+                    stages[k].append(v["ms"] / 1000)
+                for k, v in rec["counters"].items():
+                    counters[k].append(v)
+    if not totals:
+        print("Usage: python src/tracing.py trace.jsonl [more.jsonl ...]")
+        return
+    print_summary(summarize(totals, stages, counters), sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
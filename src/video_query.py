@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+视频流查询：用 cv2.VideoCapture 逐帧解码，每帧缩放 + 灰度 + ORB，但不对每一帧都做全图库检索：
+  - 跟踪：已识别出图库图片时，当前帧只与这一张图做比值测试匹配 + RANSAC（ransac_validate.verify_arrays），
+    内点数 >= TRACK_MIN_INLIERS 即认为仍在跟踪
+  - 关键帧：以下情况才触发一次全图库检索（search_two_stage.search）
+      start     第一帧
+      lost      跟踪的内点数跌破阈值
+      scene     画面变化：当前帧与上一个关键帧的 dHash 距离 > SCENE_DHASH（见 dedup.py）
+      interval  距上一个关键帧已有 --keyframe 帧（没有识别结果时也会定期重试）
+    检索 Top-1 的内点数 >= RECOGNIZE_MIN_INLIERS 时作为新的跟踪目标，否则本帧报告未识别
+  - 逐帧记录 处理延迟（解码之后到得出结果）与事件，汇总 p50/p95、有效帧率（帧数 / 总耗时，含解码）
+测试片段由图库图片本地生成（make-clip）：每张图慢速平移 + 缩放 + 小角度旋转，图与图之间插入一段噪声画面，
+旁边的 <clip>.json 记录每帧对应的图库 id（噪声帧为 null），run 时据此统计识别正确率。
+用法：
+  python src/video_query.py make-clip --out dataset/clip.avi --images 6 --seconds 3
+  python src/video_query.py run dataset/clip.avi                       # 跟踪 + 关键帧检索
+  python src/video_query.py run dataset/clip.avi --every_frame         # 对照：每帧全图库检索
+  python src/video_query.py run dataset/clip.avi --coarse flann --jsonl frames.jsonl
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.dedup import dhash, hamming
+from src.extra_features import ORB_PARAMS
+from src.feature_store import FEAT_DIR, open_gallery
+from src.hamming import RATIO_TEST_THRESHOLD, ratio_match
+from src.pipeline import MAX_SIDE, detect, list_images
+from src.ransac_validate import verify_arrays
+from src import search_two_stage, tracing
+
+IMG_DIR = Path("dataset/images")
+TRACK_MIN_INLIERS = 15      # 跟踪：与当前目标的内点数低于该值视为丢失
+RECOGNIZE_MIN_INLIERS = 20  # 识别：全图库检索 Top-1 至少这么多内点才采信（噪声画面通常只有个位数）
+SCENE_DHASH = 20            # 与上一个关键帧的 dHash 距离超过该值视为换了场景
+KEYFRAME_INTERVAL = 50      # 最多每这么多帧做一次全图库检索
+CLIP_SIZE = (640, 480)
+
+
+def frame_gray(frame, max_side: int = MAX_SIDE):
+    """BGR 帧 -> 最长边不超过 max_side 的灰度图（与建库相同的缩放）"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    h, w = gray.shape[:2]
+    scale = min(1.0, max_side / max(h, w)) if max_side else 1.0
+    if scale != 1.0:
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return gray
+
+
+class VideoTracker:
+    """逐帧调用 process()，返回该帧的识别结果与事件"""
+
+    def __init__(self, gallery, topk: int = 1, nprobe: int = 30, coarse: str = "match", max_side: int = MAX_SIDE,
+                 keyframe: int = KEYFRAME_INTERVAL, scene: int = SCENE_DHASH, every_frame: bool = False, **search_kw):
+        self.gallery = gallery
+        self.topk, self.nprobe, self.coarse = topk, nprobe, coarse
+        self.search_kw = search_kw
+        self.max_side = max_side
+        self.keyframe, self.scene, self.every_frame = keyframe, scene, every_frame
+        self.orb = cv2.ORB_create(**ORB_PARAMS)
+        self.target = None        # (图片id, pts, des)
+        self.key_hash = None      # 上一个关键帧的 dHash
+        self.key_frame = None     # 上一个关键帧的帧号
+        self.n = 0
+
+    def _search(self, pts, des):
+        with tracing.span("video_search"):
+            return search_two_stage.search(self.gallery, pts, des, self.topk, self.nprobe, coarse=self.coarse,
+                                           **self.search_kw)
+
+    def _track(self, pts, des) -> int:
+        name, t_pts, t_des = self.target
+        with tracing.span("video_track"):
+            qi, ti, _ = ratio_match(des, t_des, RATIO_TEST_THRESHOLD)
+            inliers, _ = verify_arrays(pts, t_pts, qi, ti)
+        return inliers
+
+    def _reason(self, gray) -> str:
+        """本帧是否为关键帧：返回触发原因，不是关键帧返回 None"""
+        if self.every_frame:
+            return "every"
+        if self.key_hash is None:
+            return "start"
+        if hamming(dhash(gray), self.key_hash) > self.scene:
+            return "scene"
+        if self.n - self.key_frame >= self.keyframe:
+            return "interval"
+        return None
+
+    def process(self, frame) -> dict:
+        gray = frame_gray(frame, self.max_side)
+        pts, des = detect(gray, self.orb)
+        out = {"frame": self.n, "keypoints": len(des)}
+        reason = None
+        if self.target is not None and not self.every_frame:
+            inliers = self._track(pts, des)
+            if inliers >= TRACK_MIN_INLIERS:
+                # 跟踪成功时也要看是否换了场景 / 到了定期关键帧（目标可能被更好的图取代）
+                reason = self._reason(gray)
+                if reason is None:
+                    out.update(match=self.target[0], inliers=inliers, event="track")
+                    self.n += 1
+                    return out
+            else:
+                reason = "lost"
+                self.target = None
+        else:
+            reason = self._reason(gray)
+        if reason is None:
+            out.update(match=None, inliers=0, event="idle")
+            self.n += 1
+            return out
+        results = self._search(pts, des)
+        self.key_hash, self.key_frame = dhash(gray), self.n
+        tracing.count("video_keyframe")
+        if results and results[0][1] >= RECOGNIZE_MIN_INLIERS:
+            name, inliers = results[0]
+            t_pts, t_des = self.gallery.get_by_name(name)
+            self.target = (name, t_pts, t_des)
+            out.update(match=name, inliers=int(inliers), event="search", reason=reason)
+        else:
+            self.target = None
+            out.update(match=None, inliers=int(results[0][1]) if results else 0, event="search", reason=reason)
+        self.n += 1
+        return out
+
+
+def run(video: Path, tracker: VideoTracker, jsonl=None, truth=None) -> dict:
+    """处理整个视频，返回汇总；truth 为逐帧的图库 id 列表（make-clip 生成的 .json）"""
+    cap = cv2.VideoCapture(str(video))
+    if not cap.isOpened():
+        raise FileNotFoundError(f"cannot open {video}")
+    lat, frames = [], []
+    t0 = time.perf_counter()
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            t = time.perf_counter()
+            r = tracker.process(frame)
+            r["ms"] = (time.perf_counter() - t) * 1000
+            lat.append(r["ms"])
+            frames.append(r)
+            if jsonl is not None:
+                jsonl.write(json.dumps(r, ensure_ascii=False) + "\n")
+    finally:
+        cap.release()
+    wall = time.perf_counter() - t0
+    if not frames:
+        raise ValueError(f"no frames decoded from {video}")
+    lat = np.array(lat)
+    events = {}
+    for r in frames:
+        key = r["event"] + (":" + r["reason"] if "reason" in r else "")
+        events[key] = events.get(key, 0) + 1
+    summary = {"frames": len(frames), "fps": len(frames) / wall, "p50_ms": float(np.percentile(lat, 50)),
+               "p95_ms": float(np.percentile(lat, 95)), "max_ms": float(lat.max()),
+               "searches": sum(r["event"] == "search" for r in frames), "events": events}
+    if truth is not None:
+        n = min(len(truth), len(frames))
+        summary["accuracy"] = float(np.mean([frames[i]["match"] == truth[i] for i in range(n)]))
+    return summary
+
+
+# ---------------- 测试片段 ----------------
+
+def make_clip(images, out: Path, fps: int = 25, seconds: float = 3.0, gap: float = 0.6, size=CLIP_SIZE,
+              seed: int = 0) -> list:
+    """
+    每张图显示 seconds 秒（慢速缩放 1.0 -> 1.25、平移、旋转至多 6 度，模拟手持拍摄），
+    图与图之间插入 gap 秒噪声画面；返回逐帧的图库 id（噪声帧为 None），同时写到 <out>.json
+    """
+    rng = np.random.default_rng(seed)
+    w, h = size
+    writer = cv2.VideoWriter(str(out), cv2.VideoWriter_fourcc(*("MJPG" if out.suffix == ".avi" else "mp4v")),
+                             fps, size)
+    if not writer.isOpened():
+        raise RuntimeError(f"cannot write {out}")
+    truth = []
+    try:
+        for p in images:
+            img = cv2.imread(str(p))
+            if img is None:
+                continue
+            s = min(w / img.shape[1], h / img.shape[0]) * 0.9
+            n = int(fps * seconds)
+            dx, dy, rot = rng.uniform(-40, 40), rng.uniform(-30, 30), rng.uniform(-6, 6)
+            for i in range(n):
+                a = i / max(n - 1, 1)
+                M = cv2.getRotationMatrix2D((img.shape[1] / 2, img.shape[0] / 2), rot * a, s * (1 + 0.25 * a))
+                M[0, 2] += w / 2 - img.shape[1] / 2 + dx * a
+                M[1, 2] += h / 2 - img.shape[0] / 2 + dy * a
+                frame = cv2.warpAffine(img, M, size, borderMode=cv2.BORDER_CONSTANT, borderValue=(40, 40, 40))
+                writer.write(frame)
+                truth.append(p.stem)
+            for _ in range(int(fps * gap)):
+                noise = cv2.GaussianBlur(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), (0, 0), 3)
+                writer.write(noise)
+                truth.append(None)
+    finally:
+        writer.release()
+    Path(str(out) + ".json").write_text(json.dumps({"fps": fps, "frames": truth}, ensure_ascii=False),
+                                        encoding="utf-8")
+    return truth
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    m = sub.add_parser("make-clip", help="render a test clip from gallery images")
+    m.add_argument("--out", type=str, default="dataset/clip.avi")
+    m.add_argument("--src", type=str, default=str(IMG_DIR))
+    m.add_argument("--images", type=int, default=6, help="gallery images shown in the clip")
+    m.add_argument("--seconds", type=float, default=3.0, help="seconds per image")
+    m.add_argument("--fps", type=int, default=25)
+    m.add_argument("--seed", type=int, default=0)
+    r = sub.add_parser("run", help="recognise a video file")
+    r.add_argument("video", type=str)
+    r.add_argument("--features", type=str, default=str(FEAT_DIR))
+    r.add_argument("--coarse", choices=["match", "cascade", "flann"], default="match",
+                   help="quick stage of the keyframe gallery search")
+    r.add_argument("--nprobe", type=int, default=30)
+    r.add_argument("--keyframe", type=int, default=KEYFRAME_INTERVAL, help="max frames between gallery searches")
+    r.add_argument("--scene", type=int, default=SCENE_DHASH, help="dHash distance that counts as a scene change")
+    r.add_argument("--every_frame", action="store_true", help="baseline: full gallery search on every frame")
+    r.add_argument("--jsonl", type=str, help="write per-frame results here")
+    tracing.add_arguments(r)
+    args = parser.parse_args()
+
+    if args.cmd == "make-clip":
+        rng = np.random.default_rng(args.seed)
+        files = list_images(args.src)
+        picked = [files[i] for i in sorted(rng.choice(len(files), size=min(args.images, len(files)), replace=False))]
+        out = Path(args.out)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        truth = make_clip(picked, out, args.fps, args.seconds, seed=args.seed)
+        print(f"{out}: {len(truth)} frames ({', '.join(p.stem for p in picked)}), ground truth -> {out}.json")
+        return
+
+    tracing.setup(args)
+    gallery = open_gallery(Path(args.features))
+    kw = {}
+    if args.coarse == "flann":
+        from src.matchers import load_flann
+        kw["flann"] = load_flann(gallery, Path(args.features) / "flann")
+    tracker = VideoTracker(gallery, nprobe=args.nprobe, coarse=args.coarse, keyframe=args.keyframe,
+                           scene=args.scene, every_frame=args.every_frame, **kw)
+    truth_file = Path(args.video + ".json")
+    truth = json.loads(truth_file.read_text(encoding="utf-8"))["frames"] if truth_file.exists() else None
+    jsonl = open(args.jsonl, "w", encoding="utf-8") if args.jsonl else None
+    try:
+        s = run(Path(args.video), tracker, jsonl, truth)
+    finally:
+        if jsonl is not None:
+            jsonl.close()
+    print(f"{s['frames']} frames, {s['fps']:.1f} fps effective, per-frame p50 {s['p50_ms']:.1f} ms, "
+          f"p95 {s['p95_ms']:.1f} ms, max {s['max_ms']:.1f} ms, {s['searches']} gallery searches")
+    print("events:", ", ".join(f"{k}={v}" for k, v in sorted(s["events"].items())))
+    if "accuracy" in s:
+        print(f"frame accuracy vs {truth_file.name}: {s['accuracy']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
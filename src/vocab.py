@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+视觉词袋（BoW）：在 ORB 二值描述子上训练分层 k-majority 词汇树，
+并建立 “视觉单词 -> 包含它的图片” 倒排索引（TF-IDF 加权），
+供 search_two_stage.py 的快速阶段在亚线性时间内选出 Top-nprobe 候选。
+输出（默认 features/bow/）：
+  vocab.npz   # 词汇树：各节点中心、子节点表、叶子对应的单词编号
+  index.npz   # 倒排索引：CSR 形式的 postings（图片下标 + 权重）与 idf
+用法：
+  python src/vocab.py build --k 10 --depth 4          # 训练词汇树并建倒排索引
+  python src/vocab.py eval --nprobe 30 --queries 30   # 与原快速阶段对比召回与耗时
+"""
+import argparse
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from src.feature_store import FEAT_DIR, open_gallery
+from src.hamming import hamming_matrix, hamming_rows
+from src import tracing
+
+BOW_DIR = FEAT_DIR / "bow"
+VOCAB_FILE = "vocab.npz"
+INDEX_FILE = "index.npz"
+ASSIGN_CHUNK = 1 << 14  # 分配到中心时每块的样本行数（距离矩阵与 ±1 位平面只按块分配，内存与样本数无关）
+
+def nearest_center(des: np.ndarray, centers: np.ndarray, chunk: int = ASSIGN_CHUNK) -> np.ndarray:
+    """每个描述子最近（汉明距离）的中心下标，按行分块计算"""
+    labels = np.empty(len(des), dtype=np.int64)
+    for i in range(0, len(des), chunk):
+        labels[i:i + chunk] = hamming_matrix(des[i:i + chunk], centers).argmin(axis=1)
+    return labels
+
+
+def k_majority(des: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    二值 k-majority 聚类：分配到最近中心（汉明距离），中心取成员每一位的多数票
+    返回 centers (k,32) uint8 与 labels (N,)
+    """
+    rng = np.random.default_rng(seed)
+    centers = des[rng.choice(len(des), size=k, replace=False)].copy()
+    bits = np.unpackbits(des, axis=1)
+    labels = np.zeros(len(des), dtype=np.int64)
+    for it in range(iters):
+        new_labels = nearest_center(des, centers)
+        if it > 0 and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        for c in range(k):
+            members = bits[labels == c]
+            if len(members) == 0:
+                # 空簇：随机换一个样本当中心
+                centers[c] = des[rng.integers(len(des))]
+                continue
+            centers[c] = np.packbits(members.mean(axis=0) >= 0.5)
+    return centers, labels
+
+
+class VocabTree:
+    """
+    分层 k-majority 词汇树（branching=k，深度 depth）
+    节点 0 为根；children[n] 为子节点下标（-1 表示无）；word[n] >= 0 表示叶子对应的单词
+    """
+
+    def __init__(self, centers, children, word):
+        self.centers = np.asarray(centers, dtype=np.uint8)
+        self.children = np.asarray(children, dtype=np.int32)
+        self.word = np.asarray(word, dtype=np.int32)
+        self.n_words = int(self.word.max()) + 1 if len(self.word) else 0
+
+    @classmethod
+    def train(cls, des: np.ndarray, k: int = 10, depth: int = 4, iters: int = 10, seed: int = 0) -> "VocabTree":
+        centers = [np.zeros(des.shape[1], dtype=np.uint8)]
+        children = [[-1] * k]
+        word = [-1]
+        n_words = 0
+        # 广度优先：(节点下标, 该节点的训练样本, 当前深度)
+        queue = [(0, des, 0)]
+        while queue:
+            node, sub, level = queue.pop(0)
+            if level >= depth or len(sub) < 2 * k:
+                word[node] = n_words
+                n_words += 1
+                continue
+            cs, labels = k_majority(sub, k, iters=iters, seed=seed + node)
+            for c in range(k):
+                child = len(centers)
+                centers.append(cs[c])
+                children.append([-1] * k)
+                word.append(-1)
+                children[node][c] = child
+                queue.append((child, sub[labels == c], level + 1))
+        return cls(np.array(centers), np.array(children), np.array(word))
+
+    def quantize(self, des: np.ndarray) -> np.ndarray:
+        """把每个描述子沿树下降到叶子，返回单词编号 (N,)"""
+        des = np.ascontiguousarray(des, dtype=np.uint8)
+        node = np.zeros(len(des), dtype=np.int64)
+        while len(des):
+            kids = self.children[node]                      # (N,k)
+            active = kids[:, 0] >= 0
+            if not active.any():
+                break
+            idx = np.nonzero(active)[0]
+            kid = kids[idx]
+            d = hamming_rows(des[idx, None, :], self.centers[np.maximum(kid, 0)])
+            d[kid < 0] = np.iinfo(np.int32).max
+            node[idx] = kid[np.arange(len(idx)), d.argmin(axis=1)]
+        return self.word[node]
+
+    def save(self, path: Path):
+        np.savez(path, centers=self.centers, children=self.children, word=self.word)
+
+    @classmethod
+    def load(cls, path: Path) -> "VocabTree":
+        a = np.load(path)
+        return cls(a["centers"], a["children"], a["word"])
+
+
+class InvertedIndex:
+    """
+    倒排索引：单词 t 的 postings 为 img[ptr[t]:ptr[t+1]] 及权重 w（tf-idf，按图 L2 归一化）
+    查询只累加查询单词对应的 postings，不遍历整个图库
+    """
+
+    def __init__(self, ids, ptr, img, w, idf):
+        self.ids = [str(x) for x in ids]
+        self.ptr = np.asarray(ptr, dtype=np.int64)
+        self.img = np.asarray(img, dtype=np.int32)
+        self.w = np.asarray(w, dtype=np.float32)
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self._pos = {name: i for i, name in enumerate(self.ids)}
+
+    @classmethod
+    def build(cls, vocab: VocabTree, gallery) -> "InvertedIndex":
+        V = vocab.n_words
+        rows_img, rows_word, rows_tf = [], [], []
+        for i in range(len(gallery)):
+            _, des = gallery.get(i)
+            if len(des) == 0:
+                continue
+            words = vocab.quantize(des)
+            uniq, cnt = np.unique(words, return_counts=True)
+            rows_img.append(np.full(len(uniq), i, dtype=np.int32))
+            rows_word.append(uniq.astype(np.int32))
+            rows_tf.append((cnt / len(words)).astype(np.float32))
+        img = np.concatenate(rows_img) if rows_img else np.empty(0, np.int32)
+        word = np.concatenate(rows_word) if rows_word else np.empty(0, np.int32)
+        tf = np.concatenate(rows_tf) if rows_tf else np.empty(0, np.float32)
+        df = np.bincount(word, minlength=V)
+        idf = np.log(max(len(gallery), 1) / np.maximum(df, 1)).astype(np.float32)
+        w = tf * idf[word]
+        norm = np.sqrt(np.bincount(img, weights=w * w, minlength=len(gallery)))
+        w = (w / np.maximum(norm[img], 1e-12)).astype(np.float32)
+        order = np.argsort(word, kind="stable")
+        ptr = np.concatenate([[0], np.cumsum(df)])
+        return cls(gallery.ids, ptr, img[order], w[order], idf)
+
+    def query(self, vocab: VocabTree, des: np.ndarray, nprobe: int, exclude: str = None) -> List[Tuple[str, float]]:
+        """返回按 tf-idf 余弦相似度排序的 Top-nprobe [(图片id, 分数)]"""
+        if des is None or len(des) == 0:
+            return []
+        with tracing.span("bow_query"):
+            return self._query(vocab, des, nprobe, exclude)
+
+    def _query(self, vocab, des, nprobe, exclude):
+        uniq, cnt = np.unique(vocab.quantize(des), return_counts=True)
+        q = (cnt / cnt.sum()) * self.idf[uniq]
+        q = q / max(np.linalg.norm(q), 1e-12)
+        starts, ends = self.ptr[uniq], self.ptr[uniq + 1]
+        lens = ends - starts
+        if lens.sum() == 0:
+            return []
+        # 把各单词的 postings 区间拼成一个下标数组，一次 bincount 累加得分
+        pos = np.repeat(starts - np.concatenate([[0], np.cumsum(lens)[:-1]]), lens) + np.arange(lens.sum())
+        scores = np.bincount(self.img[pos], weights=self.w[pos] * np.repeat(q, lens), minlength=len(self.ids))
+        if exclude in self._pos:
+            scores[self._pos[exclude]] = -1.0
+        n = min(nprobe, len(scores))
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    def save(self, path: Path):
+        np.savez(path, ids=np.array(self.ids, dtype=str), ptr=self.ptr, img=self.img, w=self.w, idf=self.idf)
+
+    @classmethod
+    def load(cls, path: Path) -> "InvertedIndex":
+        a = np.load(path)
+        return cls(a["ids"], a["ptr"], a["img"], a["w"], a["idf"])
+
+
+def load_bow(bow_dir: Path = BOW_DIR) -> Tuple[VocabTree, InvertedIndex]:
+    bow_dir = Path(bow_dir)
+    return VocabTree.load(bow_dir / VOCAB_FILE), InvertedIndex.load(bow_dir / INDEX_FILE)
+
+
+def train_bow(gallery, k: int = 10, depth: int = 4, iters: int = 10, sample: int = 200000,
+              seed: int = 0) -> Tuple[VocabTree, InvertedIndex]:
+    """在图库描述子的随机样本上训练词汇树，并为整个图库建倒排索引"""
+    rng = np.random.default_rng(seed)
+    des = np.asarray(gallery.des)
+    sample = des[rng.choice(len(des), size=min(sample, len(des)), replace=False)]
+    vocab = VocabTree.train(sample, k=k, depth=depth, iters=iters)
+    return vocab, InvertedIndex.build(vocab, gallery)
+
+
+def build(args):
+    gallery = open_gallery(FEAT_DIR)
+    if len(gallery) == 0:
+        print("No features found in", FEAT_DIR)
+        return
+    t0 = time.time()
+    vocab, index = train_bow(gallery, k=args.k, depth=args.depth, iters=args.iters, sample=args.sample)
+    dt = time.time() - t0
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    vocab.save(out / VOCAB_FILE)
+    index.save(out / INDEX_FILE)
+    print(f"Vocabulary: {vocab.n_words} words; inverted index: {len(gallery)} images, "
+          f"{len(index.img)} postings; built in {dt:.2f}s -> {out}")
+
+
+def warped_query(img_path: Path, rng) -> np.ndarray:
+    """对图库图片做随机旋转/缩放后重新提取 ORB，模拟一张“同物体的新照片”"""
+    import cv2
+    from src.extra_features import orb
+    img = cv2.imread(str(img_path), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    h, w = img.shape
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), rng.uniform(-30, 30), rng.uniform(0.7, 1.2))
+    _, des = orb.detectAndCompute(cv2.warpAffine(img, M, (w, h)), None)
+    return des
+
+
+def evaluate(args):
+    # 以图库图片的旋转/缩放版本为查询：统计两种快速阶段把原图排进 Top-nprobe 的比例，
+    # 以及原快速阶段（逐图 knnMatch）Top-K 落在 BoW Top-nprobe 内的比例
+    from src.search_two_stage import quick_score
+    gallery = open_gallery(FEAT_DIR)
+    vocab, index = load_bow(Path(args.out))
+    rng = np.random.default_rng(0)
+    queries = rng.choice(len(gallery), size=min(args.queries, len(gallery)), replace=False)
+    t_bow, t_quick, hit_bow, hit_quick, overlap = [], [], [], [], []
+    for qi in queries:
+        name = gallery.ids[qi]
+        des_q = warped_query(Path(args.images) / (name + ".jpg"), rng)
+        if des_q is None or len(des_q) == 0:
+            continue
+        t0 = time.time()
+        bow_top = [n for n, _ in index.query(vocab, des_q, args.nprobe)]
+        t_bow.append(time.time() - t0)
+        t0 = time.time()
+        scores = []
+        for j in range(len(gallery)):
+            cnt, _ = quick_score(des_q, gallery.get(j)[1])
+            scores.append((gallery.ids[j], cnt))
+        scores.sort(key=lambda x: x[1], reverse=True)
+        t_quick.append(time.time() - t0)
+        quick_top = [n for n, _ in scores[:args.nprobe]]
+        hit_bow.append(name in bow_top)
+        hit_quick.append(name in quick_top)
+        overlap.append(len(set(quick_top[:args.topk]) & set(bow_top)) / args.topk)
+    if not t_bow:
+        print("No readable query images in", args.images)
+        return
+    print(f"queries={len(t_bow)} nprobe={args.nprobe}")
+    print(f"BoW coarse  : mean {np.mean(t_bow) * 1000:.2f} ms/query, recall@{args.nprobe} {np.mean(hit_bow):.3f}")
+    print(f"quick stage : mean {np.mean(t_quick) * 1000:.2f} ms/query, recall@{args.nprobe} {np.mean(hit_quick):.3f}")
+    print(f"quick-stage Top-{args.topk} covered by BoW Top-{args.nprobe}: {np.mean(overlap):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="train vocabulary and build inverted index")
+    b.add_argument("--k", type=int, default=10, help="branching factor")
+    b.add_argument("--depth", type=int, default=4)
+    b.add_argument("--iters", type=int, default=10)
+    b.add_argument("--sample", type=int, default=200000, help="descriptors sampled for training")
+    b.add_argument("--out", type=str, default=str(BOW_DIR))
+    e = sub.add_parser("eval", help="compare with the knnMatch quick stage")
+    e.add_argument("--nprobe", type=int, default=30)
+    e.add_argument("--topk", type=int, default=5)
+    e.add_argument("--queries", type=int, default=30)
+    e.add_argument("--images", type=str, default="dataset/images_pre", help="images used to synthesize queries")
+    e.add_argument("--out", type=str, default=str(BOW_DIR))
+    args = parser.parse_args()
+    if args.cmd == "build":
+        build(args)
+    else:
+        evaluate(args)
+
+
+if __name__ == "__main__":
+    main()